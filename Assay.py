@@ -1,7 +1,18 @@
 
+import io
+import os
 import re
+import json
+import shutil
+import hashlib
 import numpy as np
+import pandas as pd
 import xlrd
+from Profiler import profiler
+
+script_path = os.path.dirname(os.path.abspath(__file__))
+cache_dir = os.path.join(script_path, 'cache', 'assays')
+version = "2" # bump when the cache layout or the parsing changes, invalidating cached assays
 
 
 class Assay:
@@ -19,9 +30,147 @@ class Assay:
 
     Wells are adressed by a single integer index ranging from 0 to 95, e.g. 
     assay.well[14] gives the timeline for well 14 (colum B row 2 in a 12x8 layout).
+
+    A .csv file is read as one row per cycle, the time in seconds followed by one column per
+    well in row-major order (A1, A2, ..., B1, ...). Appended rows are picked up by update().
+    An export that is still in progress only yields its complete cycles, and before the first
+    cycle is complete, empty time, well and matrix arrays.
+
+    With p_cache, the parsed data is stored in cache/assays, keyed by a hash of the workbook
+    contents and the plate dimensions, and later loads memory-map the stored arrays instead of
+    parsing the workbook. A changed workbook has a different hash, so it is parsed again.
     """
 
-    def __init__(self, p_path, p_cols, p_rows):
+    # cycle time strings such as "Cycle 2 (1 min 15 s)", "Cycle 40 (1 h 2 min)" or "Cycle 1 (30 s)"
+    time_regex = r'^Cycle \d+ \((?:(?P<h>\d+) h)? ?(?:(?P<min>\d+) min)? ?(?:(?P<s>\d+) s)?\)$'
+
+    # protocol metadata stored alongside the cached arrays
+    metadata = ("test_name", "measurement", "cycles", "protocol_cycles", "cycle_time")
+
+    def __init__(self, p_path, p_cols, p_rows, p_reader="bulk", p_cache=False):
+        self.COLS = p_cols
+        self.ROWS = p_rows
+        self.path = p_path
+        self.reader = p_reader
+        self.offset = None # bytes of a csv file read so far
+        self.digest = None # content hash of the file, computed on first use
+        with profiler.phase("assay load", path=p_path):
+            self.cache_path = os.path.join(cache_dir, self.content_hash()) if p_cache else None
+            if self.cache_path is not None and os.path.exists(self.cache_path):
+                self.load_cache()
+            else:
+                self.read()
+                if self.cache_path is not None:
+                    self.save_cache()
+
+    def read(self):
+        """Reads the protocol information and the kinetic data from the workbook"""
+        if self.path.endswith(".csv"):
+            self.read_csv()
+            return
+        book = xlrd.open_workbook(self.path)
+        # open sheets by name
+        ptcl = book.sheet_by_name('Protocol Information')
+        data = book.sheet_by_name('DATA')
+        
+        # read protocol
+        self.test_name = ptcl.cell(3, 0).value[len('Test Name: '):]
+        self.measurement = ptcl.cell(11, 1).value
+        self.protocol_cycles = int(ptcl.cell(17, 1).value)
+        self.cycle_time = float(ptcl.cell(18, 1).value/60)
+        # an export written during the read only contains the cycles measured so far
+        complete = max(0, (data.nrows - 15 - self.ROWS)//(self.ROWS + 4) + 1)
+        self.cycles = min(self.protocol_cycles, complete)
+
+        if self.reader == "bulk":
+            self.read_bulk(data)
+        else:
+            self.read_legacy(data)
+        # reshape assay.wells into 2d array for easier access
+        self.matrix = self.well.reshape(self.ROWS, self.COLS, self.cycles)
+
+    def read_csv(self):
+        """Reads a csv file of cycles from the start"""
+        self.test_name = os.path.splitext(os.path.basename(self.path))[0]
+        self.measurement = ""
+        self.protocol_cycles = None # unknown, rows are appended as they are measured
+        self.offset = 0
+        self.time = np.zeros(0)
+        self.well = np.zeros((self.ROWS*self.COLS, 0))
+        self.append_csv()
+
+    def append_csv(self):
+        """Reads the complete rows appended to the csv file since the last read, returning their number"""
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            chunk = f.read()
+        end = chunk.rfind(b'\n') + 1 # a partly written last line is left for the next read
+        if end == 0:
+            rows = np.zeros((0, 1 + self.ROWS*self.COLS))
+        else:
+            header = 0 if self.offset == 0 else None
+            rows = pd.read_csv(io.BytesIO(chunk[:end]), header=header).values.astype(float)
+            self.offset += end
+        if rows.shape[1] != 1 + self.ROWS*self.COLS:
+            raise ValueError("csv file must have a time column and one column per well")
+        self.time = np.concatenate([self.time, rows[:, 0]])
+        self.well = np.hstack([self.well, rows[:, 1:].T])
+        self.cycles = len(self.time)
+        self.cycle_time = float(np.median(np.diff(self.time))/60) if self.cycles > 1 else 0.0
+        self.matrix = self.well.reshape(self.ROWS, self.COLS, self.cycles)
+        return len(rows)
+
+    def update(self):
+        """Reads the cycles added to the file since it was last read, returning the number of new cycles
+
+        Rows appended to a csv file are read on their own, a workbook is read again in full.
+        """
+        cycles = self.cycles
+        self.digest = None # the file has changed
+        if self.offset is not None:
+            return self.append_csv()
+        self.read()
+        return self.cycles - cycles
+
+    def content_hash(self):
+        """Returns a hash of the workbook contents and the plate dimensions, the key of the assay cache
+
+        The hash is computed once per read of the file, update() computes it afresh.
+        """
+        if self.digest is None:
+            digest = hashlib.sha256("{}\n{}\n{}\n".format(version, self.ROWS, self.COLS).encode())
+            with open(self.path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+            self.digest = digest.hexdigest()
+        return self.digest
+
+    def load_cache(self):
+        """Memory-maps the arrays and reads the protocol metadata of a cached assay"""
+        with open(os.path.join(self.cache_path, "metadata.json"), 'r') as f:
+            metadata = json.load(f)
+        for name in self.metadata:
+            setattr(self, name, metadata[name])
+        self.time = np.load(os.path.join(self.cache_path, "time.npy"), mmap_mode='r')
+        self.matrix = np.load(os.path.join(self.cache_path, "matrix.npy"), mmap_mode='r')
+        self.well = self.matrix.reshape(self.ROWS*self.COLS, self.cycles)
+
+    def save_cache(self):
+        """Writes the arrays and protocol metadata to the assay cache"""
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(self.cache_path, os.getpid())
+        os.makedirs(tmp_path, exist_ok=True)
+        np.save(os.path.join(tmp_path, "time.npy"), self.time)
+        np.save(os.path.join(tmp_path, "matrix.npy"), np.ascontiguousarray(self.matrix))
+        with open(os.path.join(tmp_path, "metadata.json"), 'w') as f:
+            json.dump({name: getattr(self, name) for name in self.metadata}, f)
+        try:
+            os.replace(tmp_path, self.cache_path) # atomic, so concurrent runs never read a partial entry
+        except OSError: # another run has cached the same workbook first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def read_legacy(self, data):
+        """Reads the cycle times and well readings cell by cell"""
         def parse_time(string):
             """parses the Cycle time string into seconds
             
@@ -46,26 +195,9 @@ class Assay:
                 return total_seconds
             print("Failed to read assay data, please check format.")
 
-
-        self.COLS = p_cols
-        self.ROWS = p_rows
-        self.path = p_path
-        book = xlrd.open_workbook(self.path)
-        # open sheets by name
-        ptcl = book.sheet_by_name('Protocol Information')
-        data = book.sheet_by_name('DATA')
-        
-        # read protocol
-        self.test_name = ptcl.cell(3, 0).value[len('Test Name: '):]
-        self.measurement = ptcl.cell(11, 1).value
-        self.cycles = int(ptcl.cell(17, 1).value)
-        self.cycle_time = float(ptcl.cell(18, 1).value/60)
-
         # initialize data attributes
         self.time = np.zeros(self.cycles)
         self.well = np.zeros((self.ROWS*self.COLS, self.cycles))
-        self.matrix = np.zeros((self.ROWS, self.COLS, self.cycles))
-
 
         for idx in range(self.cycles):
             # parse time
@@ -77,13 +209,43 @@ class Assay:
                     val = data.cell(15 + (self.ROWS+4)*idx + row,
                                     1 + col).value
                     self.well[row*self.COLS + col, idx] = val if val != '' else None
-        # reshape assay.wells into 2d array for easier access
-        self.matrix = self.well.reshape(self.ROWS, self.COLS, self.cycles)
+
+    def read_bulk(self, data):
+        """Reads the DATA sheet into one array and extracts all cycle blocks at once
+
+        Each cycle is a block of ROWS+4 sheet rows: the time string in the first column of the
+        block's first row, and the readings three rows below it. The block rows are gathered
+        with one fancy index, and the time strings are parsed in a single vectorized pass.
+        """
+        if self.cycles == 0: # an export that has not completed its first cycle yet
+            self.time = np.zeros(0)
+            self.well = np.zeros((self.ROWS*self.COLS, 0))
+            return
+        stride = self.ROWS + 4
+        first = 12 + stride*np.arange(self.cycles) # first sheet row of each cycle block
+        last = first[-1] + 3 + self.ROWS
+        columns = [data.col_values(col, 0, last) for col in range(self.COLS + 1)]
+        sheet = np.array(columns, dtype=object).T # (sheet rows, COLS+1)
+
+        strings = pd.Series(sheet[first, 0], dtype=str)
+        matched = strings.str.match(self.time_regex).values
+        if not matched.all():
+            print("Failed to read assay data, please check format.")
+        parts = strings.str.extract(self.time_regex).astype(float).fillna(0).values # (cycles, [h, min, s])
+        self.time = np.where(matched, parts @ np.array([3600.0, 60.0, 1.0]), np.nan)
+
+        block = sheet[(first + 3)[:, None] + np.arange(self.ROWS), 1:] # (cycles, ROWS, COLS)
+        block[block == ''] = np.nan
+        self.well = block.astype(float).transpose(1, 2, 0).reshape(self.ROWS*self.COLS, self.cycles)
 
     @property
     def path(self):
         return self._path
 
+    @property
+    def reader(self):
+        return self._reader
+
     @property
     def COLS(self):
         return self._COLS
@@ -96,9 +258,18 @@ class Assay:
     def path(self, value):
         if not isinstance(value, str):
             raise ValueError("path must be of type string")
+        elif not value.endswith((".xls", ".csv")):
+            raise ValueError("path must be an .xls or .csv file")
         else:
             self._path = value
 
+    @reader.setter
+    def reader(self, value):
+        if value not in ("bulk", "legacy"):
+            raise ValueError("reader must be 'bulk' or 'legacy'")
+        else:
+            self._reader = value
+
     @COLS.setter
     def COLS(self, value):
         if not isinstance(value, int):
@@ -0,0 +1,148 @@
+import os
+import math
+import time
+import yaml
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from Configurator import Configurator
+from Profiler import profiler
+from Logger import setup_logger
+
+# per-process state of the batch workers, set up once by init_worker
+worker_state = {}
+
+
+def init_worker(p_run, p_args, p_profile=False, p_max_workers=None):
+    """Stores the function running a loaded configuration, whether the runs are profiled and the worker processes each run may start"""
+    worker_state["run"] = p_run
+    worker_state["args"] = p_args
+    worker_state["max_workers"] = p_max_workers
+    profiler.enabled = p_profile
+
+
+def run_config(config_path, out_path):
+    """Loads and runs one configuration, returning a summary row of its status and timings"""
+    row = {"config": config_path, "output": out_path, "status": "ok", "message": "", "pid": os.getpid(),
+           "load_time": float("nan")}
+    start = time.perf_counter()
+    profiler.reset() # each run has its own profile
+    try:
+        with profiler.phase("configure"):
+            config = Configurator(config_path, p_max_workers=worker_state["max_workers"])
+        row["load_time"] = time.perf_counter() - start
+        worker_state["run"](config, worker_state["args"], out_path)
+    except Exception as exc: # one failed run should not stop the rest
+        row["status"] = "failed"
+        row["message"] = "{}: {}".format(type(exc).__name__, " ".join(str(exc).split())) # one line of the summary
+    row["total_time"] = time.perf_counter() - start
+    return row
+
+
+def run_chunk(chunk):
+    """Runs a chunk of (config path, output path) pairs one after another, in a worker process"""
+    return [run_config(config_path, out_path) for config_path, out_path in chunk]
+
+
+class Batch:
+    """Runs many configuration files on a pool of worker processes
+
+    Each worker imports the libraries once and keeps the ODE functions and the most recently used
+    assays and derived model code it loads (see Configurator.load_shared), so configurations
+    referencing the same assay.file_path or model.func_path share them. Configurations are ordered by those paths and
+    handed out in chunks, so ones sharing an assay or model mostly land on the same worker.
+    A summary of the status and timings of every run is written to batch_summary.csv in the
+    output directory. The cores are split between the batch workers: the pools a run starts
+    (report rendering, multi-start, uncertainty, sampling, ...) get at most cores/workers
+    processes each, whatever their configuration asks for.
+    """
+
+    def __init__(self, p_configs, p_out_dir, p_run, p_args, p_workers=0, p_extension="pdf"):
+        self.logger = setup_logger("batch_logger")
+        self.configs = p_configs
+        self.out_dir = p_out_dir
+        self.run_f = p_run # run(config, args, out_path), as main.run
+        self.args = p_args
+        self.workers = p_workers if p_workers > 0 else os.cpu_count()
+        self.run_workers = max(1, os.cpu_count()//self.workers) # worker processes of each pool within a run
+        self.extension = p_extension
+        self.chunks_per_worker = 4 # smaller chunks balance uneven runs, larger ones share more loads
+        self.summary_path = os.path.join(self.out_dir, "batch_summary.csv")
+
+    @property
+    def configs(self):
+        return self._configs
+
+    @configs.setter
+    def configs(self, value):
+        if not value:
+            raise ValueError("no configuration files to run")
+        else:
+            self._configs = value
+
+    @staticmethod
+    def find_configs(path):
+        """Returns the configuration files of a directory (*.yaml and *.yml), or those listed in a manifest file
+
+        A manifest lists one path per line, relative to the manifest, blank lines and lines starting with # are skipped.
+        """
+        if os.path.isdir(path):
+            names = sorted(name for name in os.listdir(path) if name.endswith((".yaml", ".yml")))
+            return [os.path.join(path, name) for name in names]
+        with open(path, 'r') as f:
+            lines = [line.strip() for line in f]
+        return [os.path.join(os.path.dirname(path), line) for line in lines if line and not line.startswith("#")]
+
+    def output_path(self, config_path):
+        """Returns the output path of a configuration, named after its file"""
+        name = os.path.splitext(os.path.basename(config_path))[0]
+        return os.path.join(self.out_dir, "{}.{}".format(name, self.extension))
+
+    def share_key(self, config_path):
+        """Returns the assay and model paths of a configuration, used to order the runs"""
+        try:
+            with open(config_path, 'r') as f:
+                config = yaml.safe_load(f)
+            return (os.path.abspath(config["assay"]["file_path"]), os.path.abspath(config["model"]["func_path"]))
+        except Exception: # reported by the run itself
+            return ("", "")
+
+    def chunks(self):
+        """Returns the (config path, output path) pairs, ordered by assay and model and split into chunks"""
+        tasks = [(config_path, self.output_path(config_path)) for config_path in self.configs]
+        outputs = [out_path for _, out_path in tasks]
+        duplicates = sorted(set(out_path for out_path in outputs if outputs.count(out_path) > 1))
+        if duplicates:
+            raise ValueError("configuration files would write the same outputs: {}".format(", ".join(duplicates)))
+        tasks.sort(key=lambda task: self.share_key(task[0]))
+        size = max(1, math.ceil(len(tasks)/(self.workers*self.chunks_per_worker)))
+        return [tasks[i:i + size] for i in range(0, len(tasks), size)]
+
+    def run(self):
+        """Runs every configuration, returning the summary table"""
+        chunks = self.chunks()
+        n_runs = sum(len(chunk) for chunk in chunks)
+        self.logger.info("Running {} configurations on {} workers.".format(n_runs, self.workers))
+        start = time.perf_counter()
+        rows = []
+        if self.workers == 1: # run in this process, which keeps the loads as a single worker would
+            init_worker(self.run_f, self.args, profiler.enabled, self.run_workers)
+            for chunk in chunks:
+                rows.extend(self.log_rows(run_chunk(chunk), len(rows), n_runs))
+        else:
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                     initargs=(self.run_f, self.args, profiler.enabled, self.run_workers)) as pool:
+                futures = [pool.submit(run_chunk, chunk) for chunk in chunks]
+                for future in as_completed(futures):
+                    rows.extend(self.log_rows(future.result(), len(rows), n_runs))
+        summary = pd.DataFrame(rows).set_index("config").loc[self.configs] # in the order given
+        summary.to_csv(self.summary_path)
+        self.logger.info("Batch finished in {:.1f} s.".format(time.perf_counter() - start))
+        return summary
+
+    def log_rows(self, rows, done, n_runs):
+        """Logs the outcome of finished runs, returning the rows"""
+        for i, row in enumerate(rows):
+            outcome = "ok" if row["status"] == "ok" else "failed, {}".format(row["message"])
+            self.logger.info("[{}/{}] {}: {} in {:.1f} s.".format(done + i + 1, n_runs, row["config"], outcome,
+                                                                 row["total_time"]))
+        return rows
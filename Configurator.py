@@ -1,32 +1,66 @@
+import os
 import yaml
 import numpy as np
-import importlib.util
+from collections import OrderedDict
 from lmfit import Parameters
 from schema import SchemaError
-from string import ascii_uppercase
 
 from Assay import Assay
-from Model import Model
+from Model import Model, load_ode_f
+from Jacobian import Jacobian
+from Kernel import Kernel
+from Sensitivity import Sensitivity
 from Fitter import Fitter
+from Wells import Wells
+from Noise import Noise
+# the classes of the other modes (Plate, Watcher, MultiStart, ...) are imported by their make_ methods,
+# so a run only imports the modules, and their dependencies, that it uses
 from config_schema import config_schema
 from Logger import setup_logger
 
+# least recently used assays and derived model code shared by the configurations loaded in this process,
+# e.g. by a batch worker, as (version, object) by key
+shared = OrderedDict()
+shared_size = 32 # objects kept, a batch worker may load many assays and models over a batch
+
+
+def load_shared(key, build, version=None):
+    """Returns the object stored under key, building and storing it on first use or when its version has changed
+
+    A new version, e.g. of a rewritten file, replaces the stored object rather than adding to it.
+    """
+    if key in shared and shared[key][0] == version:
+        shared.move_to_end(key)
+        return shared[key][1]
+    shared[key] = (version, build())
+    shared.move_to_end(key)
+    if len(shared) > shared_size:
+        shared.popitem(last=False) # evict the least recently used object
+    return shared[key][1]
+
+
 class Configurator:
     """
     Reads in config file and sets-up model fitting by instantiating an Assay, Model and Fitter class.
 
     Config file must be in yaml format, following the schema defined in config_schema.py.
     An example with comments describing each field is available at config_example.yaml.
+    Without p_fitter, the fitter is left to be made later, e.g. by the Watcher once enough
+    cycles of a growing assay file have been read. p_max_workers limits the worker processes
+    of every pool the configuration starts, e.g. to a batch worker's share of the cores.
     """
     
-    def __init__(self, p_config_path):
+    def __init__(self, p_config_path, p_fitter=True, p_max_workers=None):
         self.logger = setup_logger("config_logger")
+        self.max_workers = p_max_workers
         self.schema = config_schema
         self.config_path = p_config_path
         self.config = self.load_config()
         self.assay = self.make_assay()
+        self.wells = Wells(self.assay.ROWS, self.assay.COLS) # keeps the compiled well selections
         self.model = self.make_model()
-        self.fitter = self.make_fitter()
+        self.noise = self.make_noise()
+        self.fitter = self.make_fitter() if p_fitter else None
         self.logger.info("Configuration complete.")
 
     @property
@@ -40,6 +74,16 @@ class Configurator:
         else:
             self._config_path = value
 
+    def workers(self, value):
+        """Returns the number of worker processes for a configured workers value, where 0 uses all cores, within max_workers"""
+        workers = value if value > 0 else os.cpu_count()
+        return workers if self.max_workers is None else min(workers, self.max_workers)
+
+    def jacobian_workers(self):
+        """Returns the number of jacobian workers, 0 leaving the jacobian to lmfit"""
+        workers = self.config["fitter"]["jacobian_workers"]
+        return self.workers(workers) if workers > 0 else 0
+
     def load_config(self):
         """Loads the and validates the configuration file against the schema"""
 
@@ -47,8 +91,7 @@ class Configurator:
         with open(self.config_path, 'r') as f:
             config = yaml.safe_load(f) # parse yaml file contents into data structure
             try:
-                self.schema.validate(config) # validate the configuration file
-                return config
+                return self.schema.validate(config) # validate the configuration file, filling in defaults
             except SchemaError as exc: # raise any SchemaErrors
                 raise exc
     
@@ -60,26 +103,27 @@ class Configurator:
         file_path = assay_config["file_path"]
         cols = assay_config["cols"]
         rows = assay_config["rows"]
-        return Assay(file_path, cols, rows)
+        stat = os.stat(file_path) # a changed file is parsed again, replacing the stored assay
+        key = ("assay", os.path.abspath(file_path), cols, rows, assay_config["reader"])
+        return load_shared(key, lambda: Assay(file_path, cols, rows, assay_config["reader"], assay_config["cache"]),
+                           (stat.st_mtime_ns, stat.st_size))
 
-    def make_model(self):
-        """Instantiates the the Model class with the configuration data"""
+    def make_model(self, model_config=None):
+        """Instantiates the the Model class with the configuration data, of the model section unless another model block is given"""
 
         self.logger.info("Loading model.")
-        model_config = self.config["model"]
+        model_config = model_config if model_config is not None else self.config["model"]
         func_path = model_config["func_path"]
         
         # fetch ode function 
-        spec = importlib.util.spec_from_file_location("ODE", func_path) # create module to package function
-        module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(module)
-        ode_f = getattr(module, "ode_f") # retrieve function from module
+        ode_f = load_ode_f(func_path)
 
         # create lmfit parameter objects
         param_vals = model_config["parameters"]
         params = Parameters()
         for k, v in param_vals.items():
             params.add(name=k, value=v["init_guess"], min=v["min"], max=v["max"])
+            params[k].user_data = {"scale": v["scale"]}
         
         # load other configs
         y0 = tuple(model_config["y0"])
@@ -90,39 +134,173 @@ class Configurator:
         atol = integration_config["atol"]
         rtol = integration_config["rtol"]
         integration_method = integration_config["method"]
+        cache_size = integration_config["cache_size"]
 
-        return Model(ode_f, time, params, y0, max_val, atol, rtol, integration_method)
+        # code derived from the model is shared by configurations with the same model and parameter names
+        with open(func_path, 'r') as f:
+            key = (f.read(), tuple(params), len(y0))
+
+        kernel = None
+        if model_config["compile"]:
+            try:
+                kernel = load_shared(("kernel",) + key, lambda: Kernel(ode_f, list(params), len(y0), key[0]))
+            except Exception as exc: # sympy missing, or ode_f cannot be traced symbolically
+                self.logger.info("Could not compile model ({}), using ode_f directly.".format(exc))
+
+        jac = None
+        if integration_config["jacobian"] == "analytic":
+            if kernel is not None: # kernels carry their own jacobian, taking the same flat parameter array
+                jac = kernel.jac
+            else:
+                try:
+                    jac = load_shared(("jacobian",) + key, lambda: Jacobian(ode_f, list(params), len(y0)))
+                except Exception as exc:
+                    self.logger.info("Could not derive analytic jacobian ({}), using finite differences.".format(exc))
+
+        sensitivity = None
+        if self.config["fitter"]["sensitivity"]:
+            try:
+                sensitivity = load_shared(("sensitivity",) + key, lambda: Sensitivity(ode_f, list(params), len(y0)))
+            except Exception as exc:
+                self.logger.info("Could not derive sensitivity equations ({}), using finite differences.".format(exc))
+
+        return Model(ode_f, time, params, y0, max_val, atol, rtol, integration_method, jac, kernel, sensitivity, cache_size,
+                     integration_config["max_time"], integration_config["max_nfev"], integration_config["cache_memory"])
+
+    def parse_wells(self, well_coords):
+        """parses the well coordinate strings (e.g. C3 or C3:G4) from the configuration file, averaging the selected wells"""
+        return self.wells.average(self.assay.matrix, well_coords)
+
+    def make_noise(self):
+        """Instantiates the Noise class with the configuration data"""
+
+        noise_config = self.config["fitter"]["noise"]
+        return Noise(noise_config["model"], noise_config["window"], noise_config["value"])
+
+    def estimate_noise(self, data_wells, control_wells):
+        """Estimates the noise of the averaged data wells, reusing the estimate for the same assay and wells"""
+        key = (self.assay.content_hash(), tuple(data_wells), tuple(control_wells))
+        return self.noise.cached(key, lambda: (self.wells.gather(self.assay.matrix, data_wells),
+                                               self.wells.average(self.assay.matrix, control_wells)))
 
     def make_fitter(self):
         """Instantiates the the Fitter class with the configuration data"""
 
         self.logger.info("Loading data fitting configuration.")
-        letter_to_number = {letter: index for index, letter in enumerate(ascii_uppercase)}
-        def parse_wells(well_coords):
-            """parses the well coordinate strings (e.g. C3) from the configuration file"""
-            wells = np.empty((0, self.assay.cycles))
-            for well_str in well_coords:
-                well_str = well_str.upper()
-                if ":" in well_str: # if selection is a range (C3:G4)
-                    well_str = well_str.split(":")
-                    start_row = letter_to_number[well_str[0][0]]
-                    end_row = letter_to_number[well_str[1][0]]
-                    start_col = int(well_str[0][1])-1
-                    end_col = int(well_str[1][1])-1
-                    selection = self.assay.matrix[start_row:end_row+1, start_col:end_col+1]
-                    for w in selection:
-                        wells = np.vstack((wells, w))
-                else:
-                    row = letter_to_number[well_str[0]]
-                    col = int(well_str[1:])-1
-                    wells = np.vstack((wells, self.assay.matrix[row][col]))
-
-            if np.isnan(wells).any():
-                raise ValueError("One or more selected wells contains a nan value")
-            return np.sum(wells, axis=0)/len(wells) # average across well range and return values
-        
         fitter_config = self.config["fitter"]
-        y_data = parse_wells(fitter_config["data_wells"])
-        control_data = parse_wells(fitter_config["control_wells"])
+        y_data = self.parse_wells(fitter_config["data_wells"])
+        control_data = self.parse_wells(fitter_config["control_wells"])
+        noise = self.estimate_noise(fitter_config["data_wells"], fitter_config["control_wells"])
+
+        return Fitter(self.model, self.assay.time, y_data, control_data,
+                      self.jacobian_workers(), fitter_config["jacobian_executor"], noise)
+
+    def make_multistart(self):
+        """Instantiates the MultiStart class with the configuration data, or returns None if multi-start is not configured"""
+
+        multistart_config = self.config["fitter"].get("multistart")
+        if multistart_config is None:
+            return None
+        from MultiStart import MultiStart
+        return MultiStart(self.fitter, multistart_config["starts"], self.workers(multistart_config["workers"]), multistart_config["seed"],
+                          multistart_config["cancel_factor"], multistart_config["min_nfev"])
+
+    def make_uncertainty(self, result):
+        """Instantiates the Uncertainty class for the fit result with the configuration data, or returns None if it is not configured"""
+
+        uncertainty_config = self.config["fitter"].get("uncertainty")
+        if uncertainty_config is None:
+            return None
+        from Uncertainty import Uncertainty
+        return Uncertainty(self.fitter, result, uncertainty_config["bootstrap"], uncertainty_config["profile_points"],
+                           uncertainty_config["level"], self.workers(uncertainty_config["workers"]), uncertainty_config["seed"],
+                           uncertainty_config["span"])
+
+    def make_sampler(self, result):
+        """Instantiates the Sampler class for the fit result with the configuration data, or returns None if it is not configured"""
+
+        sampling_config = self.config["fitter"].get("sampling")
+        if sampling_config is None:
+            return None
+        from Sampler import Sampler
+        key = None
+        if sampling_config["chain"] is not None:
+            from Store import input_key
+            # the posterior depends on the data, model, integration and noise, not on the other modes or the sampling length
+            settings = {section: self.config[section] for section in ("assay", "model", "integration")}
+            settings["fitter"] = {name: value for name, value in self.config["fitter"].items()
+                                  if name not in ("multistart", "uncertainty", "sampling", "jacobian_workers", "jacobian_executor")}
+            settings["walkers"] = sampling_config["walkers"]
+            key = input_key(self, settings)
+        return Sampler(self.fitter, result, sampling_config["walkers"], sampling_config["steps"], sampling_config["burn"],
+                       sampling_config["thin"], sampling_config["check_interval"], sampling_config["tau_factor"],
+                       sampling_config["tau_rtol"], sampling_config["level"], self.workers(sampling_config["workers"]),
+                       sampling_config["seed"], sampling_config["chain"], key)
+
+    def make_store(self):
+        """Instantiates the Store class with the configuration data, or returns None if the results store is not configured"""
+
+        store_config = self.config.get("store")
+        if store_config is None:
+            return None
+        from Store import Store
+        return Store(store_config["path"], store_config["reuse"])
+
+    def make_plate(self):
+        """Instantiates the Plate class with the configuration data, for fitting each well separately"""
+        from Plate import Plate
+
+        self.logger.info("Loading plate fitting configuration.")
+        fitter_config = self.config["fitter"]
+        plate_config = self.config["plate"]
+        return Plate(self.assay, self.model, fitter_config["data_wells"], fitter_config["control_wells"],
+                     self.workers(plate_config["workers"]), plate_config["replicates"], self.noise)
+
+    def make_watcher(self, out_path):
+        """Instantiates the Watcher class with the configuration data, for refitting while the assay file grows"""
+        from Watcher import Watcher
+
+        self.logger.info("Loading watch configuration.")
+        watch_config = self.config["watch"]
+        return Watcher(self, out_path, watch_config["interval"], watch_config["tolerance"], watch_config["patience"],
+                       watch_config["min_cycles"], watch_config["timeout"])
+
+    def make_selection(self):
+        """Instantiates the Selection class with the configuration data, for fitting the model and the candidate models to the same data"""
+        from Selection import Selection
+
+        self.logger.info("Loading model selection configuration.")
+        if "selection" not in self.config:
+            raise ValueError("The configuration file has no selection section")
+        selection_config = self.config["selection"]
+        fitter_config = self.config["fitter"]
+        fitters, labels = [self.fitter], []
+        for model_config in [self.config["model"]] + selection_config["candidates"]:
+            label = model_config.get("label", os.path.splitext(os.path.basename(model_config["func_path"]))[0])
+            labels.append(label if label not in labels else "{} ({})".format(label, len(labels) + 1))
+        for model_config in selection_config["candidates"]:
+            # the candidates share the data, control and noise arrays prepared for the model section
+            fitters.append(Fitter(self.make_model(model_config), self.assay.time, self.fitter.y_data, self.fitter.control_data,
+                                  self.jacobian_workers(), fitter_config["jacobian_executor"], self.fitter.noise))
+        return Selection(fitters, labels, self.workers(selection_config["workers"]), selection_config["criterion"],
+                         selection_config["cancel_delta"], selection_config["min_nfev"])
+
+    def make_global_fitter(self):
+        """Instantiates the GlobalFitter class with the configuration data, for fitting several datasets at once"""
+        from GlobalFitter import GlobalFitter
 
-        return Fitter(self.model, self.assay.time, y_data, control_data)
\ No newline at end of file
+        self.logger.info("Loading global fitting configuration.")
+        if "global" not in self.config:
+            raise ValueError("The configuration file has no global section")
+        global_config = self.config["global"]
+        datasets = []
+        for i, dataset_config in enumerate(global_config["datasets"]):
+            datasets.append({
+                "label": dataset_config.get("label", str(i)),
+                "y_data": self.parse_wells(dataset_config["data_wells"]),
+                "control_data": self.parse_wells(dataset_config["control_wells"]),
+                "noise": self.estimate_noise(dataset_config["data_wells"], dataset_config["control_wells"]),
+                "y0": tuple(dataset_config.get("y0", self.model.y0)),
+                "max_val": dataset_config.get("max_value", self.model.max_val)
+            })
+        return GlobalFitter(self.model, self.assay.time, datasets, global_config["shared"])
@@ -1,13 +1,36 @@
+import copy
 import lmfit
 import numpy as np
-import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from Model import Model
+from Noise import Noise
+from Transform import log_names, to_internal, update_natural, scale_jacobian, to_natural
+from Profiler import profiler
 from Logger import setup_logger
 
+# per-process state of the jacobian workers, set up once by init_worker
+worker_state = {}
+
+
+def init_worker(p_fitter):
+    """Stores the worker's copy of the fitter, used to evaluate perturbed residuals"""
+    worker_state["fitter"] = p_fitter
+    worker_state["params"] = copy.deepcopy(p_fitter.model.params)
+
+
+def perturbed_residuals(values):
+    """Calculates the residuals for the given parameter values, in a worker process"""
+    params = worker_state["params"]
+    for name, value in values.items():
+        params[name].value = value
+    return worker_state["fitter"].residuals(params)
+
+
 class Fitter:
     """Peforms the model fitting against the data using the LMfit library"""
 
-    def __init__(self, p_model, p_time, p_y_data, p_control_data):
+    def __init__(self, p_model, p_time, p_y_data, p_control_data, p_jacobian_workers=0, p_jacobian_executor="process",
+                 p_noise=None):
         self.logger = setup_logger("fitter_logger")
         self.model = p_model
         self.time = p_time
@@ -15,8 +38,16 @@ class Fitter:
         self.control_data = p_control_data
         self.normalised_data = self.y_data / self.control_data
         self.noise_window = 20
-        self.noise = self.estimate_noise()
+        self.noise = p_noise if p_noise is not None else self.estimate_noise() # e.g. from a noise model of Noise
         self.mini = None
+        self.last_sensitivity = (None, None) # (parameter values, product sensitivities) of the last solve
+        self.log_names = [] # parameters optimised in log10 space during a fit
+        self.natural_params = None
+        self.jacobian_workers = p_jacobian_workers # 0 leaves the finite-difference jacobian to lmfit
+        self.jacobian_executor = p_jacobian_executor
+        self.fd_step = 1e-5 # relative step of the finite differences, as lmfit's default epsfcn of 1e-10
+        self.penalty = 10.0 # failed integrations score this many times worse than a zero solution
+        self.pool = None
 
         if np.array_equal(self.time, self.y_data):
             raise ValueError("time and y_data must be the same shape")
@@ -26,6 +57,10 @@ class Fitter:
     @property
     def model(self):
         return self._model
+
+    @property
+    def jacobian_executor(self):
+        return self._jacobian_executor
     
     @property
     def time(self):
@@ -39,6 +74,13 @@ class Fitter:
     def control_data(self):
         return self._control_data
 
+    @jacobian_executor.setter
+    def jacobian_executor(self, value):
+        if value not in ("process", "thread", "batch"):
+            raise ValueError("jacobian_executor must be 'process', 'thread' or 'batch'")
+        else:
+            self._jacobian_executor = value
+
     @model.setter
     def model(self, value):
         if not isinstance(value, Model):
@@ -75,29 +117,158 @@ class Fitter:
 
     def estimate_noise(self):
         """Estimates the noise of each data points with a rolling window"""
-        data = self.normalised_data
-        rolling_std = pd.Series(data).rolling(window=self.noise_window, min_periods=1).std().values
-        rolling_mean = pd.Series(data).rolling(window=self.noise_window, min_periods=1).mean().values
-        noise = np.abs(data - rolling_mean) / rolling_std
-        return noise
+        return Noise(p_window=self.noise_window).rolling(self.normalised_data[np.newaxis])[0]
     
     def residuals(self, params): # calc residuals
         """Integrates and calculates the residual between the IVP solution for the ODE model and the experimental data """
-        self.model.params = params
-        solution = self.model.integrate()
-        normalised_sol = solution.y[-1]/self.model.max_val # normalise solution against the maximum value of the product
+        with profiler.phase("residuals"):
+            self.model.params = params
+            if self.model.sensitivity is not None: # solve the sensitivities alongside, for the jacobian
+                solution = self.model.integrate_sensitivity()
+                self.last_sensitivity = (params.valuesdict(), solution.sensitivity)
+            else:
+                solution = self.model.integrate()
+            if not solution.success: # failed or out of budget, steer the optimiser away instead of stopping
+                return self.penalty_residuals()
+            normalised_sol = solution.y[-1]/self.model.max_val # normalise solution against the maximum value of the product
+            return (normalised_sol[1:] - self.normalised_data[1:]) / self.noise[1:]
+
+    def penalty_residuals(self):
+        """Returns the residuals given for a failed integration, penalty times those of a solution that is zero throughout"""
+        return np.nan_to_num(self.penalty*np.abs(self.normalised_data[1:] / self.noise[1:]))
+
+    def __getstate__(self):
+        # the minimizer and worker pool belong to the process running the fit
+        state = self.__dict__.copy()
+        state["mini"] = None
+        state["pool"] = None
+        return state
+
+    def jacobian(self, params):
+        """Calculates the jacobian of the residuals with respect to the varying parameters"""
+        with profiler.phase("jacobian"):
+            if self.model.sensitivity is not None:
+                return self.sensitivity_jacobian(params)
+            return self.fd_jacobian(params)
+
+    def fd_jacobian(self, params):
+        """Calculates the jacobian of the residuals by forward differences, solving the perturbed models concurrently
+
+        The unperturbed residuals come from the model's solution cache, since lmfit has just
+        evaluated them. Each perturbed parameter set is solved in the worker pool, or with the
+        batch executor all of them together with the unperturbed one, see batch_jacobian.
+        """
+        var_names = [name for name, param in params.items() if param.vary and not param.expr]
+        tasks, steps = [], []
+        for name in var_names:
+            value = params[name].value
+            step = self.fd_step*abs(value) if value != 0 else self.fd_step
+            if value + step > params[name].max: # step backwards at the upper bound
+                step = -step
+            values = params.valuesdict()
+            values[name] = value + step
+            tasks.append(values)
+            steps.append(step)
+        if self.jacobian_executor == "batch":
+            return self.batch_jacobian(params, tasks, steps)
+        base = self.residuals(params)
+        if self.jacobian_executor == "process":
+            columns = list(self.pool.map(perturbed_residuals, tasks))
+        else:
+            columns = list(self.pool.map(self.copy_residuals, tasks))
+        return np.column_stack([(column - base)/step for column, step in zip(columns, steps)])
+
+    def batch_jacobian(self, params, tasks, steps):
+        """Calculates the forward differences from one stacked solve of the unperturbed and perturbed parameter sets
+
+        All copies of the model share the solver's steps, so the differences are not disturbed by
+        each solve choosing its own steps, and the solver overhead is paid once per jacobian.
+        """
+        names = list(self.model.params)
+        rows = [params.valuesdict()] + tasks
+        curves = self.model.integrate_batch(np.array([[values[name] for name in names] for values in rows]))
+        residuals = [self.penalty_residuals() if np.isnan(curve).any() else
+                     (curve[1:] - self.normalised_data[1:])/self.noise[1:] for curve in curves]
+        return np.column_stack([(column - residuals[0])/step for column, step in zip(residuals[1:], steps)])
+
+    def copy_residuals(self, values):
+        """Calculates the residuals for the given parameter values with a copy of the model, so threads do not share state"""
+        fitter = copy.copy(self)
+        fitter.model = copy.copy(self.model)
+        fitter.model.clear_cache() # the shared cache is not thread safe
+        params = copy.deepcopy(self.model.params)
+        for name, value in values.items():
+            params[name].value = value
+        return fitter.residuals(params)
+
+    def sensitivity_jacobian(self, params):
+        """Calculates the jacobian of the residuals with respect to the varying parameters from the forward sensitivities
+
+        lmfit evaluates the jacobian at the parameters of the preceding residual call, so the
+        sensitivities solved alongside that call are reused rather than solving again.
+        """
+        values, sensitivity = self.last_sensitivity
+        if values != params.valuesdict():
+            self.model.params = params
+            sensitivity = self.model.integrate_sensitivity().sensitivity
+            self.last_sensitivity = (params.valuesdict(), sensitivity)
+        var_names = [name for name, param in params.items() if param.vary and not param.expr]
+        if sensitivity.shape[1] != len(self.normalised_data): # failed integration, the penalty is constant
+            return np.zeros((len(self.normalised_data) - 1, len(var_names)))
+        cols = [self.model.sensitivity.param_names.index(name) for name in var_names]
+        jac = sensitivity[cols, 1:].T / self.model.max_val
+        return jac / self.noise[1:, np.newaxis]
+
+    def internal_residuals(self, params):
+        """Calculates the residuals for parameters with the log scaled ones in log10 space"""
+        return self.residuals(update_natural(self.natural_params, params, self.log_names))
+
+    def internal_jacobian(self, params):
+        """Calculates the jacobian of the residuals for parameters with the log scaled ones in log10 space"""
+        natural = update_natural(self.natural_params, params, self.log_names)
+        var_names = [name for name, param in params.items() if param.vary and not param.expr]
+        return scale_jacobian(self.jacobian(natural), natural, var_names, self.log_names)
 
-        if len(normalised_sol) != len(self.normalised_data):
-               print(solution.message)
-               exit(0)
-        return (normalised_sol[1:] - self.normalised_data[1:]) / self.noise[1:]
+    def fit(self, iter_cb=None):
+        ''' Fits the model against the data using LMfit's minimise function
 
-    def fit(self):
-        ''' Fits the model against the data using LMfit's minimise function'''
+        Parameters configured with scale: log are optimised in log10 space, the result is reported in natural units.
+        The number of failed integrations and the time spent in them are reported as
+        result.integration_failures and result.failure_time.
+        iter_cb is passed on to lmfit, it is called after each iteration and can abort the fit by returning True.
+        '''
         self.logger.info("Fitting Model.")
-        self.mini = lmfit.Minimizer(self.residuals, self.model.params)
-        result = self.mini.minimize()
+        failures, failure_time = self.model.failures, self.model.failure_time
+        self.log_names = log_names(self.model.params)
+        self.natural_params = copy.deepcopy(self.model.params)
+        params = to_internal(self.model.params, self.log_names)
+        self.mini = lmfit.Minimizer(self.internal_residuals, params, iter_cb=iter_cb)
+        with profiler.phase("fit"):
+            if self.model.sensitivity is not None: # exact jacobian from the sensitivity equations
+                result = self.mini.minimize(Dfun=self.internal_jacobian)
+            elif self.jacobian_executor == "batch": # finite-difference jacobian from one stacked solve
+                result = self.mini.minimize(Dfun=self.internal_jacobian)
+            elif self.jacobian_workers > 0: # finite-difference jacobian with the perturbed solves run concurrently
+                if self.jacobian_executor == "process":
+                    pool = ProcessPoolExecutor(max_workers=self.jacobian_workers, initializer=init_worker, initargs=(self,))
+                else:
+                    pool = ThreadPoolExecutor(max_workers=self.jacobian_workers)
+                self.pool = pool
+                try:
+                    result = self.mini.minimize(Dfun=self.internal_jacobian)
+                finally:
+                    self.pool = None
+                    pool.shutdown()
+            else:
+                result = self.mini.minimize()
+        result = to_natural(result, self.natural_params, self.log_names)
         if not result.errorbars: # check if parameter errors were succesfully calculated
             self.logger.info("Fit suceeded, but failed to estimate errors.")
+        self.logger.info("Solution cache: {} hits, {} misses.".format(self.model.cache_hits, self.model.cache_misses))
+        # failures of the integrations run in this process, solves in jacobian worker processes are not counted
+        result.integration_failures = self.model.failures - failures
+        result.failure_time = self.model.failure_time - failure_time
+        if result.integration_failures:
+            self.logger.info("{} integrations failed, taking {:.2f} s.".format(result.integration_failures, result.failure_time))
         self.model.params = result.params
         return result
\ No newline at end of file
@@ -0,0 +1,154 @@
+import copy
+import lmfit
+import numpy as np
+import pandas as pd
+from scipy.sparse import lil_matrix
+from lmfit import Parameters
+from Model import Model
+from Fitter import Fitter
+from Transform import log_names, to_internal, update_natural, to_natural
+from Logger import setup_logger
+
+
+class GlobalFitter:
+    """Fits the model against several datasets at once, with parameters shared between datasets or local to each
+
+    Each dataset is a dict with the keys label, y_data, control_data, y0 and max_val, and
+    optionally noise, otherwise the noise is estimated with the rolling model. Shared
+    parameters keep their name, local parameters get one copy per dataset named name_i. The
+    residuals of all datasets are stacked into one least-squares problem, and since the
+    residuals of a dataset only depend on the shared and its own local parameters, the sparsity
+    pattern of the jacobian is passed to scipy's least_squares. Finite differences then need one
+    evaluation per shared parameter plus one per local parameter name, however many datasets
+    there are.
+    """
+
+    def __init__(self, p_model, p_time, p_datasets, p_shared):
+        self.logger = setup_logger("global_fitter_logger")
+        self.model = p_model
+        self.time = p_time
+        self.shared = list(p_shared)
+        self.labels = [dataset["label"] for dataset in p_datasets]
+        unknown = set(self.shared) - set(self.model.params)
+        if unknown:
+            raise ValueError("shared parameters {} are not model parameters".format(sorted(unknown)))
+        self.local = [name for name in self.model.params if name not in self.shared]
+        self.fitters = [self.make_fitter(dataset) for dataset in p_datasets]
+        self.params = self.make_params()
+        self.mini = None
+        self.log_names = [] # parameters optimised in log10 space during a fit
+        self.natural_params = None
+
+    @property
+    def model(self):
+        return self._model
+
+    @property
+    def time(self):
+        return self._time
+
+    @model.setter
+    def model(self, value):
+        if not isinstance(value, Model):
+            raise ValueError("model must be instance of Model class")
+        else:
+            self._model = value
+
+    @time.setter
+    def time(self, value):
+        if not isinstance(value, np.ndarray):
+            raise ValueError("time must be of type np.ndarray")
+        elif value.ndim != 1:
+            raise ValueError("time array must be 1 dimensional")
+        else:
+            self._time = value
+
+    def make_fitter(self, dataset):
+        """Creates a Fitter for one dataset, with its own copy of the model"""
+        model = copy.copy(self.model) # shares the ode function and solution cache, which is keyed on y0
+        model.params = copy.deepcopy(self.model.params)
+        model.y0 = tuple(dataset["y0"])
+        model.max_val = dataset["max_val"]
+        return Fitter(model, self.time, dataset["y_data"], dataset["control_data"], p_noise=dataset.get("noise"))
+
+    def global_name(self, name, i):
+        """Returns the name of a model parameter in the global parameters, for the i-th dataset"""
+        return name if name in self.shared else "{}_{}".format(name, i)
+
+    def make_params(self):
+        """Creates the global parameters, one for each shared parameter and one per dataset for each local parameter"""
+        params = Parameters()
+        for name in self.shared:
+            params.add(copy.deepcopy(self.model.params[name]))
+        for i in range(len(self.fitters)):
+            for name in self.local:
+                param = copy.deepcopy(self.model.params[name])
+                param.name = self.global_name(name, i)
+                params.add(param)
+        return params
+
+    def dataset_params(self, params, i):
+        """Copies the global parameter values into the model parameters of the i-th dataset"""
+        model_params = self.fitters[i].model.params
+        for name in model_params:
+            model_params[name].value = params[self.global_name(name, i)].value
+        return model_params
+
+    def residuals(self, params):
+        """Stacks the residuals of all datasets"""
+        return np.concatenate([fitter.residuals(self.dataset_params(params, i))
+                               for i, fitter in enumerate(self.fitters)])
+
+    def internal_residuals(self, params):
+        """Stacks the residuals of all datasets for parameters with the log scaled ones in log10 space"""
+        return self.residuals(update_natural(self.natural_params, params, self.log_names))
+
+    def jac_sparsity(self):
+        """Returns the sparsity pattern of the jacobian of the stacked residuals"""
+        var_names = [name for name, param in self.params.items() if param.vary and not param.expr]
+        sizes = [len(fitter.normalised_data) - 1 for fitter in self.fitters] # residuals skip the first point
+        sparsity = lil_matrix((sum(sizes), len(var_names)), dtype=int)
+        start = 0
+        for i, size in enumerate(sizes):
+            for name in self.fitters[i].model.params:
+                global_name = self.global_name(name, i)
+                if global_name in var_names:
+                    sparsity[start:start+size, var_names.index(global_name)] = 1
+            start += size
+        return sparsity
+
+    def fit(self):
+        """Fits the model against all datasets using lmfit's least_squares method with the jacobian sparsity pattern"""
+        self.logger.info("Fitting model globally against {} datasets.".format(len(self.fitters)))
+        self.log_names = log_names(self.params)
+        self.natural_params = copy.deepcopy(self.params)
+        failures = sum(fitter.model.failures for fitter in self.fitters)
+        failure_time = sum(fitter.model.failure_time for fitter in self.fitters)
+        self.mini = lmfit.Minimizer(self.internal_residuals, to_internal(self.params, self.log_names))
+        result = self.mini.minimize(method="least_squares", jac_sparsity=self.jac_sparsity())
+        result = to_natural(result, self.natural_params, self.log_names)
+        if not result.errorbars:
+            self.logger.info("Fit suceeded, but failed to estimate errors.")
+        result.integration_failures = sum(fitter.model.failures for fitter in self.fitters) - failures
+        result.failure_time = sum(fitter.model.failure_time for fitter in self.fitters) - failure_time
+        if result.integration_failures:
+            self.logger.info("{} integrations failed, taking {:.2f} s.".format(result.integration_failures, result.failure_time))
+        self.params = result.params
+        for i in range(len(self.fitters)):
+            self.dataset_params(result.params, i)
+        return result
+
+    def param_table(self, result):
+        """Returns a table of the fitted parameter values and stderr for each dataset"""
+        rows = []
+        for i, label in enumerate(self.labels):
+            row = {"dataset": label}
+            for name in self.model.params:
+                param = result.params[self.global_name(name, i)]
+                row[name] = param.value
+                row[name + "_stderr"] = param.stderr
+            rows.append(row)
+        table = pd.DataFrame(rows).set_index("dataset")
+        for stat in ("chisqr", "redchi", "aic", "bic", "nfev", "integration_failures", "failure_time"):
+            table[stat] = getattr(result, stat) # statistics of the global fit, the same for every dataset
+        return table
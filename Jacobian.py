@@ -0,0 +1,100 @@
+import numpy as np
+
+
+def trace(ode_f, param_names, n_states):
+    """Calls the ODE function with sympy symbols in place of the state and parameter values
+
+    Returns the time symbol, state symbols, parameter symbols and the symbolic right-hand side.
+    Raises an ImportError if sympy is not installed, and whatever the ODE function raises if
+    it cannot operate on symbols (e.g. calls to math or numpy functions).
+    """
+    import sympy # optional dependency, only needed for the analytic modes
+
+    t = sympy.Symbol("t")
+    y = sympy.symbols("y0:{}".format(n_states))
+    p = sympy.symbols("p0:{}".format(len(param_names)))
+    rhs = ode_f(t, list(y), dict(zip(param_names, p)))
+    rhs = [sympy.sympify(expr) for expr in rhs]
+    if len(rhs) != n_states:
+        raise ValueError("ode_f returned {} derivatives for {} dependant variables".format(len(rhs), n_states))
+    return t, y, p, rhs
+
+
+def array_source(func_name, shape, entries, y, p):
+    """Writes the source of a python function filling an array from sympy expressions
+
+    entries is a list of (index, expression) pairs, zero expressions are skipped and common
+    subexpressions are eliminated. The generated function takes the arguments (t, y, p), where
+    y and p are the flat state and parameter arrays, unpacked into floats since plain float
+    arithmetic is much faster than numpy on scalars.
+    """
+    import sympy
+    from sympy.printing.numpy import NumPyPrinter
+
+    printer = NumPyPrinter()
+    entries = [(idx, expr) for idx, expr in entries if expr != 0]
+    subs, reduced = sympy.cse([expr for _, expr in entries], symbols=sympy.numbered_symbols("x"))
+    lines = ["def {}(t, y, p):".format(func_name)]
+    if len(y):
+        lines.append("    {}, = numpy.ravel(y).tolist()".format(", ".join(str(s) for s in y)))
+    if len(p):
+        lines.append("    {}, = numpy.ravel(p).tolist()".format(", ".join(str(s) for s in p)))
+    for sym, expr in subs:
+        lines.append("    {} = {}".format(sym, printer.doprint(expr)))
+    lines.append("    out = numpy.zeros({})".format(shape))
+    for (idx, _), expr in zip(entries, reduced):
+        lines.append("    out[{}] = {}".format(", ".join(str(i) for i in idx), printer.doprint(expr)))
+    lines.append("    return out")
+    return "\n".join(lines) + "\n"
+
+
+def compile_source(func_name, source):
+    """Compiles generated source, returning the named function"""
+    namespace = {"numpy": np}
+    exec(compile(source, "<{}>".format(func_name), "exec"), namespace)
+    return namespace[func_name]
+
+
+class Jacobian:
+    """Analytic Jacobian of an ODE function with respect to the dependant variables
+
+    The Jacobian is derived by tracing the ODE function with sympy symbols, differentiating the
+    result and generating a numpy function from it. Instances are callable with the same
+    signature as the ODE function, (t, y, params), and can be passed to solve_ivp as jac.
+    """
+
+    def __init__(self, p_ode_f, p_param_names, p_n_states):
+        self.param_names = list(p_param_names)
+        self.n_states = p_n_states
+        self.source = self.generate(p_ode_f)
+
+    @property
+    def source(self):
+        return self._source
+
+    @source.setter
+    def source(self, value):
+        if not isinstance(value, str):
+            raise ValueError("source must be of type string")
+        else:
+            self._source = value
+            self._jac = compile_source("jac", value)
+
+    def generate(self, ode_f):
+        """Traces the ODE function and returns the source of its Jacobian function"""
+        t, y, p, rhs = trace(ode_f, self.param_names, self.n_states)
+        entries = [((i, j), rhs[i].diff(y[j])) for i in range(self.n_states) for j in range(self.n_states)]
+        return array_source("jac", (self.n_states, self.n_states), entries, y, p)
+
+    def __call__(self, t, y, params):
+        return self._jac(t, y, [params[name] for name in self.param_names])
+
+    def __getstate__(self):
+        # the compiled function cannot be pickled, it is rebuilt from the source
+        state = self.__dict__.copy()
+        del state["_jac"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._jac = compile_source("jac", self._source)
@@ -0,0 +1,121 @@
+import os
+import hashlib
+import numpy as np
+from Jacobian import trace, array_source, compile_source
+
+script_path = os.path.dirname(os.path.abspath(__file__))
+cache_dir = os.path.join(script_path, 'cache', 'kernels')
+version = "1" # bump when the generated code changes, invalidating cached kernels
+
+
+class Kernel:
+    """Compiled right-hand side and jacobian of an ODE function
+
+    The ODE function is traced with sympy symbols, common subexpressions are eliminated, and
+    numpy functions rhs(t, y, p) and jac(t, y, p) are generated, where p is a flat array of the
+    parameter values in the order of param_names. rhs accepts y with shape (n,) or (n, k) so it
+    can be used with solve_ivp(vectorized=True).
+
+    The generated source is cached on disk, keyed by a hash of the model source, so later runs
+    skip tracing and code generation.
+    """
+
+    def __init__(self, p_ode_f, p_param_names, p_n_states, p_model_source):
+        self.param_names = list(p_param_names)
+        self.n_states = p_n_states
+        key = "\n".join([version, p_model_source, ",".join(self.param_names), str(self.n_states)])
+        self.hash = hashlib.sha256(key.encode()).hexdigest()
+        self.path = os.path.join(cache_dir, "{}.py".format(self.hash))
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.source = f.read()
+        else:
+            self.source = self.generate(p_ode_f)
+            self.save()
+
+    @property
+    def source(self):
+        return self._source
+
+    @source.setter
+    def source(self, value):
+        if not isinstance(value, str):
+            raise ValueError("source must be of type string")
+        else:
+            self._source = value
+            self._compile()
+
+    def _compile(self):
+        self._rhs = compile_source("rhs", self._source)
+        self._jac = compile_source("jac", self._source)
+
+    def rhs(self, t, y, p):
+        return self._rhs(t, y, p)
+
+    def jac(self, t, y, p):
+        return self._jac(t, y, p)
+
+    def generate(self, ode_f):
+        """Traces the ODE function and returns the source of the rhs and jac functions"""
+        import sympy
+        from sympy.printing.numpy import NumPyPrinter
+
+        t, y, p, rhs = trace(ode_f, self.param_names, self.n_states)
+        printer = NumPyPrinter()
+
+        def unpack(lines, indent, y_source, p_source):
+            lines.append("{}{}, = {}".format(indent, ", ".join(str(s) for s in y), y_source))
+            if len(p):
+                lines.append("{}{}, = {}".format(indent, ", ".join(str(s) for s in p), p_source))
+
+        def assign(lines, indent, exprs):
+            """appends the common subexpressions to lines, returning the reduced expressions"""
+            subs, reduced = sympy.cse(exprs, symbols=sympy.numbered_symbols("x"))
+            for sym, expr in subs:
+                lines.append("{}{} = {}".format(indent, sym, printer.doprint(expr)))
+            return reduced
+
+        n = self.n_states
+        # a single state vector is evaluated with plain float arithmetic, which is much faster than
+        # numpy on scalars; several state vectors (vectorized=True) are evaluated on whole rows
+        lines = ["def rhs(t, y, p):",
+                 "    if numpy.ndim(y) == 1 or numpy.shape(y)[1] == 1:"]
+        unpack(lines, "        ", "numpy.ravel(y).tolist()", "numpy.ravel(p).tolist()")
+        reduced = assign(lines, "        ", rhs)
+        lines.append("        return numpy.array([{}]).reshape(numpy.shape(y))".format(
+            ", ".join(printer.doprint(expr) for expr in reduced)))
+        unpack(lines, "    ", "y", "p")
+        nonzero = [(i, expr) for i, expr in enumerate(rhs) if expr != 0]
+        reduced = assign(lines, "    ", [expr for _, expr in nonzero])
+        lines.append("    out = numpy.zeros(({},) + numpy.shape(y0))".format(n))
+        for (i, _), expr in zip(nonzero, reduced):
+            lines.append("    out[{}] = {}".format(i, printer.doprint(expr)))
+        lines.append("    return out")
+        rhs_source = "\n".join(lines) + "\n"
+
+        entries = [((i, j), rhs[i].diff(y[j])) for i in range(n) for j in range(n)]
+        jac_source = array_source("jac", (n, n), entries, y, p)
+        return rhs_source + "\n\n" + jac_source
+
+    def save(self):
+        """Writes the generated source to the kernel cache"""
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(self.source)
+        os.replace(tmp_path, self.path) # atomic, so concurrent runs never read a partial kernel
+
+    def pack(self, params):
+        """Packs lmfit Parameters into the flat parameter array taken by the kernel"""
+        return np.array([params[name].value for name in self.param_names], dtype=float)
+
+    def __getstate__(self):
+        # the compiled functions cannot be pickled, they are rebuilt from the source
+        state = self.__dict__.copy()
+        del state["_rhs"]
+        del state["_jac"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._compile()
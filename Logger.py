@@ -5,6 +5,8 @@ def setup_logger(logger_name):
     """ Sets up a logger"""
     logger =logging.getLogger(logger_name)
     logger.setLevel("INFO")
+    if logger.handlers: # already set up, e.g. by an earlier instance of the same class
+        return logger
     format = logging.Formatter('%(message)s')
     handler = logging.StreamHandler()
     handler.setFormatter(format)
@@ -1,14 +1,84 @@
 
+import time
 import numpy as np
+import importlib.util
+from collections import OrderedDict
 from scipy.integrate import solve_ivp
+from scipy.optimize import OptimizeResult
+from scipy.sparse import kron, identity
 from lmfit import Parameters
+from Kernel import Kernel
+from Sensitivity import Sensitivity
+from Profiler import profiler
 from Logger import setup_logger
 
+loaded_ode_fs = {} # ode functions loaded in this process, by file path
+
+
+def load_ode_f(func_path):
+    """Loads the ode_f function from a python file
+
+    The function remembers the path it was loaded from, so models using it can be pickled
+    (e.g. sent to worker processes), and reloads it there from the file.
+    """
+    if func_path not in loaded_ode_fs:
+        spec = importlib.util.spec_from_file_location("ODE", func_path) # create module to package function
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        ode_f = getattr(module, "ode_f") # retrieve function from module
+        ode_f.func_path = func_path
+        loaded_ode_fs[func_path] = ode_f
+    return loaded_ode_fs[func_path]
+
+
+def solution_nbytes(sol):
+    """Returns the memory held by the arrays of a solution, in bytes"""
+    arrays = (sol.get("t"), sol.get("y"), sol.get("sensitivity"))
+    return sum(array.nbytes for array in arrays if isinstance(array, np.ndarray))
+
+
+class BudgetExceeded(Exception):
+    """Raised when an integration runs past its wall-clock or function evaluation budget"""
+
+
+class Budget:
+    """Wraps the right-hand side of an ODE, raising BudgetExceeded once the integration runs past
+    max_time seconds or max_nfev evaluations, either of which may be None for no limit"""
+
+    def __init__(self, p_fun, p_max_time, p_max_nfev):
+        self.fun = p_fun
+        self.max_time = p_max_time
+        self.max_nfev = p_max_nfev
+        self.nfev = 0
+        self.start = time.perf_counter()
+
+    def __call__(self, t, y, *args):
+        self.nfev += 1
+        if self.max_nfev is not None and self.nfev > self.max_nfev:
+            raise BudgetExceeded("Integration exceeded {} function evaluations.".format(self.max_nfev))
+        if self.max_time is not None and time.perf_counter() - self.start > self.max_time:
+            raise BudgetExceeded("Integration exceeded {} s.".format(self.max_time))
+        return self.fun(t, y, *args)
+
+
 class Model:
-    """Stores information parameters and current parameter values, provides solutions to the ODE integration"""
+    """Stores information parameters and current parameter values, provides solutions to the ODE integration
+
+    Each integration can be given a wall-clock budget of max_time seconds and a budget of
+    max_nfev ODE function evaluations. An integration that fails or runs out of budget
+    returns an unsuccessful solution, and is counted in failures and failure_time.
+    The solution cache holds at most cache_size solutions and cache_memory megabytes.
+    """
 
-    def __init__(self, p_ode_f, p_time, p_params, p_y0, p_max_val, p_atol, p_rtol, p_integration_method):
+    def __init__(self, p_ode_f, p_time, p_params, p_y0, p_max_val, p_atol, p_rtol, p_integration_method, p_jac=None, p_kernel=None, p_sensitivity=None, p_cache_size=128,
+                 p_max_time=None, p_max_nfev=None, p_cache_memory=64.0):
         self.logger = setup_logger("model_logger")
+        self.cache = OrderedDict() # least recently used solutions, keyed by parameter values and solver settings
+        self.cache_bytes = 0 # memory held by the cached solutions
+        self.cache_size = p_cache_size
+        self.cache_memory = p_cache_memory
+        self.cache_hits = 0
+        self.cache_misses = 0
         self.ode_f = p_ode_f
         self.time = p_time
         self.params = p_params
@@ -17,7 +87,15 @@ class Model:
         self.atol = p_atol
         self.rtol = p_rtol
         self.allowed_methods = ['RK23', 'RK45', 'DOP853', 'Radau', 'BDF', 'LSODA']
+        self.implicit_methods = ['Radau', 'BDF', 'LSODA'] # methods that make use of the jacobian
         self.integration_method = p_integration_method
+        self.jac = p_jac
+        self.kernel = p_kernel
+        self.sensitivity = p_sensitivity
+        self.max_time = p_max_time
+        self.max_nfev = p_max_nfev
+        self.failures = 0 # failed integrations, including those out of budget
+        self.failure_time = 0.0 # seconds spent in failed integrations
         
     @property
     def ode_f(self):
@@ -50,6 +128,26 @@ class Model:
     @property
     def integration_method(self):
         return self._integration_method
+
+    @property
+    def jac(self):
+        return self._jac
+
+    @property
+    def kernel(self):
+        return self._kernel
+
+    @property
+    def sensitivity(self):
+        return self._sensitivity
+
+    @property
+    def cache_size(self):
+        return self._cache_size
+
+    @property
+    def cache_memory(self):
+        return self._cache_memory
     
     @ode_f.setter
     def ode_f(self, f):
@@ -66,6 +164,7 @@ class Model:
             raise ValueError("time array must be 1 dimensional")
         else:
             self._time = value
+            self.clear_cache() # cached solutions are only valid for the time points they were solved at
     
     @params.setter
     def params(self, value):
@@ -112,22 +211,253 @@ class Model:
         else:
             self._integration_method = value
 
+    @jac.setter
+    def jac(self, f):
+        if not (f is None or callable(f)):
+            raise ValueError("jac must be a function or None")
+        else:
+            self._jac = f
+
+    @kernel.setter
+    def kernel(self, value):
+        if not (value is None or isinstance(value, Kernel)):
+            raise ValueError("kernel must be instance of Kernel class or None")
+        else:
+            self._kernel = value
+
+    @sensitivity.setter
+    def sensitivity(self, value):
+        if not (value is None or isinstance(value, Sensitivity)):
+            raise ValueError("sensitivity must be instance of Sensitivity class or None")
+        else:
+            self._sensitivity = value
+
+    @cache_size.setter
+    def cache_size(self, value):
+        if not isinstance(value, int) or value < 0:
+            raise ValueError("cache_size must be a non-negative int")
+        else:
+            self._cache_size = value
+            self.evict()
+
+    @cache_memory.setter
+    def cache_memory(self, value):
+        if not isinstance(value, (int, float)) or value < 0:
+            raise ValueError("cache_memory must be a non-negative number of megabytes")
+        else:
+            self._cache_memory = value
+            self.evict()
+
+    def __getstate__(self):
+        # functions loaded from a file cannot be pickled, they are reloaded from their path instead
+        state = self.__dict__.copy()
+        if hasattr(self._ode_f, "func_path"):
+            state["_ode_f"] = self._ode_f.func_path
+        state["cache"] = OrderedDict() # solutions are not worth sending between processes
+        state["cache_bytes"] = 0
+        return state
+
+    def __setstate__(self, state):
+        if isinstance(state["_ode_f"], str):
+            state["_ode_f"] = load_ode_f(state["_ode_f"])
+        self.__dict__.update(state)
+
+    def cache_key(self, mode):
+        """Returns the solution cache key for the current parameter values and solver settings"""
+        values = tuple(param.value for param in self.params.values())
+        return (mode, values, self.y0, self.atol, self.rtol, self.integration_method)
+
+    def cached(self, mode, solve):
+        """Returns the cached solution for the current parameters, calling solve and caching its result on a miss
+
+        Unsuccessful solutions are not cached, a solve that ran out of its time budget may succeed when retried.
+        """
+        key = self.cache_key(mode)
+        if key in self.cache:
+            self.cache_hits += 1
+            profiler.count("cache hits")
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        self.cache_misses += 1
+        profiler.count("cache misses")
+        sol = solve()
+        nbytes = solution_nbytes(sol)
+        if sol.success and self.cache_size > 0 and nbytes <= self.cache_memory*1e6:
+            self.cache[key] = sol
+            self.cache_bytes += nbytes
+            self.evict()
+        return sol
+
+    def clear_cache(self):
+        """Removes every cached solution"""
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+
+    def evict(self):
+        """Evicts the least recently used solutions until the cache is within cache_size and cache_memory"""
+        if not hasattr(self, "_cache_memory"): # during __init__, before both limits are set
+            return
+        while self.cache and (len(self.cache) > self.cache_size or self.cache_bytes > self.cache_memory*1e6):
+            _, sol = self.cache.popitem(last=False)
+            self.cache_bytes -= solution_nbytes(sol)
+
     def integrate(self):
-        """Solves the intital value problem for the ODE model and current parameter values with Scipy"""
-        current_params = {}
-        for p in self.params:
-            current_params[p] = self.params[p].value
-        sol = solve_ivp(fun=self.ode_f, 
-                        args=(current_params,),
-                        y0 = self.y0,
-                        t_span=(self.time[0], self.time[-1]), 
-                        t_eval=self.time, 
-                        method=self.integration_method,
-                        atol=self.atol, 
-                        rtol=self.rtol,
-                        dense_output=True)
+        """Solves the intital value problem for the ODE model and current parameter values with Scipy
+
+        Solutions are cached, so repeated calls with the same parameters do not solve again.
+        """
+        return self.cached("solution", self.solve)
+
+    def solve(self):
+        """Solves the intital value problem without the solution cache"""
+        if self.kernel is not None: # compiled kernels take the parameters as a flat array
+            fun = self.kernel.rhs
+            current_params = self.kernel.pack(self.params)
+        else:
+            fun = self.ode_f
+            current_params = {}
+            for p in self.params:
+                current_params[p] = self.params[p].value
+        # without a jacobian the implicit methods estimate it by finite differences
+        jac = self.jac if self.integration_method in self.implicit_methods else None
+        sol = self.run_solver(fun=fun,
+                              jac=jac,
+                              vectorized=self.kernel is not None,
+                              args=(current_params,),
+                              y0 = self.y0,
+                              t_span=(self.time[0], self.time[-1]),
+                              t_eval=self.time,
+                              method=self.integration_method,
+                              atol=self.atol,
+                              rtol=self.rtol)
         return sol
 
+    def integrate_sensitivity(self):
+        """Solves the intital value problem for the ODE model together with its forward sensitivity equations
+
+        The returned solution holds the sensitivities of the product to each parameter as
+        sol.sensitivity, with shape (n_params, len(time)) in the order of sensitivity.param_names.
+        """
+        return self.cached("sensitivity", self.solve_sensitivity)
+
+    def solve_sensitivity(self):
+        """Solves the ODE model and its forward sensitivity equations without the solution cache"""
+        sol = self.run_solver(fun=self.sensitivity.rhs,
+                              jac=self.sensitivity.jac,
+                              args=(self.sensitivity.pack(self.params),),
+                              y0=self.sensitivity.z0(self.y0),
+                              t_span=(self.time[0], self.time[-1]),
+                              t_eval=self.time,
+                              method=self.integration_method,
+                              atol=self.atol,
+                              rtol=self.rtol)
+        if not sol.success: # nothing to split, the fitter penalises the failed solution
+            sol.y = np.zeros((len(self.y0), 0))
+            sol.sensitivity = np.zeros((self.sensitivity.n_params, 0))
+            return sol
+        sol.y, sensitivities = self.sensitivity.split(sol.y)
+        sol.sensitivity = sensitivities[-1]
+        return sol
+
+    def run_solver(self, fun, **kwargs):
+        """Runs solve_ivp within the integration budget, counting failed integrations and the time spent in them
+
+        A solution that does not reach the end of the time span, or that is not finite, is marked as unsuccessful.
+        Each call is recorded with its solver statistics (nfev, njev, nlu) by the profiler.
+        """
+        begin = time.perf_counter()
+        if self.max_time is not None or self.max_nfev is not None:
+            fun = Budget(fun, self.max_time, self.max_nfev)
+        try:
+            sol = solve_ivp(fun=fun, **kwargs)
+        except BudgetExceeded as exc:
+            sol = OptimizeResult(t=np.zeros(0), y=np.zeros((len(kwargs["y0"]), 0)), status=-1, message=str(exc),
+                                 success=False, nfev=fun.nfev)
+        if sol.success and (sol.y.shape[1] != len(kwargs["t_eval"]) or not np.isfinite(sol.y).all()):
+            sol.success = False
+            sol.message = "Integration returned an incomplete or non-finite solution."
+        if not sol.success:
+            self.failures += 1
+            self.failure_time += time.perf_counter() - begin
+        profiler.solver(sol, begin, time.perf_counter() - begin)
+        return sol
+
+    def batch_rhs(self, param_matrix):
+        """Returns the right-hand side of K stacked copies of the system, for a (K, n_params) parameter matrix
+
+        The stacked state is ordered state-major, z[i*K + k] is state i of copy k, so that
+        reshaping it to (n_states, K) gives the rows the kernel, or a vectorized ode_f, expects.
+        """
+        n, K = len(self.y0), len(param_matrix)
+        names = list(self.params)
+        if self.kernel is not None:
+            p = param_matrix[:, [names.index(name) for name in self.kernel.param_names]].T # (n_params, K)
+
+            def rhs(t, z):
+                cols = z.shape[1] if z.ndim == 2 else 1 # vectorized calls evaluate several stacked states
+                y = z.reshape(n, K, cols).reshape(n, K*cols)
+                return self.kernel.rhs(t, y, np.repeat(p, cols, axis=1)).reshape(z.shape)
+        else:
+            params = {name: param_matrix[:, i] for i, name in enumerate(names)}
+
+            def rhs(t, z):
+                y = z.reshape(n, K)
+                dydt = self.ode_f(t, list(y), params) # ode_f using plain arithmetic works on arrays too
+                return np.stack([np.broadcast_to(d, (K,)) for d in dydt]).reshape(z.shape)
+        return rhs
+
+    def integrate_batch(self, param_matrix):
+        """Solves the model for K parameter sets at once, as one stacked ODE system
+
+        param_matrix has shape (K, n_params), with columns in the order of the model parameters.
+        Returns the normalised product curves with shape (K, len(time)). The copies are independent,
+        so implicit methods are given the block sparsity of the stacked jacobian. The tolerances
+        are tightened by sqrt(K), since the solver controls the RMS error over all K copies.
+        If the stacked solve fails, each parameter set is solved on its own, and rows of parameter
+        sets that still fail are nan.
+        """
+        param_matrix = np.atleast_2d(np.asarray(param_matrix, dtype=float))
+        n, K = len(self.y0), len(param_matrix)
+        if param_matrix.shape[1] != len(self.params):
+            raise ValueError("param_matrix must have one column per model parameter")
+        jac_sparsity = None
+        if self.integration_method in ('Radau', 'BDF'):
+            jac_sparsity = kron(np.ones((n, n)), identity(K), format='csc')
+        try:
+            sol = self.run_solver(fun=self.batch_rhs(param_matrix),
+                                  y0=np.repeat(np.asarray(self.y0, dtype=float), K),
+                                  t_span=(self.time[0], self.time[-1]),
+                                  t_eval=self.time,
+                                  method=self.integration_method,
+                                  vectorized=self.kernel is not None,
+                                  jac_sparsity=jac_sparsity,
+                                  atol=self.atol/np.sqrt(K),
+                                  rtol=self.rtol/np.sqrt(K))
+            if sol.success and sol.y.shape[1] == len(self.time):
+                return sol.y[(n-1)*K:]/self.max_val
+        except Exception as exc: # e.g. an ode_f that cannot operate on arrays
+            self.logger.info("Stacked integration failed ({}), solving each parameter set separately.".format(exc))
+        return self.integrate_each(param_matrix)
+
+    def integrate_each(self, param_matrix):
+        """Solves the model for each row of the parameter matrix in turn, with nan rows for failed solves"""
+        params = self.params
+        curves = np.full((len(param_matrix), len(self.time)), np.nan)
+        try:
+            for k, values in enumerate(param_matrix):
+                self.params = params.copy()
+                for name, value in zip(params, values):
+                    self.params[name].value = value
+                sol = self.integrate()
+                if sol.y.shape[1] == len(self.time):
+                    curves[k] = sol.y[-1]/self.max_val
+        finally:
+            self.params = params
+        return curves
+
     def normalised(self):
-        """Returns the model solution normalised against the maximum value for the product"""
-        return self.integrate().y[-1]/self.max_val
\ No newline at end of file
+        """Returns the model solution normalised against the maximum value for the product, nan if the integration failed"""
+        sol = self.integrate()
+        if not sol.success:
+            return np.full(len(self.time), np.nan)
+        return sol.y[-1]/self.max_val
\ No newline at end of file
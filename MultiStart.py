@@ -0,0 +1,117 @@
+import os
+import lmfit
+import numpy as np
+import pandas as pd
+from scipy.stats import qmc
+from Fitter import Fitter
+from Logger import setup_logger
+from Race import race
+
+
+def log_chisqr(chisqr, ndata, nvarys):
+    """Returns the score of a start, so a cancel_factor times higher chi-square is log(cancel_factor) worse"""
+    return np.log(max(chisqr, 1e-250))
+
+
+class MultiStart:
+    """Fits the model from several starting points in parallel, keeping the best fit
+
+    Starting values are drawn by Latin hypercube sampling within the parameter bounds, in log
+    space for parameters whose bounds are both positive. Starts run in a process pool; once a
+    start has made min_nfev function evaluations, it is cancelled if the lowest chi-square it has
+    reached is more than cancel_factor times that of the best finished start.
+    """
+
+    def __init__(self, p_fitter, p_starts, p_workers=0, p_seed=None, p_cancel_factor=10.0, p_min_nfev=20):
+        self.logger = setup_logger("multistart_logger")
+        self.fitter = p_fitter
+        self.starts = p_starts
+        self.workers = p_workers if p_workers > 0 else os.cpu_count()
+        self.seed = p_seed
+        self.cancel_factor = p_cancel_factor
+        self.min_nfev = p_min_nfev
+        self.summary = None
+
+    @property
+    def fitter(self):
+        return self._fitter
+
+    @property
+    def starts(self):
+        return self._starts
+
+    @fitter.setter
+    def fitter(self, value):
+        if not isinstance(value, Fitter):
+            raise ValueError("fitter must be instance of Fitter class")
+        else:
+            self._fitter = value
+
+    @starts.setter
+    def starts(self, value):
+        if not isinstance(value, int) or value < 1:
+            raise ValueError("starts must be a positive int")
+        else:
+            self._starts = value
+
+    def sample(self):
+        """Draws the starting values of the varying parameters with Latin hypercube sampling"""
+        params = self.fitter.model.params
+        names = [name for name, param in params.items() if param.vary and not param.expr]
+        for name in names:
+            if not (np.isfinite(params[name].min) and np.isfinite(params[name].max)):
+                raise ValueError("parameter {} needs finite bounds for multi-start sampling".format(name))
+        log_scale = np.array([params[name].min > 0 for name in names])
+        lower = np.array([params[name].min for name in names], dtype=float)
+        upper = np.array([params[name].max for name in names], dtype=float)
+        lower[log_scale] = np.log10(lower[log_scale])
+        upper[log_scale] = np.log10(upper[log_scale])
+
+        unit = qmc.LatinHypercube(d=len(names), seed=self.seed).random(self.starts)
+        samples = qmc.scale(unit, lower, upper)
+        samples[:, log_scale] = 10**samples[:, log_scale]
+        samples = np.clip(samples, [params[name].min for name in names], [params[name].max for name in names])
+        return [dict(zip(names, sample)) for sample in samples]
+
+    def fit(self):
+        """Runs all starts, returning the best MinimizerResult"""
+        starts = self.sample()
+        self.logger.info("Fitting from {} starts with {} workers.".format(self.starts, self.workers))
+        tasks = [(index, None, start) for index, start in enumerate(starts)]
+        outcomes = race(tasks, log_chisqr, np.log(self.cancel_factor), self.min_nfev, self.workers, self.fitter)
+
+        rows = []
+        results = {}
+        for index, result, status, score in outcomes:
+            row = {"start": index, "status": status}
+            row.update({"init_" + name: value for name, value in starts[index].items()})
+            if result is None:
+                row.update({"chisqr": np.nan, "nfev": 0, "failures": np.nan})
+            else:
+                row.update({"chisqr": getattr(result, "chisqr", np.nan), # not calculated for cancelled starts
+                            "nfev": result.nfev, "failures": result.integration_failures})
+                row.update({name: param.value for name, param in result.params.items()})
+                if status != "cancelled":
+                    results[index] = result
+            rows.append(row)
+        self.summary = pd.DataFrame(rows).set_index("start").sort_values("chisqr")
+        if not results:
+            raise ValueError("None of the {} starts converged".format(self.starts))
+
+        best_result = min(results.values(), key=lambda result: result.chisqr)
+        self.report_convergence(best_result)
+        # make the best fit the fitter's own, as if it had been fitted directly
+        self.fitter.model.params = best_result.params
+        self.fitter.mini = lmfit.Minimizer(self.fitter.residuals, best_result.params)
+        self.fitter.mini.result = best_result
+        return best_result
+
+    def report_convergence(self, best_result):
+        """Logs how the starts converged"""
+        summary = self.summary
+        near_best = summary[summary["chisqr"] <= best_result.chisqr*1.01]
+        self.logger.info("{} starts converged, {} reached the maximum evaluations, {} cancelled, {} failed; {} reached within 1% of the best chi-square ({:.6g}).".format(
+            (summary["status"] == "converged").sum(), (summary["status"] == "max_nfev reached").sum(),
+            (summary["status"] == "cancelled").sum(), summary["status"].str.startswith("failed").sum(),
+            len(near_best), best_result.chisqr))
+        self.logger.info(summary[["status", "chisqr", "nfev", "failures"]].to_string())
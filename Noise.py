@@ -0,0 +1,103 @@
+import numpy as np
+from collections import OrderedDict
+
+# least recently used noise estimates, keyed by the caller's (assay, wells) key and the noise settings
+cache = OrderedDict()
+cache_size = 32 # estimates kept, e.g. by a batch worker running many configurations
+
+
+def rolling_moments(data, window):
+    """Returns the trailing rolling mean and standard deviation along the last axis of a (traces, cycles) array
+
+    The windows hold up to window points, fewer at the start as with pandas' min_periods=1,
+    and the standard deviation of a single point is nan. All traces are done in one pass
+    with cumulative sums, shifted by the first value of each trace to limit cancellation.
+    """
+    data = np.asarray(data, dtype=float)
+    first = data[:, :1]
+    shifted = data - first
+    zero = np.zeros((len(data), 1))
+    sums = np.concatenate([zero, np.cumsum(shifted, axis=1)], axis=1)
+    squares = np.concatenate([zero, np.cumsum(shifted**2, axis=1)], axis=1)
+    end = np.arange(data.shape[1]) + 1
+    start = np.maximum(0, end - window)
+    n = end - start
+    total = sums[:, end] - sums[:, start]
+    mean = total/n
+    with np.errstate(invalid="ignore", divide="ignore"):
+        var = (squares[:, end] - squares[:, start] - total*mean)/(n - 1)
+    var[:, n == 1] = np.nan # rounding can leave a nonzero numerator
+    return mean + first, np.sqrt(np.maximum(var, 0))
+
+
+class Noise:
+    """Estimates the noise of the normalised data, used to weight the residuals of a fit
+
+    Three models are available:
+    rolling   - the deviation of each point from the rolling mean, in units of the rolling
+                standard deviation, over a trailing window of window cycles
+    replicate - the standard deviation across the replicate data wells at each cycle,
+                divided by sqrt(n) when the fit is against their average
+    constant  - the same value for every point, i.e. unweighted least squares
+
+    Estimates are computed for a whole (wells x cycles) array at once, and can be cached
+    under a key identifying the assay and the selected wells.
+    """
+
+    models = ("rolling", "replicate", "constant")
+
+    def __init__(self, p_model="rolling", p_window=20, p_value=1.0):
+        self.model = p_model
+        self.window = p_window
+        self.value = p_value
+
+    @property
+    def model(self):
+        return self._model
+
+    @model.setter
+    def model(self, value):
+        if value not in self.models:
+            raise ValueError("noise model must be one of {}".format(", ".join(self.models)))
+        else:
+            self._model = value
+
+    def rolling(self, data):
+        """Returns the rolling noise of each trace of a (traces, cycles) array"""
+        mean, std = rolling_moments(data, self.window)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.abs(data - mean)/std
+
+    def replicate(self, wells, averaged=True):
+        """Returns the noise at each cycle from the spread of a (replicates, cycles) array of normalised wells"""
+        if len(wells) < 2:
+            raise ValueError("the replicate noise model needs at least two data wells")
+        std = np.std(wells, axis=0, ddof=1)
+        return std/np.sqrt(len(wells)) if averaged else std
+
+    def constant(self, data):
+        """Returns the constant noise for each point of a (traces, cycles) array"""
+        return np.full(np.shape(data), float(self.value))
+
+    def estimate(self, data_wells, control_data):
+        """Returns the noise of the averaged data wells, normalised against the control data
+
+        data_wells has shape (wells, cycles), control_data is the averaged control with shape (cycles,).
+        """
+        if self.model == "replicate":
+            return self.replicate(data_wells/control_data)
+        normalised = data_wells.mean(axis=0)/control_data
+        if self.model == "constant":
+            return self.constant(normalised)
+        return self.rolling(normalised[np.newaxis])[0]
+
+    def cached(self, key, load):
+        """Returns the noise estimate stored under key, estimating it on a miss from the (data_wells, control_data) load returns"""
+        key = (key, self.model, self.window, self.value)
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        cache[key] = self.estimate(*load())
+        if len(cache) > cache_size:
+            cache.popitem(last=False) # evict the least recently used estimate
+        return cache[key]
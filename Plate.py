@@ -0,0 +1,154 @@
+import os
+import copy
+import numpy as np
+import pandas as pd
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+from Assay import Assay
+from Model import Model
+from Fitter import Fitter
+from Wells import Wells
+from Noise import Noise
+from Logger import setup_logger
+
+# per-process state of the plate workers, set up once by init_worker
+worker_state = {}
+
+
+def init_worker(p_shm_name, p_shape, p_model, p_time):
+    """Attaches a worker process to the shared assay data and stores its copy of the model"""
+    shm = shared_memory.SharedMemory(name=p_shm_name)
+    worker_state["shm"] = shm # keep a reference, the array is only valid while the block is open
+    worker_state["wells"] = np.ndarray(p_shape, dtype=np.float64, buffer=shm.buf)
+    worker_state["model"] = p_model
+    worker_state["params"] = copy.deepcopy(p_model.params) # initial guesses, restored before each fit
+    worker_state["time"] = p_time
+
+
+def fit_wells(task, noise):
+    """Fits the model against one data well (or replicate group) and its control, in a worker process"""
+    label, control_label, data_idx, control_idx, _ = task
+    wells = worker_state["wells"]
+    model = worker_state["model"]
+    model.params = copy.deepcopy(worker_state["params"])
+    row = {"well": label, "control": control_label}
+    y_data = wells[data_idx].mean(axis=0)
+    control_data = wells[control_idx].mean(axis=0)
+    if np.isnan(y_data).any() or np.isnan(control_data).any():
+        row["status"] = "One or more selected wells contains a nan value"
+        return row
+    try:
+        fitter = Fitter(model, worker_state["time"], y_data, control_data, p_noise=noise)
+        result = fitter.fit()
+    except Exception as exc: # one bad well should not stop the rest of the plate
+        row["status"] = str(exc)
+        return row
+    row["status"] = result.message
+    for name, param in result.params.items():
+        row[name] = param.value
+        row[name + "_stderr"] = param.stderr
+    row.update({"chisqr": result.chisqr, "redchi": result.redchi, "aic": result.aic, "bic": result.bic,
+                "nfev": result.nfev, "success": result.success, "integration_failures": result.integration_failures,
+                "failure_time": result.failure_time})
+    return row
+
+
+class Plate:
+    """Fits every selected data well (or replicate group) of an assay as its own fit, in parallel
+
+    The i-th data well selection is matched with the i-th control well selection, or with the
+    only control selection if just one is given. Within a matched pair each data well is fitted
+    against the control well at the same position of the control selection, or against the
+    average of the control selection if their sizes differ. With replicates, each data
+    selection is averaged and fitted as a single group instead.
+
+    The assay data is placed in shared memory once, so tasks only carry well indices. The
+    noise of every task is estimated up front in one pass over all wells. With the replicate
+    noise model, the wells of a data selection are the replicates of each other.
+    """
+
+    def __init__(self, p_assay, p_model, p_data_wells, p_control_wells, p_workers=0, p_replicates=False,
+                 p_noise=None):
+        self.logger = setup_logger("plate_logger")
+        self.assay = p_assay
+        self.model = p_model
+        self.workers = p_workers if p_workers > 0 else os.cpu_count()
+        self.replicates = p_replicates
+        self.noise = p_noise if p_noise is not None else Noise()
+        self.wells = Wells(self.assay.ROWS, self.assay.COLS)
+        self.tasks = self.match_wells(p_data_wells, p_control_wells)
+
+    @property
+    def assay(self):
+        return self._assay
+
+    @property
+    def model(self):
+        return self._model
+
+    @assay.setter
+    def assay(self, value):
+        if not isinstance(value, Assay):
+            raise ValueError("assay must be instance of Assay class")
+        else:
+            self._assay = value
+
+    @model.setter
+    def model(self, value):
+        if not isinstance(value, Model):
+            raise ValueError("model must be instance of Model class")
+        else:
+            self._model = value
+
+    def match_wells(self, data_wells, control_wells):
+        """Matches the data and control selections, returning a fit task for each data well or group
+
+        A task is (label, control label, data well indices, control well indices, data selection indices).
+        """
+        if len(control_wells) == 1:
+            control_wells = control_wells*len(data_wells)
+        elif len(control_wells) != len(data_wells):
+            raise ValueError("control_wells must have one selection, or one per data_wells selection")
+
+        tasks = []
+        for data_str, control_str in zip(data_wells, control_wells):
+            data = self.wells.expand(data_str)
+            control = self.wells.expand(control_str)
+            control_idx = [idx for _, idx in control]
+            data_idx = [idx for _, idx in data]
+            if self.replicates:
+                tasks.append((data_str.upper(), control_str.upper(), data_idx, control_idx, data_idx))
+            elif len(data) == len(control): # well by well
+                for (label, idx), (control_label, c_idx) in zip(data, control):
+                    tasks.append((label, control_label, [idx], [c_idx], data_idx))
+            else: # each well against the averaged control
+                for label, idx in data:
+                    tasks.append((label, control_str.upper(), [idx], control_idx, data_idx))
+        return tasks
+
+    def estimate_noise(self, wells):
+        """Estimates the noise of every task, the rolling and constant models in a single pass over all tasks"""
+        control = np.stack([wells[control_idx].mean(axis=0) for _, _, _, control_idx, _ in self.tasks])
+        if self.noise.model == "replicate":
+            return [self.noise.replicate(wells[group_idx]/control[i], averaged=self.replicates)
+                    for i, (_, _, _, _, group_idx) in enumerate(self.tasks)]
+        data = np.stack([wells[data_idx].mean(axis=0) for _, _, data_idx, _, _ in self.tasks])
+        if self.noise.model == "constant":
+            return list(self.noise.constant(data/control))
+        return list(self.noise.rolling(data/control))
+
+    def fit(self):
+        """Fits all tasks in a process pool, returning a table of the fitted parameters for each well"""
+        self.logger.info("Fitting {} wells with {} workers.".format(len(self.tasks), self.workers))
+        wells = np.ascontiguousarray(self.assay.well, dtype=np.float64)
+        noise = self.estimate_noise(wells)
+        shm = shared_memory.SharedMemory(create=True, size=wells.nbytes)
+        try:
+            np.ndarray(wells.shape, dtype=np.float64, buffer=shm.buf)[:] = wells
+            with ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                     initargs=(shm.name, wells.shape, self.model, self.assay.time)) as pool:
+                rows = list(pool.map(fit_wells, self.tasks, noise))
+        finally:
+            shm.close()
+            shm.unlink()
+        return pd.DataFrame(rows).set_index("well")
@@ -0,0 +1,163 @@
+import os
+import json
+import time
+import threading
+import contextlib
+from Logger import setup_logger
+
+
+class Phase:
+    """Times one phase of a run, recording it with the profiler when it ends"""
+
+    __slots__ = ("profiler", "name", "args", "start")
+
+    def __init__(self, p_profiler, p_name, p_args):
+        self.profiler = p_profiler
+        self.name = p_name
+        self.args = p_args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profiler.record(self.name, self.start, time.perf_counter() - self.start, self.args)
+        return False
+
+
+class Profiler:
+    """Collects timers, counters and solver statistics of a run, exported as JSON and as a Chrome trace
+
+    The instrumented code records into the module's profiler instance, which does nothing until
+    enabled, so the hot paths only pay for a check of the enabled flag. Phases nest, e.g. the solves
+    of a residual call within the residual call within the fit, and each is kept as an event of the
+    timeline (up to max_events) and summed into a timer by name. Work done in worker processes is not
+    recorded, only the time the run waits for it.
+    """
+
+    def __init__(self, p_enabled=False, p_max_events=200000):
+        self.logger = setup_logger("profiler_logger")
+        self.enabled = p_enabled
+        self.max_events = p_max_events # the timers and counters are kept in full once the timeline is
+        self.lock = threading.Lock() # residuals may be called from jacobian threads
+        self.reset()
+
+    @property
+    def max_events(self):
+        return self._max_events
+
+    @max_events.setter
+    def max_events(self, value):
+        if not isinstance(value, int) or value < 0:
+            raise ValueError("max_events must be a non-negative int")
+        else:
+            self._max_events = value
+
+    def reset(self):
+        """Clears the recorded data, starting the clock of a new run"""
+        self.origin = time.perf_counter()
+        self.events = [] # (name, start, duration, thread id, args)
+        self.samples = [] # (time, cumulative solver counters), for the counter track of the trace
+        self.dropped = 0
+        self.timers = {} # name: [calls, total seconds, longest]
+        self.counters = {}
+
+    def phase(self, name, **args):
+        """Returns a context manager timing the named phase, args are shown with its event in the trace"""
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return Phase(self, name, args)
+
+    def record(self, name, start, duration, args=None):
+        """Records a phase that started at start (from time.perf_counter) and took duration seconds"""
+        if not self.enabled:
+            return
+        with self.lock:
+            timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += duration
+            timer[2] = max(timer[2], duration)
+            if len(self.events) < self.max_events:
+                self.events.append((name, start, duration, threading.get_ident(), args))
+            else:
+                self.dropped += 1
+
+    def count(self, name, n=1):
+        """Adds n to the named counter"""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def solver(self, sol, start, duration):
+        """Records a solve_ivp call, its function, jacobian and LU decomposition counts and whether it succeeded"""
+        if not self.enabled:
+            return
+        stats = {"nfev": int(getattr(sol, "nfev", 0)), "njev": int(getattr(sol, "njev", 0)),
+                 "nlu": int(getattr(sol, "nlu", 0)), "success": bool(sol.success)}
+        self.record("solve_ivp", start, duration, stats)
+        with self.lock:
+            for name in ("nfev", "njev", "nlu"):
+                self.counters[name] = self.counters.get(name, 0) + stats[name]
+            if not sol.success:
+                self.counters["failed solves"] = self.counters.get("failed solves", 0) + 1
+            if len(self.samples) < self.max_events:
+                self.samples.append((start + duration, {name: self.counters[name] for name in ("nfev", "njev", "nlu")}))
+
+    def summary(self):
+        """Returns the timers, with calls, total, mean and longest seconds, and the counters as a dict"""
+        elapsed = time.perf_counter() - self.origin
+        timers = {name: {"calls": calls, "total": total, "mean": total/calls, "max": longest,
+                         "share": total/elapsed if elapsed > 0 else 0.0}
+                  for name, (calls, total, longest) in sorted(self.timers.items(), key=lambda item: -item[1][1])}
+        return {"elapsed": elapsed, "timers": timers, "counters": dict(self.counters), "dropped_events": self.dropped}
+
+    def trace(self):
+        """Returns the recorded phases and solver counters in the Chrome trace event format
+
+        The trace can be opened in chrome://tracing or https://ui.perfetto.dev, times are in microseconds from reset.
+        """
+        pid = os.getpid()
+        threads = {}
+        events = []
+        for name, start, duration, thread, args in self.events:
+            tid = threads.setdefault(thread, len(threads))
+            event = {"name": name, "ph": "X", "ts": (start - self.origin)*1e6, "dur": duration*1e6, "pid": pid, "tid": tid}
+            if args:
+                event["args"] = args
+            events.append(event)
+        for at, counts in self.samples:
+            events.append({"name": "solver", "ph": "C", "ts": (at - self.origin)*1e6, "pid": pid, "args": counts})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    @staticmethod
+    def paths(out_path):
+        """Returns the paths of the summary and trace files written next to a run's output"""
+        stem = os.path.splitext(out_path)[0]
+        return "{}_profile.json".format(stem), "{}_trace.json".format(stem)
+
+    def export(self, out_path):
+        """Writes the summary and the trace next to the output of a run and logs the summary"""
+        summary = self.summary()
+        for path, data in zip(self.paths(out_path), (summary, self.trace())):
+            tmp_path = "{}.{}.tmp".format(path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, path)
+        self.log_summary(summary)
+
+    def log_summary(self, summary=None):
+        """Logs the timers and counters"""
+        summary = summary if summary is not None else self.summary()
+        self.logger.info("Profile of {:.2f} s:".format(summary["elapsed"]))
+        for name, timer in summary["timers"].items():
+            self.logger.info("  {:<16} {:>8} calls {:>10.3f} s {:>6.1%}  mean {:.2e} s  max {:.2e} s".format(
+                name, timer["calls"], timer["total"], timer["share"], timer["mean"], timer["max"]))
+        for name, value in summary["counters"].items():
+            self.logger.info("  {:<16} {:>8}".format(name, value))
+        if summary["dropped_events"]:
+            self.logger.info("  {} events left out of the trace.".format(summary["dropped_events"]))
+
+
+# the profiler of this process, enabled by main.py --profile
+profiler = Profiler()
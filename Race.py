@@ -0,0 +1,80 @@
+import copy
+import numpy as np
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+# per-process state of the race workers, set up once by init_worker
+worker_state = {}
+
+
+def init_worker(p_score, p_best, p_margin, p_min_nfev, p_fitter=None):
+    """Stores the score of the best finished fit so far, shared by all workers, the cancellation settings and the shared fitter"""
+    worker_state["score"] = p_score
+    worker_state["best"] = p_best
+    worker_state["margin"] = p_margin
+    worker_state["min_nfev"] = p_min_nfev
+    worker_state["fitter"] = p_fitter
+    worker_state["params"] = copy.deepcopy(p_fitter.model.params) if p_fitter is not None else None
+
+
+def cancel_losing(params, iteration, resid, *args, **kws):
+    """lmfit iteration callback, aborting a fit that is clearly losing to the best finished fit
+
+    lmfit calls it after every function evaluation, so iteration counts evaluations. The score
+    is taken at the lowest chi-square the fit has reached so far.
+    """
+    worker_state["lowest"] = min(worker_state["lowest"], np.sum(resid**2))
+    if iteration < worker_state["min_nfev"]:
+        return False
+    value = worker_state["score"](worker_state["lowest"], len(resid), worker_state["nvarys"])
+    worker_state["cancelled"] = value > worker_state["best"].value + worker_state["margin"]
+    worker_state["value"] = value
+    return worker_state["cancelled"]
+
+
+def fit_task(task):
+    """Fits one (index, fitter, start) task, in a worker process
+
+    A task without a fitter fits the shared fitter of init_worker, from the start values.
+    """
+    index, fitter, start = task
+    if fitter is None:
+        fitter = worker_state["fitter"]
+        params = copy.deepcopy(worker_state["params"])
+        for name, value in start.items():
+            params[name].value = value
+        fitter.model.params = params
+    worker_state["nvarys"] = sum(1 for param in fitter.model.params.values() if param.vary and not param.expr)
+    worker_state["lowest"] = np.inf
+    worker_state["cancelled"] = False
+    try:
+        result = fitter.fit(iter_cb=cancel_losing)
+    except Exception as exc: # a failing fit should not stop the others
+        return index, None, "failed: {}".format(exc), np.nan
+    result.call_kws = None # holds bound methods of the fitter, not needed by the caller
+    if worker_state["cancelled"]:
+        return index, result, "cancelled", worker_state["value"]
+    value = worker_state["score"](result.chisqr, result.ndata, result.nvarys)
+    best = worker_state["best"]
+    with best.get_lock():
+        best.value = min(best.value, value)
+    # lmfit also aborts, without cancellation, when it reaches the maximum number of evaluations
+    return index, result, "max_nfev reached" if result.aborted else "converged", value
+
+
+def race(tasks, score, margin, min_nfev, workers, fitter=None):
+    """Fits the (index, fitter, start) tasks in a process pool, returning (index, result, status, score) of each
+
+    score(chisqr, ndata, nvarys) rates a fit, lower is better and picklable for the workers. Once a
+    fit has made min_nfev function evaluations, it is cancelled if its score is more than margin
+    above that of the best finished fit. fitter is the shared fitter of tasks without their own.
+    With one worker the tasks are fitted in this process, one after another.
+    """
+    best = multiprocessing.Value('d', np.inf)
+    initargs = (score, best, margin, min_nfev, fitter)
+    workers = min(workers, len(tasks))
+    if workers == 1:
+        init_worker(*initargs)
+        return [fit_task(task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=initargs) as pool:
+        return list(pool.map(fit_task, tasks))
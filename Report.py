@@ -1,25 +1,44 @@
+import io
 import os
 import math
+import time
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
+import matplotlib
+
+from matplotlib.figure import Figure
+from concurrent.futures import ProcessPoolExecutor
 
 from scipy.stats import norm
 from fpdf import FPDF, HTMLMixin
 from lmfit.minimizer import MinimizerResult, Minimizer
 from datetime import datetime
+from Profiler import profiler
 from Logger import setup_logger
 
 
 script_path = os.path.dirname(os.path.abspath(__file__))
 mm = 1/25.4
 
+# per-process state of the rendering workers, set up once by init_worker
+worker_state = {}
+
+
+def init_worker(p_report):
+    """Stores the worker's copy of the report, whose figures it renders"""
+    worker_state["report"] = p_report
+
+
+def render_figure(name):
+    """Renders the named figure method of the report, in a worker process, returning the image bytes"""
+    return getattr(worker_state["report"], name)().getvalue()
+
 
 class Report:
     """Generates a PDF report from the data produced by the fitting procedure"""
 
-    def __init__(self, p_title, p_y_data, p_time, p_model_sol, p_fit, p_mini, p_out):
+    def __init__(self, p_title, p_y_data, p_time, p_model_sol, p_fit, p_mini, p_out, p_intervals=None, p_posterior=None,
+                 p_image_format="png", p_dpi=300, p_workers=0):
         self.logger = setup_logger('report_logger')
         self.title = p_title
         self.y_data = p_y_data
@@ -28,6 +47,11 @@ class Report:
         self.fit = p_fit
         self.mini = p_mini
         self.out = p_out
+        self.intervals = p_intervals # table of confidence intervals from Uncertainty, if estimated
+        self.posterior = p_posterior # table of posterior summaries from Sampler, if sampled
+        self.image_format = p_image_format # png, or svg to embed the figures as vectors
+        self.dpi = p_dpi # resolution of the fit and covariance plots in png format
+        self.workers = p_workers if p_workers > 0 else os.cpu_count()
 
     @property
     def title(self):
@@ -56,6 +80,10 @@ class Report:
     @property
     def out(self):
         return self._out
+
+    @property
+    def image_format(self):
+        return self._image_format
     
     @title.setter
     def title(self, value):
@@ -100,7 +128,7 @@ class Report:
 
     @mini.setter
     def mini(self, value):
-        if not isinstance(value, Minimizer):
+        if value is not None and not isinstance(value, Minimizer): # None for a fit loaded from the results store
             raise ValueError("fit must be of type lmfit.minimizer.Minimizer")
         else:
             self._mini = value
@@ -112,6 +140,26 @@ class Report:
         else:
             self._out = value
 
+    @image_format.setter
+    def image_format(self, value):
+        if value not in ("png", "svg"):
+            raise ValueError("image_format must be 'png' or 'svg'")
+        else:
+            self._image_format = value
+
+    def __getstate__(self):
+        # the minimizer is not needed to render the figures in worker processes
+        state = self.__dict__.copy()
+        state["_mini"] = None
+        return state
+
+    def save(self, fig, dpi='figure'):
+        """Renders a figure into an in-memory image in the report's format"""
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format=self.image_format, dpi=dpi, bbox_inches='tight')
+        buffer.seek(0)
+        return buffer
+
     @staticmethod
     def format_float(num):
         """Formats numbers to a specific character length"""
@@ -130,8 +178,8 @@ class Report:
         """Creates a plot of the model solution against the experimental data"""
 
         self.logger.info('Creating model fit plot.')
-        plt.clf()  
-        fig, ax = plt.subplots(figsize=(130*mm, 80*mm))
+        fig = Figure(figsize=(130*mm, 80*mm))
+        ax = fig.subplots()
         ax.spines['top'].set_visible(False)
         ax.spines['right'].set_visible(False)
         ax.spines['left'].set_color('#BBBBBB')
@@ -145,19 +193,18 @@ class Report:
         ax.plot(self.time, self.model_sol, label="Fit")
         ax.set_xticks(ax.get_xticks()[1::2])
         ax.legend()
-        image_path = os.path.join(script_path, 'resources', 'fit_plot.png')   
-        fig.savefig(image_path, dpi=300, bbox_inches='tight')
-        return image_path
+        return self.save(fig, self.dpi)
         
     def covar_plot(self):
         """Creates a heatmap plot of the parameter covariance matrix"""
 
         self.logger.info('Creating parameter covariance plot.')
-        plt.clf()
-        fig, ax = plt.subplots()
+        import seaborn as sns # only needed for this plot, and slow to import
+        fig = Figure()
+        ax = fig.subplots()
         covar = self.fit.covar
         labels = self.fit.var_names
-        cmap = plt.get_cmap("RdYlGn").reversed()
+        cmap = matplotlib.colormaps["RdYlGn"].reversed()
         plot = sns.heatmap(covar,
                            cmap=cmap, 
                            xticklabels=labels, yticklabels=labels,
@@ -165,15 +212,14 @@ class Report:
                            annot=True,
                            ax=ax,
                            cbar_kws={"format": "%.2g"})
-        image_path = os.path.join(script_path, 'resources', 'covar_plot.png')   
-        fig.savefig(image_path, dpi=300, bbox_inches='tight')
-        return image_path
+        if self.image_format == "svg": # fpdf does not draw the raster image matplotlib embeds for the colorbar
+            plot.collections[0].colorbar.solids.set_rasterized(False)
+        return self.save(fig, self.dpi)
     
     def cdf_plot(self):
         """Creates a CDF and PDF plot of the model errors"""
 
         self.logger.info('Creating error plots.')
-        plt.clf()
         errors = self.model_sol - self.y_data
         sorted_errors = np.sort(errors)
         mean_error = np.mean(errors)
@@ -181,7 +227,8 @@ class Report:
 
 
         cdf = np.cumsum(np.ones_like(sorted_errors)) / len(sorted_errors)   
-        fig, ax  = plt.subplots(2, figsize=(130*mm, 80*mm), layout="constrained")
+        fig = Figure(figsize=(130*mm, 80*mm), layout="constrained")
+        ax = fig.subplots(2)
         ax[0].plot(sorted_errors, cdf)
         # ax[0].set_xlabel('Error')
         # ax[0].set_ylabel('Proportion of Errors <= x')
@@ -192,9 +239,7 @@ class Report:
         # ax[1].set_xlabel('Error')
         # ax[1].set_ylabel('Probability Density')
 
-        image_path = os.path.join(script_path, 'resources', 'cdf_plot.png')   
-        fig.savefig(image_path, bbox_inches='tight')
-        return image_path
+        return self.save(fig)
 
     def param_table(self):
         """Creates the parameter value table plot"""
@@ -215,15 +260,48 @@ class Report:
             param_df = pd.DataFrame(param_data[1:], columns=param_data[0])
         
 
-        fig, ax = plt.subplots(figsize=(185*mm,60*mm), layout='constrained')
+        fig = Figure(figsize=(185*mm,60*mm), layout='constrained')
+        ax = fig.subplots()
         ax.axis('off')
         ax.axis('tight')
         ax.autoscale(True)
         ax.table(cellText=param_df.values, colLabels=param_df.columns, loc='top')
 
-        image_path = os.path.join(script_path, 'resources', 'param_table.png')   
-        fig.savefig(image_path, bbox_inches="tight")
-        return image_path
+        return self.save(fig)
+
+    def interval_table(self):
+        """Creates the confidence interval table plot"""
+
+        self.logger.info('Creating confidence interval table.')
+        columns = [("value", "Value"), ("stderr", "StdErr"), ("bootstrap_lower", "Bootstrap Lower"),
+                   ("bootstrap_upper", "Bootstrap Upper"), ("profile_lower", "Profile Lower"), ("profile_upper", "Profile Upper")]
+        cells = [[name] + ["-" if value is None or np.isnan(value) else self.format_float(value)
+                           for value in (row[column] for column, _ in columns)]
+                 for name, row in self.intervals.iterrows()]
+        fig = Figure(figsize=(270*mm, 60*mm), layout='constrained')
+        ax = fig.subplots()
+        ax.axis('off')
+        ax.axis('tight')
+        ax.autoscale(True)
+        ax.table(cellText=cells, colLabels=["Parameter"] + [label for _, label in columns], loc='top')
+        return self.save(fig)
+
+    def posterior_table(self):
+        """Creates the posterior summary table plot"""
+
+        self.logger.info('Creating posterior table.')
+        columns = [("value", "Best Fit"), ("median", "Median"), ("lower", "Lower"), ("upper", "Upper"),
+                   ("tau", "Autocorrelation Time")]
+        cells = [[name] + ["-" if value is None or np.isnan(value) else self.format_float(value)
+                           for value in (row[column] for column, _ in columns)]
+                 for name, row in self.posterior.iterrows()]
+        fig = Figure(figsize=(230*mm, 60*mm), layout='constrained')
+        ax = fig.subplots()
+        ax.axis('off')
+        ax.axis('tight')
+        ax.autoscale(True)
+        ax.table(cellText=cells, colLabels=["Parameter"] + [label for _, label in columns], loc='top')
+        return self.save(fig)
 
     def gof_table(self):
         """Creates the goodness-of-fit table plot"""
@@ -235,20 +313,53 @@ class Report:
             "Akaike info crit": [self.format_float(self.fit.aic)],
             "Bayesian info crit": [self.format_float(self.fit.bic)]
             })
+        failures = getattr(self.fit, "integration_failures", 0)
+        if failures: # only shown when integrations failed during the fit
+            df["Failed integrations"] = ["{} ({:.1f} s)".format(failures, self.fit.failure_time)]
         data = df.T.values
-        fig, ax = plt.subplots(figsize=(185*mm,9*mm))
+        fig = Figure(figsize=(185*mm,9*mm))
+        ax = fig.subplots()
         ax.axis('off')
         ax.axis('tight')
         ax.table(cellText=data, rowLabels=df.columns, loc='top', fontsize=60, cellLoc='center')
         ax.autoscale(True)
-        image_path = os.path.join(script_path, 'resources', 'gof_table.png')   
-        fig.savefig(image_path, bbox_inches="tight")
-        return image_path
+        return self.save(fig)
         
+    def figure_names(self):
+        """Returns the names of the figure methods of the report"""
+        names = ["fit_plot", "cdf_plot", "param_table", "gof_table"]
+        if self.fit.errorbars:
+            names.append("covar_plot")
+        if self.intervals is not None:
+            names.append("interval_table")
+        if self.posterior is not None:
+            names.append("posterior_table")
+        return names
+
+    def render(self):
+        """Renders the figures of the report, returning a dict of in-memory images by figure name
+
+        The figures are independent, so they are rendered concurrently in worker processes.
+        """
+        names = self.figure_names()
+        workers = min(self.workers, len(names))
+        if workers == 1:
+            images = {}
+            for name in names:
+                with profiler.phase(name):
+                    images[name] = getattr(self, name)()
+            return images
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(self,)) as pool:
+            images = pool.map(render_figure, names)
+            return {name: io.BytesIO(image) for name, image in zip(names, images)}
+
     def generate_pdf(self):
         """Generates the PDF using the individual components created by this class
         """
+        with profiler.phase("render"):
+            images = self.render()
         self.logger.info('Compiling report.')
+        compile_start = time.perf_counter()
         pdf = PDF('L', 'mm', 'A4') # instatiate PDF class
         pdf.add_page()
         pdf.set_auto_page_break(auto=False)
@@ -264,27 +375,196 @@ class Report:
         # add covariance plot
         if self.fit.errorbars:
             pdf.set_xy(187, 23)
-            covar_path = self.covar_plot()
-            pdf.add_image(covar_path, h=80)
+            pdf.add_image(images["covar_plot"], h=80)
         
         # add fit plot
-        fit_path = self.fit_plot()
         pdf.set_xy(1, 121)
-        pdf.add_image(fit_path, h=88)
+        pdf.add_image(images["fit_plot"], h=88)
         
         # add parameter table
         pdf.set_xy(1, 16)
-        param_path = self.param_table() 
-        pdf.add_image(param_path, h=60)
+        pdf.add_image(images["param_table"], h=60)
         
         # add GOF table
         pdf.set_xy(1, 85)
-        gof_path = self.gof_table()   
-        pdf.add_image(gof_path, h=27)
+        pdf.add_image(images["gof_table"], h=27)
         
         pdf.set_xy(148, 122)
-        cdf_path = self.cdf_plot()
-        pdf.add_image(cdf_path, h=86)
+        pdf.add_image(images["cdf_plot"], h=86)
+
+        # add confidence intervals and the posterior summary on a second page
+        if self.intervals is not None or self.posterior is not None:
+            pdf.add_page()
+            pdf.set_xy(31, 0)
+            pdf.cell(162, 8, "Confidence Intervals", align='C')
+        if self.intervals is not None:
+            pdf.set_xy(1, 16)
+            pdf.add_image(images["interval_table"], h=60)
+        if self.posterior is not None:
+            pdf.set_xy(1, 16 if self.intervals is None else 100)
+            pdf.add_image(images["posterior_table"], h=60)
+
+        pdf.output(self.out)
+        profiler.record("compile", compile_start, time.perf_counter() - compile_start)
+        self.logger.info('Done, report saved at: {}'.format(os.path.abspath(self.out)))
+
+class ComparisonReport(Report):
+    """Generates a PDF report comparing the fits of several candidate models to the same data, from a Selection"""
+
+    def __init__(self, p_title, p_y_data, p_time, p_curves, p_results, p_summary, p_criterion, p_out,
+                 p_image_format="png", p_dpi=300, p_workers=0):
+        self.logger = setup_logger('report_logger')
+        self.title = p_title
+        self.y_data = p_y_data
+        self.time = p_time
+        self.curves = p_curves # normalised model solution of each fitted candidate, by label
+        self.results = p_results # MinimizerResult of each fitted candidate, by label
+        self.summary = p_summary # ranking table of Selection.fit
+        self.criterion = p_criterion
+        self.out = p_out
+        self.image_format = p_image_format
+        self.dpi = p_dpi
+        self.workers = p_workers if p_workers > 0 else os.cpu_count()
+
+    def figure_names(self):
+        return ["comparison_plot", "residual_plot", "weight_plot", "ranking_table", "candidate_table"]
+
+    def comparison_plot(self):
+        """Creates a plot of each candidate's model solution against the experimental data"""
+
+        self.logger.info('Creating model comparison plot.')
+        fig = Figure(figsize=(130*mm, 80*mm))
+        ax = fig.subplots()
+        ax.spines['top'].set_visible(False)
+        ax.spines['right'].set_visible(False)
+        ax.spines['left'].set_color('#BBBBBB')
+        ax.spines['bottom'].set_color('#BBBBBB')
+        ax.set_axisbelow(True)
+        ax.yaxis.grid(True, color='#DDDDDD')
+        ax.xaxis.grid(True, color='#DDDDDD')
+        ax.set_ylabel("Reaction Completion Fraction")
+        ax.set_xlabel("Time (s)")
+        ax.plot(self.time, self.y_data, label="Data", alpha=0.7, color='#888888')
+        for label in self.summary.index: # best first
+            if label in self.curves:
+                ax.plot(self.time, self.curves[label], label=label)
+        ax.set_xticks(ax.get_xticks()[1::2])
+        ax.legend()
+        return self.save(fig, self.dpi)
+
+    def residual_plot(self):
+        """Creates a plot of each candidate's residuals against time"""
+
+        self.logger.info('Creating model residual plot.')
+        fig = Figure(figsize=(130*mm, 80*mm))
+        ax = fig.subplots()
+        ax.spines['top'].set_visible(False)
+        ax.spines['right'].set_visible(False)
+        ax.set_axisbelow(True)
+        ax.yaxis.grid(True, color='#DDDDDD')
+        ax.set_ylabel("Model - Data")
+        ax.set_xlabel("Time (s)")
+        ax.axhline(0, color='#888888', linewidth=1)
+        for label in self.summary.index:
+            if label in self.curves:
+                ax.plot(self.time, self.curves[label] - self.y_data, label=label, alpha=0.8)
+        ax.legend()
+        return self.save(fig, self.dpi)
+
+    def weight_plot(self):
+        """Creates a bar plot of the weight of each candidate"""
+
+        self.logger.info('Creating model weight plot.')
+        weights = self.summary["weight"].fillna(0)
+        fig = Figure(figsize=(100*mm, 80*mm), layout='constrained')
+        ax = fig.subplots()
+        ax.spines['top'].set_visible(False)
+        ax.spines['right'].set_visible(False)
+        ax.barh(weights.index[::-1], weights.values[::-1], color='#4C72B0')
+        ax.set_xlim(0, 1)
+        ax.set_xlabel("{} Weight".format(self.criterion.upper()))
+        return self.save(fig, self.dpi)
+
+    def ranking_table(self):
+        """Creates the table of the candidates ranked by the information criterion"""
+
+        self.logger.info('Creating model ranking table.')
+        columns = [("nvarys", "Parameters", "{:.0f}"), ("chisqr", "Chi-Square", None),
+                   ("redchi", "Reduced Chi-Sq.", None), ("aic", "AIC", None),
+                   ("bic", "BIC", None), ("delta", "Delta " + self.criterion.upper(), "{:.2f}"),
+                   ("weight", "Weight", "{:.3g}")] # weights of losing models can be far below format_float's range
+        cells = []
+        for label, row in self.summary.iterrows():
+            status = "fitted" if row["status"] in ("converged", "max_nfev reached") else row["status"]
+            cells.append([label, status] + ["-" if np.isnan(row[column]) else
+                                            self.format_float(row[column]) if form is None else form.format(row[column])
+                                            for column, _, form in columns])
+        fig = Figure(figsize=(185*mm, 9*mm))
+        ax = fig.subplots()
+        ax.axis('off')
+        ax.axis('tight')
+        ax.autoscale(True)
+        table = ax.table(cellText=cells, colLabels=["Model", "Status"] + [label for _, label, _ in columns], loc='top')
+        table.auto_set_font_size(False) # matplotlib shrinks the font of wide tables until it is unreadable
+        table.set_fontsize(7)
+        table.auto_set_column_width(list(range(len(columns) + 2)))
+        return self.save(fig)
+
+    def candidate_table(self):
+        """Creates the table of the fitted parameters of each candidate"""
+
+        self.logger.info('Creating candidate parameter table.')
+        cells = []
+        for label in self.summary.index:
+            if label not in self.results:
+                continue
+            for name, param in self.results[label].params.items():
+                stderr = "-" if param.stderr is None else self.format_float(param.stderr)
+                cells.append([label, name, self.format_float(param.value), stderr])
+        fig = Figure(figsize=(185*mm, 60*mm), layout='constrained')
+        ax = fig.subplots()
+        ax.axis('off')
+        ax.axis('tight')
+        ax.autoscale(True)
+        ax.table(cellText=cells, colLabels=["Model", "Parameter", "Value", "StdErr"], loc='top')
+        return self.save(fig)
+
+    def generate_pdf(self):
+        """Generates the PDF of the model comparison"""
+        with profiler.phase("render"):
+            images = self.render()
+        self.logger.info('Compiling report.')
+        pdf = PDF('L', 'mm', 'A4')
+        pdf.add_page()
+        pdf.set_auto_page_break(auto=False)
+        pdf.set_font("helvetica", size=13)
+        pdf.set_xy(31, 0)
+        pdf.cell(162, 8, self.title, align='C')
+        pdf.set_xy(223, 0)
+        pdf.cell(75, 8, datetime.now().strftime('%d/%m/%Y'), align="C")
+
+        # fitted parameters, ranking and weights in place of the parameter, goodness of fit and covariance figures,
+        # with the headings of the background over the covariance and error plots replaced
+        pdf.set_fill_color(160, 214, 105)
+        pdf.set_xy(186, 8.2)
+        pdf.cell(110.5, 7, "Model Weights", align='C', fill=True)
+        pdf.set_xy(149, 113)
+        pdf.cell(147.5, 7, "Residuals", align='C', fill=True)
+
+        pdf.set_xy(1, 16)
+        pdf.add_image(images["candidate_table"], h=60)
+
+        pdf.set_xy(1, 85)
+        pdf.add_image(images["ranking_table"], h=27)
+
+        pdf.set_xy(200, 23)
+        pdf.add_image(images["weight_plot"], h=80)
+
+        pdf.set_xy(1, 121)
+        pdf.add_image(images["comparison_plot"], h=88)
+
+        pdf.set_xy(148, 122)
+        pdf.add_image(images["residual_plot"], h=86)
 
         pdf.output(self.out)
         self.logger.info('Done, report saved at: {}'.format(os.path.abspath(self.out)))
@@ -297,5 +577,5 @@ class PDF(FPDF, HTMLMixin):
         self.image(image_path, 0, 0, self.w, self.h)
 
     def add_image(self, image, h):
-        '''Adds images to the page at the current cursor location, limited by the height value'''
-        self.image(image, x=self.get_x(), y=self.get_y(), h=h, type='png')
+        '''Adds images, png or svg, to the page at the current cursor location, limited by the height value'''
+        self.image(image, x=self.get_x(), y=self.get_y(), h=h)
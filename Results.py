@@ -0,0 +1,103 @@
+import os
+import json
+import math
+import numpy as np
+import pandas as pd
+from lmfit import Parameters
+from lmfit.minimizer import MinimizerResult
+
+
+def plain(value):
+    """Converts numpy scalars and arrays into python values for json, with nan and inf as None"""
+    if isinstance(value, dict):
+        return {str(key): plain(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [plain(item) for item in value]
+    if isinstance(value, (np.bool_, bool)):
+        return bool(value)
+    if isinstance(value, (np.integer, int)):
+        return int(value)
+    if isinstance(value, (np.floating, float)):
+        return float(value) if math.isfinite(value) else None
+    return value
+
+
+def fit_results(result, intervals=None, posterior=None):
+    """Returns the results of a fit as a dict of plain values
+
+    Holds the parameters (value, stderr, initial value, bounds and whether they varied), the
+    covariance of the varying parameters (None if errors were not estimated), the fit statistics,
+    and the tables of Uncertainty and Sampler by parameter if they were run.
+    """
+    params = {name: {"value": param.value, "stderr": param.stderr, "init_value": param.init_value,
+                     "min": param.min, "max": param.max, "vary": param.vary}
+              for name, param in result.params.items()}
+    covar = getattr(result, "covar", None)
+    results = {
+        "success": result.success,
+        "message": result.message,
+        "params": params,
+        "var_names": result.var_names,
+        "covar": covar if result.errorbars and covar is not None else None,
+        "chisqr": result.chisqr,
+        "redchi": result.redchi,
+        "aic": result.aic,
+        "bic": result.bic,
+        "nfev": result.nfev,
+        "ndata": result.ndata,
+        "nvarys": result.nvarys,
+        "integration_failures": getattr(result, "integration_failures", 0),
+        "failure_time": getattr(result, "failure_time", 0.0)
+    }
+    if intervals is not None:
+        results["intervals"] = intervals.to_dict(orient="index")
+    if posterior is not None:
+        results["posterior"] = posterior.to_dict(orient="index")
+    return plain(results)
+
+
+def selection_results(selection):
+    """Returns the ranking of a fitted Selection and the results of each fitted candidate as a dict of plain values"""
+    return plain({
+        "criterion": selection.criterion,
+        "ranking": selection.summary.to_dict(orient="index"),
+        "fits": {label: fit_results(result) for label, result in selection.results.items()}
+    })
+
+
+def minimizer_result(results):
+    """Rebuilds a MinimizerResult from the dict of fit_results, e.g. a fit loaded from the Store"""
+    params = Parameters()
+    for name, param in results["params"].items():
+        lower = -np.inf if param["min"] is None else param["min"]
+        upper = np.inf if param["max"] is None else param["max"]
+        params.add(name, value=param["value"], min=lower, max=upper, vary=param["vary"])
+        params[name].stderr = param["stderr"]
+        params[name].init_value = param["init_value"]
+    covar = None if results["covar"] is None else np.array(results["covar"], dtype=float)
+    result = MinimizerResult(params=params, var_names=results["var_names"], covar=covar, errorbars=covar is not None,
+                             init_vals=[params[name].init_value for name in results["var_names"]])
+    for name in ("success", "message", "chisqr", "redchi", "aic", "bic", "nfev", "ndata", "nvarys",
+                 "integration_failures", "failure_time"):
+        setattr(result, name, np.nan if results[name] is None else results[name])
+    return result
+
+
+def result_tables(results):
+    """Returns the Uncertainty and Sampler tables stored by fit_results, each None if it was not run"""
+    tables = []
+    for name in ("intervals", "posterior"):
+        table = results.get(name)
+        if table is not None:
+            table = pd.DataFrame.from_dict(table, orient="index").astype(float)
+            table.index.name = "parameter"
+        tables.append(table)
+    return tuple(tables)
+
+
+def save_json(results, path):
+    """Writes results to a json file, replacing it atomically so readers never see a partial file"""
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(results, f, indent=2)
+    os.replace(tmp_path, path)
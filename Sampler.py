@@ -0,0 +1,298 @@
+import io
+import os
+import copy
+import contextlib
+import lmfit
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from Fitter import Fitter
+from Transform import log_names, to_internal
+from Logger import setup_logger
+
+# per-process state of the walker pool, set up once by init_worker
+worker_state = {}
+
+
+def init_worker(p_fitter, p_params, p_var_names, p_bounds):
+    """Stores the worker's copy of the fitter, with the internal parameters and bounds of the sampled ones"""
+    worker_state["fitter"] = p_fitter
+    worker_state["params"] = p_params
+    worker_state["var_names"] = p_var_names
+    worker_state["bounds"] = p_bounds
+
+
+def log_prob(theta):
+    """Calculates the log posterior of a walker position, in a worker process
+
+    As lmfit's for weighted residuals: a flat prior within the bounds and -chisqr/2 inside them.
+    """
+    bounds = worker_state["bounds"]
+    if np.any(theta < bounds[:, 0]) or np.any(theta > bounds[:, 1]):
+        return -np.inf
+    params = worker_state["params"]
+    for name, value in zip(worker_state["var_names"], theta):
+        params[name].value = value
+    params.update_constraints()
+    residuals = worker_state["fitter"].internal_residuals(params)
+    return -0.5*np.sum(residuals**2)
+
+
+class WalkerPool:
+    """A pool for emcee's sampler that evaluates walker positions in worker processes holding their own fitter and model
+
+    emcee maps its log probability function over the walkers, which would pickle the
+    minimizer, fitter and model for every position. The workers instead load them once and
+    evaluate the same log posterior with log_prob, so the function emcee passes is not used.
+    """
+
+    def __init__(self, p_workers, p_fitter, p_params, p_var_names, p_bounds):
+        self.workers = p_workers
+        self.executor = ProcessPoolExecutor(max_workers=p_workers, initializer=init_worker,
+                                            initargs=(p_fitter, p_params, p_var_names, p_bounds))
+
+    def map(self, func, positions):
+        positions = list(positions)
+        chunksize = max(1, -(-len(positions)//self.workers)) # one chunk of walkers per worker
+        return self.executor.map(log_prob, positions, chunksize=chunksize)
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+class Sampler:
+    """Samples the posterior distribution of the fitted parameters with lmfit's emcee minimizer
+
+    The walkers start in a small ball around the best fit and are advanced check_interval
+    steps at a time. After each block the new steps are appended to the chain file, and the
+    integrated autocorrelation time tau of the chain after burn-in is estimated. Sampling
+    stops early once the chain is longer than tau_factor times tau and tau has changed by less
+    than tau_rtol since the last block, as recommended by emcee, or after steps steps.
+
+    Parameters configured with scale: log are sampled in log10 space, i.e. with a flat prior on
+    their logarithm, the chain and summary are given in natural units. If the chain file already
+    holds steps for the same parameters and walkers, sampling resumes from its last positions.
+    p_key identifies the data, model and settings the posterior depends on. It is written next
+    to the chain file, as the chain path with .key appended, and a chain sampled with another
+    key is not resumed, so samples of different posteriors are never mixed.
+    """
+
+    def __init__(self, p_fitter, p_result, p_walkers=32, p_steps=5000, p_burn=0, p_thin=1, p_check_interval=100,
+                 p_tau_factor=50.0, p_tau_rtol=0.01, p_level=0.95, p_workers=0, p_seed=None, p_chain=None, p_key=None):
+        self.logger = setup_logger("sampler_logger")
+        self.fitter = p_fitter
+        self.result = p_result
+        self.walkers = p_walkers
+        self.steps = p_steps
+        self.burn = p_burn
+        self.thin = p_thin
+        self.check_interval = p_check_interval
+        self.tau_factor = p_tau_factor
+        self.tau_rtol = p_tau_rtol
+        self.level = p_level
+        self.workers = p_workers if p_workers > 0 else os.cpu_count()
+        self.seed = p_seed
+        self.chain_path = p_chain # csv file the chain is written to, None keeps it in memory only
+        self.key = p_key # hash of the inputs of the posterior, checked before resuming the chain file
+        self.chain = None # internal walker positions, with shape (steps, walkers, parameters)
+        self.log_prob = None # log posterior of each position, with shape (steps, walkers)
+        self.tau = None
+        self.converged = False
+        self.samples = None # the chain after burn-in and thinning in natural units, one row per sample
+        self.table = None
+
+    @property
+    def fitter(self):
+        return self._fitter
+
+    @property
+    def level(self):
+        return self._level
+
+    @fitter.setter
+    def fitter(self, value):
+        if not isinstance(value, Fitter):
+            raise ValueError("fitter must be instance of Fitter class")
+        else:
+            self._fitter = value
+
+    @level.setter
+    def level(self, value):
+        if not 0 < value < 1:
+            raise ValueError("level must be between 0 and 1")
+        else:
+            self._level = value
+
+    @property
+    def var_names(self):
+        return [name for name, param in self.result.params.items() if param.vary and not param.expr]
+
+    def to_natural(self, positions):
+        """Returns a copy of an array of internal positions, parameters along the last axis, in natural units"""
+        natural = np.array(positions, dtype=float)
+        for i, name in enumerate(self.var_names):
+            if name in self.fitter.log_names:
+                natural[..., i] = 10**natural[..., i]
+        return natural
+
+    def to_internal(self, positions):
+        """Returns a copy of an array of natural positions in internal units, the inverse of to_natural"""
+        internal = np.array(positions, dtype=float)
+        for i, name in enumerate(self.var_names):
+            if name in self.fitter.log_names:
+                internal[..., i] = np.log10(internal[..., i])
+        return internal
+
+    @property
+    def key_path(self):
+        return self.chain_path + ".key"
+
+    def check_key(self):
+        """Raises a ValueError if the chain file was sampled from other inputs, writing the key of a new chain file"""
+        if self.key is None:
+            return
+        if not os.path.exists(self.chain_path):
+            with open(self.key_path, 'w') as f:
+                f.write(self.key)
+            return
+        key = None
+        if os.path.exists(self.key_path):
+            with open(self.key_path, 'r') as f:
+                key = f.read().strip()
+        if key != self.key:
+            raise ValueError("chain file {} was sampled from other data, model or settings, remove it or set another "
+                             "chain file".format(self.chain_path))
+
+    def load_chain(self):
+        """Reads the complete steps of the chain file, returning the internal positions and log posteriors"""
+        n_vars = len(self.var_names)
+        empty = np.empty((0, self.walkers, n_vars)), np.empty((0, self.walkers))
+        if self.chain_path is None:
+            return empty
+        self.check_key()
+        if not os.path.exists(self.chain_path):
+            return empty
+        table = pd.read_csv(self.chain_path)
+        if list(table.columns) != ["step", "walker", "log_prob"] + self.var_names:
+            raise ValueError("chain file {} does not hold the varying parameters {}".format(self.chain_path, self.var_names))
+        rows = len(table)
+        table = table.dropna(subset=["step", "walker"] + self.var_names) # a partly written last line
+        counts = table.groupby("step")["walker"].count()
+        if len(counts) and counts.max() != self.walkers:
+            raise ValueError("chain file {} was sampled with {} walkers, not {}".format(self.chain_path, counts.max(), self.walkers))
+        complete = counts.index[counts == self.walkers]
+        table = table[table["step"].isin(complete)].sort_values(["step", "walker"])
+        if len(table) != rows: # drop the incomplete steps of an interrupted write, before appending to the file
+            temp_path = self.chain_path + ".tmp"
+            table.to_csv(temp_path, index=False)
+            os.replace(temp_path, self.chain_path)
+        if not len(table):
+            return empty
+        positions = table[self.var_names].values.reshape(-1, self.walkers, n_vars)
+        return self.to_internal(positions), table["log_prob"].values.reshape(-1, self.walkers)
+
+    def write_chain(self, positions, log_prob, first_step):
+        """Appends steps of internal walker positions to the chain file, in natural units"""
+        if self.chain_path is None:
+            return
+        n_steps = len(positions)
+        table = pd.DataFrame(self.to_natural(positions).reshape(-1, len(self.var_names)), columns=self.var_names)
+        table.insert(0, "step", np.repeat(np.arange(first_step, first_step + n_steps), self.walkers))
+        table.insert(1, "walker", np.tile(np.arange(self.walkers), n_steps))
+        table.insert(2, "log_prob", log_prob.ravel())
+        table.to_csv(self.chain_path, mode="a", header=not os.path.exists(self.chain_path), index=False)
+
+    def start_positions(self, params):
+        """Returns the walkers' starting positions, in a small ball around the best fit within the bounds"""
+        rng = np.random.default_rng(self.seed)
+        values = np.array([params[name].value for name in self.var_names])
+        lower = np.array([params[name].min for name in self.var_names])
+        upper = np.array([params[name].max for name in self.var_names])
+        scale = 1e-4*np.maximum(np.abs(values), 1e-3) # lmfit's relative ball, which cannot spread from zero
+        positions = values + scale*rng.standard_normal((self.walkers, len(values)))
+        return np.clip(positions, lower, upper)
+
+    def check_convergence(self):
+        """Estimates the autocorrelation time of the chain after burn-in, returning whether sampling has converged"""
+        from emcee.autocorr import integrated_time # optional dependency, only needed for sampling
+
+        chain = self.chain[self.burn:]
+        if len(chain) < 2:
+            return False
+        last_tau = self.tau
+        self.tau = integrated_time(chain, tol=0) # tol=0 estimates tau however short the chain is
+        if last_tau is None or not np.all(np.isfinite(self.tau)):
+            return False
+        long_enough = np.all(len(chain) > self.tau_factor*self.tau)
+        stable = np.all(np.abs(last_tau - self.tau)/self.tau < self.tau_rtol)
+        return bool(long_enough and stable)
+
+    def run(self):
+        """Samples the posterior, returning a table of the median and credible interval of each varying parameter"""
+        fitter = self.fitter
+        fitter.log_names = log_names(self.result.params)
+        fitter.natural_params = copy.deepcopy(self.result.params)
+        params = to_internal(self.result.params, fitter.log_names)
+        var_names = self.var_names
+        if self.walkers < 2*len(var_names):
+            raise ValueError("sampling {} parameters needs at least {} walkers".format(len(var_names), 2*len(var_names)))
+        bounds = np.array([[params[name].min, params[name].max] for name in var_names])
+
+        self.chain, self.log_prob = self.load_chain()
+        if len(self.chain):
+            self.logger.info("Resuming sampling from step {} of {}.".format(len(self.chain), self.chain_path))
+            positions = self.chain[-1]
+        else:
+            positions = self.start_positions(params)
+        self.logger.info("Sampling with {} walkers for up to {} steps on {} workers.".format(
+            self.walkers, self.steps, self.workers))
+
+        mini = lmfit.Minimizer(fitter.internal_residuals, params)
+        pool = WalkerPool(self.workers, copy.copy(fitter), copy.deepcopy(params), var_names, bounds) if self.workers > 1 else 1
+        self.converged = self.check_convergence()
+        started = False
+        try:
+            while len(self.chain) < self.steps and not self.converged:
+                n_steps = min(self.check_interval, self.steps - len(self.chain))
+                # lmfit prints emcee's warning whenever the chain is too short for its own autocorrelation estimate
+                with contextlib.redirect_stdout(io.StringIO()):
+                    mini.emcee(params, steps=n_steps, nwalkers=self.walkers, pos=positions, reuse_sampler=started,
+                               workers=pool, seed=None if started else self.seed, progress=False)
+                started = True # later blocks continue the same sampler, with its random state
+                positions = mini.sampler.get_chain()[-n_steps:]
+                log_prob = mini.sampler.get_log_prob()[-n_steps:]
+                self.write_chain(positions, log_prob, len(self.chain))
+                self.chain = np.concatenate([self.chain, positions])
+                self.log_prob = np.concatenate([self.log_prob, log_prob])
+                self.converged = self.check_convergence()
+                tau = "-" if self.tau is None else np.array2string(self.tau, precision=1)
+                self.logger.info("Step {}: tau {}, acceptance fraction {:.2f}.".format(
+                    len(self.chain), tau, np.mean(mini.sampler.acceptance_fraction)))
+        finally:
+            if pool != 1:
+                pool.shutdown()
+        self.fitter.model.params = self.result.params
+        if self.converged:
+            self.logger.info("Sampling converged after {} steps.".format(len(self.chain)))
+        else:
+            self.logger.info("Sampling did not converge within {} steps.".format(self.steps))
+        return self.summary()
+
+    def summary(self):
+        """Returns a table of the median and credible interval of each varying parameter, from the chain after burn-in and thinning"""
+        samples = self.to_natural(self.chain[self.burn::self.thin]).reshape(-1, len(self.var_names))
+        self.samples = pd.DataFrame(samples, columns=self.var_names)
+        alpha = (1 - self.level)/2
+        tau = np.full(len(self.var_names), np.nan) if self.tau is None else self.tau
+        rows = []
+        for i, name in enumerate(self.var_names):
+            if len(samples):
+                lower, median, upper = np.quantile(samples[:, i], [alpha, 0.5, 1 - alpha])
+            else: # every step was burnt
+                lower, median, upper = np.nan, np.nan, np.nan
+            rows.append({"parameter": name, "value": self.result.params[name].value, "median": median,
+                         "lower": lower, "upper": upper, "tau": tau[i]})
+        self.table = pd.DataFrame(rows).set_index("parameter")
+        self.logger.info("{} posterior samples.".format(len(samples)))
+        self.logger.info(self.table.to_string())
+        return self.table
@@ -0,0 +1,109 @@
+import os
+import functools
+import numpy as np
+import pandas as pd
+from Fitter import Fitter
+from Logger import setup_logger
+from Race import race
+
+
+def information_criterion(chisqr, ndata, nvarys, criterion):
+    """Returns the AIC or BIC of a fit, as lmfit calculates them"""
+    neg2_log_likel = ndata*np.log(max(chisqr, 1e-250*ndata)/ndata)
+    penalty = 2*nvarys if criterion == "aic" else np.log(ndata)*nvarys
+    return neg2_log_likel + penalty
+
+
+class Selection:
+    """Fits several candidate models to the same prepared data in parallel, ranking them by AIC or BIC
+
+    The candidates' fitters share the data, control and noise arrays, which are prepared once.
+    Candidates run in a process pool; once a candidate has made min_nfev function evaluations, it
+    is cancelled if its criterion, at the lowest chi-square it has reached, is more than
+    cancel_delta above that of the best finished candidate. A difference of 10 leaves the losing
+    model essentially no support, though a cancelled candidate could still have improved.
+    The ranking gives each candidate's difference to the best (delta) and its Akaike weight,
+    the relative likelihood of the model among the finished candidates.
+    """
+
+    def __init__(self, p_fitters, p_labels, p_workers=0, p_criterion="aic", p_cancel_delta=10.0, p_min_nfev=50):
+        self.logger = setup_logger("selection_logger")
+        self.fitters = p_fitters
+        self.labels = p_labels
+        self.workers = p_workers if p_workers > 0 else os.cpu_count()
+        self.criterion = p_criterion
+        self.cancel_delta = p_cancel_delta
+        self.min_nfev = p_min_nfev
+        self.results = {} # MinimizerResult of each finished candidate, by label
+        self.curves = {} # normalised model solution of each finished candidate, by label
+        self.summary = None
+
+    @property
+    def fitters(self):
+        return self._fitters
+
+    @property
+    def labels(self):
+        return self._labels
+
+    @property
+    def criterion(self):
+        return self._criterion
+
+    @fitters.setter
+    def fitters(self, value):
+        if not value or not all(isinstance(fitter, Fitter) for fitter in value):
+            raise ValueError("fitters must be a non-empty list of Fitter instances")
+        else:
+            self._fitters = value
+
+    @labels.setter
+    def labels(self, value):
+        if len(value) != len(self.fitters):
+            raise ValueError("labels must have one label per fitter")
+        elif len(set(value)) != len(value):
+            raise ValueError("labels must be unique")
+        else:
+            self._labels = value
+
+    @criterion.setter
+    def criterion(self, value):
+        if value not in ("aic", "bic"):
+            raise ValueError("criterion must be 'aic' or 'bic'")
+        else:
+            self._criterion = value
+
+    def fit(self):
+        """Fits every candidate, returning the ranking table, best first"""
+        self.logger.info("Fitting {} candidate models with {} workers.".format(len(self.fitters), self.workers))
+        score = functools.partial(information_criterion, criterion=self.criterion)
+        tasks = [(index, fitter, None) for index, fitter in enumerate(self.fitters)]
+        outcomes = race(tasks, score, self.cancel_delta, self.min_nfev, self.workers)
+
+        rows = []
+        for index, result, status, value in outcomes:
+            label = self.labels[index]
+            if status == "cancelled":
+                status = "cancelled at {} {:.6g}".format(self.criterion.upper(), value)
+            row = {"model": label, "status": status}
+            if result is None or status.startswith("cancelled"): # the statistics of an aborted fit are not calculated
+                row.update({"nvarys": np.nan, "chisqr": np.nan, "redchi": np.nan, "aic": np.nan, "bic": np.nan,
+                            "nfev": result.nfev if result is not None else 0})
+            else:
+                row.update({"nvarys": result.nvarys, "chisqr": result.chisqr, "redchi": result.redchi,
+                            "aic": result.aic, "bic": result.bic, "nfev": result.nfev})
+                model = self.fitters[index].model
+                model.params = result.params # the worker fitted a copy
+                self.results[label] = result
+                self.curves[label] = model.normalised()
+            rows.append(row)
+        summary = pd.DataFrame(rows).set_index("model")
+        summary["delta"] = summary[self.criterion] - summary[self.criterion].min()
+        likelihood = np.exp(-summary["delta"]/2)
+        summary["weight"] = likelihood/likelihood.sum()
+        self.summary = summary.sort_values(self.criterion)
+        if not self.results:
+            raise ValueError("None of the {} candidate models could be fitted".format(len(self.fitters)))
+        self.logger.info("Best model by {}: {}.".format(self.criterion.upper(), self.summary.index[0]))
+        self.logger.info(self.summary[["status", "nvarys", "chisqr", self.criterion, "delta", "weight"]].to_string())
+        return self.summary
@@ -0,0 +1,81 @@
+import numpy as np
+from Jacobian import trace, array_source, compile_source
+
+
+class Sensitivity:
+    """ODE function augmented with its forward sensitivity equations
+
+    For the system dy/dt = f(t, y, p), the sensitivities S = dy/dp obey
+    dS/dt = df/dy S + df/dp, with S(0) = 0 since y0 does not depend on the parameters.
+    The augmented state is y followed by S flattened row-major, S[i, k] = dy_i/dp_k.
+
+    The augmented right-hand side and its exact jacobian are derived by tracing the ODE
+    function with sympy symbols. Both take the arguments (t, z, p), where p is a flat array of
+    the parameter values in the order of param_names.
+    """
+
+    def __init__(self, p_ode_f, p_param_names, p_n_states):
+        self.param_names = list(p_param_names)
+        self.n_states = p_n_states
+        self.n_params = len(self.param_names)
+        self.source = self.generate(p_ode_f)
+
+    @property
+    def source(self):
+        return self._source
+
+    @source.setter
+    def source(self, value):
+        if not isinstance(value, str):
+            raise ValueError("source must be of type string")
+        else:
+            self._source = value
+            self._compile()
+
+    def _compile(self):
+        self.rhs = compile_source("rhs", self._source)
+        self.jac = compile_source("jac", self._source)
+
+    def generate(self, ode_f):
+        """Traces the ODE function and returns the source of the augmented rhs and jac functions"""
+        import sympy
+
+        t, y, p, rhs = trace(ode_f, self.param_names, self.n_states)
+        n, m = self.n_states, self.n_params
+        s = sympy.symbols("s0:{}".format(n*m))
+        aug = list(rhs)
+        for i in range(n):
+            for k in range(m):
+                aug.append(sum(rhs[i].diff(y[j])*s[j*m + k] for j in range(n)) + rhs[i].diff(p[k]))
+        z = list(y) + list(s)
+        size = len(z)
+        rhs_source = array_source("rhs", (size,), [((i,), expr) for i, expr in enumerate(aug)], z, p)
+        jac_entries = [((i, j), aug[i].diff(z[j])) for i in range(size) for j in range(size)]
+        jac_source = array_source("jac", (size, size), jac_entries, z, p)
+        return rhs_source + "\n\n" + jac_source
+
+    def z0(self, y0):
+        """Returns the augmented initial values for the initial values of the ODE"""
+        return np.concatenate([np.asarray(y0, dtype=float), np.zeros(self.n_states*self.n_params)])
+
+    def split(self, z):
+        """Splits an augmented solution with shape (n_aug, n_times) into the solution,
+        with shape (n_states, n_times), and sensitivities, with shape (n_states, n_params, n_times)"""
+        y = z[:self.n_states]
+        s = z[self.n_states:].reshape(self.n_states, self.n_params, -1)
+        return y, s
+
+    def pack(self, params):
+        """Packs lmfit Parameters into the flat parameter array taken by rhs and jac"""
+        return np.array([params[name].value for name in self.param_names], dtype=float)
+
+    def __getstate__(self):
+        # the compiled functions cannot be pickled, they are rebuilt from the source
+        state = self.__dict__.copy()
+        del state["rhs"]
+        del state["jac"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._compile()
@@ -0,0 +1,151 @@
+import os
+import json
+import sqlite3
+import hashlib
+import contextlib
+import pandas as pd
+from datetime import datetime
+from Logger import setup_logger
+
+script_path = os.path.dirname(os.path.abspath(__file__))
+default_path = os.path.join(script_path, 'cache', 'results.sqlite')
+version = "1" # bump when the stored results or the key change, so older fits are no longer reused
+
+# configuration sections that do not change the fit, left out of the key
+ignored_sections = ("report", "store")
+
+schema = """
+CREATE TABLE IF NOT EXISTS fits (
+    key TEXT PRIMARY KEY,
+    created TEXT,
+    title TEXT,
+    config_path TEXT,
+    assay_path TEXT,
+    assay_hash TEXT,
+    model_path TEXT,
+    model_hash TEXT,
+    chisqr REAL,
+    redchi REAL,
+    aic REAL,
+    bic REAL,
+    nfev INTEGER,
+    success INTEGER,
+    fit_time REAL,
+    total_time REAL,
+    results TEXT
+);
+CREATE TABLE IF NOT EXISTS params (
+    key TEXT REFERENCES fits(key) ON DELETE CASCADE,
+    name TEXT,
+    value REAL,
+    stderr REAL,
+    PRIMARY KEY (key, name)
+);
+"""
+
+
+def file_hash(path):
+    """Returns the sha256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def input_hashes(config, settings=None):
+    """Returns the hashes identifying the inputs of a loaded Configurator's fit
+
+    settings are the configuration sections hashed, by default all but the ignored sections.
+    """
+    if settings is None:
+        settings = {section: value for section, value in config.config.items() if section not in ignored_sections}
+    settings = json.loads(json.dumps(settings, default=str)) # a copy, without the paths of the hashed files
+    del settings["model"]["func_path"], settings["assay"]["file_path"]
+    return {
+        "config_hash": hashlib.sha256(json.dumps(settings, sort_keys=True, default=str).encode()).hexdigest(),
+        "model_hash": file_hash(config.config["model"]["func_path"]),
+        "assay_hash": config.assay.content_hash()
+    }
+
+
+def input_key(config, settings=None):
+    """Returns a single hash of the inputs of a loaded Configurator's fit, see input_hashes"""
+    inputs = input_hashes(config, settings)
+    parts = [version, inputs["config_hash"], inputs["model_hash"], inputs["assay_hash"]]
+    return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+
+class Store:
+    """A SQLite database of fit results, keyed by a hash of the inputs of the fit
+
+    The key hashes the validated configuration (without the report and store sections and the
+    file paths), the source of the ODE model file and the assay contents, so a fit whose inputs
+    are unchanged is found again even if the files were moved or renamed. The fits table holds one row per fit with its
+    statistics, timings and the results of Results.fit_results as JSON, and the params table
+    one row per parameter, so fits can be compared across plates and model versions with SQL
+    or with table().
+    """
+
+    def __init__(self, p_path=None, p_reuse=True):
+        self.logger = setup_logger("store_logger")
+        self.path = p_path if p_path is not None else default_path
+        self.reuse = p_reuse # False records new fits without returning stored ones
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self.connect() as connection:
+            connection.executescript(schema)
+
+    @contextlib.contextmanager
+    def connect(self):
+        """Opens a connection for one transaction, waiting for other processes (e.g. batch workers) writing to the store"""
+        connection = sqlite3.connect(self.path, timeout=60)
+        try:
+            with connection: # commits, or rolls back if the block raises
+                connection.execute("PRAGMA foreign_keys = ON")
+                yield connection
+        finally:
+            connection.close()
+
+    def inputs(self, config):
+        """Returns the hashes identifying the inputs of a loaded Configurator's fit"""
+        return input_hashes(config)
+
+    def key(self, config):
+        """Returns the key of a loaded Configurator's fit"""
+        return input_key(config)
+
+    def load(self, key):
+        """Returns the stored results under key, or None"""
+        if not self.reuse:
+            return None
+        with self.connect() as connection:
+            row = connection.execute("SELECT results, created FROM fits WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        self.logger.info("Using the stored fit of {}.".format(row[1]))
+        return json.loads(row[0])
+
+    def save(self, key, config, results, fit_time, total_time):
+        """Stores the results of a loaded Configurator's fit under key, replacing an earlier fit with the same inputs"""
+        inputs = self.inputs(config)
+        fit = (key, datetime.now().isoformat(timespec="seconds"), config.config["title"], os.path.abspath(config.config_path),
+               os.path.abspath(config.assay.path), inputs["assay_hash"], os.path.abspath(config.config["model"]["func_path"]),
+               inputs["model_hash"], results["chisqr"], results["redchi"], results["aic"], results["bic"],
+               results["nfev"], int(results["success"]), fit_time, total_time, json.dumps(results))
+        params = [(key, name, param["value"], param["stderr"]) for name, param in results["params"].items()]
+        with self.connect() as connection: # one transaction, so readers never see a fit without its parameters
+            connection.execute("DELETE FROM fits WHERE key = ?", (key,))
+            connection.execute("INSERT INTO fits VALUES ({})".format(", ".join("?"*len(fit))), fit)
+            connection.executemany("INSERT INTO params VALUES (?, ?, ?, ?)", params)
+        self.logger.info("Fit stored in {}.".format(os.path.abspath(self.path)))
+
+    def table(self):
+        """Returns every stored fit, one row each, with columns of its statistics, timings and parameter values and stderrs"""
+        with self.connect() as connection:
+            fits = pd.read_sql_query("SELECT * FROM fits ORDER BY created", connection).drop(columns="results")
+            params = pd.read_sql_query("SELECT * FROM params", connection)
+        if len(params):
+            wide = params.pivot(index="key", columns="name", values=["value", "stderr"])
+            wide.columns = ["{}_{}".format(name, column) for column, name in wide.columns]
+            fits = fits.join(wide[sorted(wide.columns)], on="key")
+        return fits.set_index("key")
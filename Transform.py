@@ -0,0 +1,62 @@
+import copy
+import numpy as np
+
+ln10 = np.log(10)
+
+
+def log_names(params):
+    """Returns the names of the varying parameters configured with scale: log"""
+    return [name for name, param in params.items()
+            if param.vary and not param.expr and (param.user_data or {}).get("scale") == "log"]
+
+
+def to_internal(params, names):
+    """Returns a copy of the parameters with the named ones replaced by their log10, including bounds"""
+    internal = copy.deepcopy(params)
+    for name in names:
+        param = internal[name]
+        if param.min <= 0:
+            raise ValueError("parameter {} must have a positive min to be optimised in log space".format(name))
+        value, lower, upper = param.value, param.min, param.max
+        param.set(min=np.log10(lower), max=np.log10(upper))
+        param.set(value=np.log10(value))
+    return internal
+
+
+def update_natural(natural, internal, names):
+    """Copies the internal parameter values into the natural parameters, undoing the log10 of the named ones"""
+    for name in natural:
+        value = internal[name].value
+        natural[name].value = 10**value if name in names else value
+    return natural
+
+
+def scale_jacobian(jac, natural, var_names, names):
+    """Converts a jacobian with respect to the natural parameters into one with respect to the internal ones"""
+    scale = np.array([ln10*natural[name].value if name in names else 1.0 for name in var_names])
+    return jac*scale
+
+
+def to_natural(result, natural, names):
+    """Converts a MinimizerResult of a fit in internal parameters into natural units
+
+    Values and initial values are transformed back, and stderr and the covariance matrix are
+    propagated to first order, d(10**x) = ln(10) 10**x dx.
+    """
+    internal = result.params
+    params = copy.deepcopy(natural)
+    update_natural(params, internal, names)
+    scale = np.array([ln10*params[name].value if name in names else 1.0 for name in result.var_names])
+    for name, param in params.items():
+        param.init_value = 10**internal[name].init_value if name in names else internal[name].init_value
+        param.correl = internal[name].correl # correlations are unchanged by scaling each parameter
+        param.stderr = internal[name].stderr
+        if name in names and param.stderr is not None:
+            param.stderr = param.stderr*ln10*param.value
+    if getattr(result, "covar", None) is not None:
+        result.covar = result.covar*np.outer(scale, scale)
+    result.params = params
+    result.init_values = {name: params[name].init_value for name in result.var_names}
+    result.init_vals = [params[name].init_value for name in result.var_names]
+    result.best_values = params.valuesdict()
+    return result
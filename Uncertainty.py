@@ -0,0 +1,186 @@
+import os
+import copy
+import numpy as np
+import pandas as pd
+from scipy.stats import chi2
+from concurrent.futures import ProcessPoolExecutor
+from Fitter import Fitter
+from Logger import setup_logger
+
+# per-process state of the uncertainty workers, set up once by init_worker
+worker_state = {}
+
+
+def init_worker(p_fitter, p_params):
+    """Stores the worker's copy of the fitter and the best-fit parameters, the warm start of every refit"""
+    worker_state["fitter"] = p_fitter
+    worker_state["data"] = p_fitter.normalised_data
+    worker_state["params"] = p_params
+
+
+def refit(params, data):
+    """Refits the model against the given normalised data, starting from the given parameters"""
+    fitter = worker_state["fitter"]
+    fitter.normalised_data = data
+    fitter.model.params = params
+    return fitter.fit()
+
+
+def run_task(task):
+    """Runs one bootstrap refit or profile point, in a worker process
+
+    A bootstrap task is ("bootstrap", synthetic data) and returns the refitted parameter values,
+    a profile task is ("profile", name, value) and returns the chi-square with the named
+    parameter fixed at value. Failed refits return None.
+    """
+    params = copy.deepcopy(worker_state["params"])
+    try:
+        if task[0] == "bootstrap":
+            result = refit(params, task[1])
+            return {name: param.value for name, param in result.params.items()}
+        _, name, value = task
+        params[name].set(value=value, vary=False)
+        return getattr(refit(params, worker_state["data"]), "chisqr", None)
+    except Exception: # one failed refit should not stop the rest
+        return None
+
+
+class Uncertainty:
+    """Estimates confidence intervals of the fitted parameters by bootstrap and profile likelihood
+
+    Bootstrap: the weighted residuals of the best fit are resampled with replacement and added
+    to the best-fit curve, and the model is refitted to each synthetic dataset. The interval
+    is given by percentiles of the refitted values.
+
+    Profile likelihood: each varying parameter is fixed at points either side of its best value
+    (spaced logarithmically over span decades for positive parameters, otherwise linearly over
+    span times the larger of the stderr and the value) and the other parameters are refitted. The
+    interval is where the chi-square, scaled by the best reduced chi-square, rises above that of
+    the best fit by the chi-square quantile for one degree of freedom, as in lmfit's conf_interval.
+
+    Every refit starts from the best-fit parameters, and all refits run in one process pool.
+    Unlike the covariance stderr, neither needs the fit to have estimated errors.
+    """
+
+    def __init__(self, p_fitter, p_result, p_bootstrap=100, p_profile_points=10, p_level=0.95, p_workers=0,
+                 p_seed=None, p_span=1.0):
+        self.logger = setup_logger("uncertainty_logger")
+        self.fitter = p_fitter
+        self.result = p_result
+        self.bootstrap = p_bootstrap
+        self.profile_points = p_profile_points
+        self.level = p_level
+        self.workers = p_workers if p_workers > 0 else os.cpu_count()
+        self.seed = p_seed
+        self.span = p_span
+        self.samples = None # bootstrap refitted values, one row per refit
+        self.profiles = {} # name -> table of the fixed values and their chi-square
+        self.table = None
+
+    @property
+    def fitter(self):
+        return self._fitter
+
+    @property
+    def level(self):
+        return self._level
+
+    @fitter.setter
+    def fitter(self, value):
+        if not isinstance(value, Fitter):
+            raise ValueError("fitter must be instance of Fitter class")
+        else:
+            self._fitter = value
+
+    @level.setter
+    def level(self, value):
+        if not 0 < value < 1:
+            raise ValueError("level must be between 0 and 1")
+        else:
+            self._level = value
+
+    @property
+    def var_names(self):
+        return [name for name, param in self.result.params.items() if param.vary and not param.expr]
+
+    def bootstrap_data(self):
+        """Returns the synthetic datasets of the residual bootstrap"""
+        fitter = self.fitter
+        fitter.model.params = copy.deepcopy(self.result.params)
+        curve = fitter.model.normalised()
+        data, noise = fitter.normalised_data, fitter.noise
+        weighted = (data[1:] - curve[1:])/noise[1:] # the first point is not part of the residuals
+        rng = np.random.default_rng(self.seed)
+        datasets = []
+        for _ in range(self.bootstrap):
+            synthetic = data.copy()
+            synthetic[1:] = curve[1:] + noise[1:]*rng.choice(weighted, size=len(weighted))
+            datasets.append(synthetic)
+        return datasets
+
+    def profile_values(self, name):
+        """Returns the values at which the named parameter is fixed for its profile, within its bounds"""
+        param = self.result.params[name]
+        steps = np.linspace(0, self.span, self.profile_points + 1)[1:]
+        if param.value > 0 and param.min >= 0:
+            values = np.concatenate([param.value*10**-steps[::-1], param.value*10**steps])
+        else:
+            scale = max(param.stderr or 0.0, abs(param.value)) or 1.0
+            values = np.concatenate([param.value - scale*steps[::-1], param.value + scale*steps])
+        return np.unique(np.clip(values, param.min, param.max))
+
+    def profile_interval(self, profile):
+        """Returns the interval where the scaled chi-square rise stays below the threshold, nan where the profile does not reach it"""
+        best = self.result.params[profile.name].value
+        threshold = chi2.ppf(self.level, 1)
+        bounds = []
+        for side in (profile[profile.index < best].iloc[::-1], profile[profile.index > best]):
+            side = side.dropna()
+            # the square root of the rise is close to linear in the parameter near the minimum
+            root = np.sqrt(np.maximum((side - self.result.chisqr)/self.result.redchi, 0))
+            crossed = np.nonzero(root.values > np.sqrt(threshold))[0]
+            if len(crossed) == 0:
+                bounds.append(np.nan)
+                continue
+            i = crossed[0] # interpolate between the last point below and the first above the threshold
+            x0, y0 = (best, 0.0) if i == 0 else (root.index[i-1], root.values[i-1])
+            x1, y1 = root.index[i], root.values[i]
+            bounds.append(x0 + (np.sqrt(threshold) - y0)*(x1 - x0)/(y1 - y0))
+        return bounds[0], bounds[1]
+
+    def run(self):
+        """Runs the bootstrap and profile refits, returning a table of the intervals of each varying parameter"""
+        tasks = [("bootstrap", data) for data in self.bootstrap_data()]
+        profile_tasks = [("profile", name, value) for name in self.var_names for value in self.profile_values(name)]
+        self.logger.info("Estimating uncertainty with {} bootstrap and {} profile refits on {} workers.".format(
+            len(tasks), len(profile_tasks), self.workers))
+        fitter = copy.copy(self.fitter) # the workers get the data and parameters of the best fit
+        fitter.model.params = copy.deepcopy(self.result.params)
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                 initargs=(fitter, copy.deepcopy(self.result.params))) as pool:
+            outcomes = list(pool.map(run_task, tasks + profile_tasks))
+        self.fitter.model.params = self.result.params
+
+        samples = [outcome for outcome in outcomes[:len(tasks)] if outcome is not None]
+        self.samples = pd.DataFrame(samples, columns=list(self.result.params))
+        chisqrs = outcomes[len(tasks):]
+        for name in self.var_names:
+            points = [(value, np.nan if chisqr is None else chisqr)
+                      for (_, task_name, value), chisqr in zip(profile_tasks, chisqrs) if task_name == name]
+            self.profiles[name] = pd.Series(dict(points), name=name, dtype=float).sort_index()
+
+        alpha = (1 - self.level)/2
+        rows = []
+        for name in self.var_names:
+            param = self.result.params[name]
+            row = {"parameter": name, "value": param.value, "stderr": param.stderr}
+            if len(self.samples):
+                row["bootstrap_lower"], row["bootstrap_upper"] = np.quantile(self.samples[name], [alpha, 1 - alpha])
+            else:
+                row["bootstrap_lower"], row["bootstrap_upper"] = np.nan, np.nan
+            row["profile_lower"], row["profile_upper"] = self.profile_interval(self.profiles[name])
+            rows.append(row)
+        self.table = pd.DataFrame(rows).set_index("parameter")
+        self.logger.info("{} of {} bootstrap refits succeeded.".format(len(self.samples), len(tasks)))
+        self.logger.info(self.table.to_string())
+        return self.table
@@ -0,0 +1,154 @@
+import os
+import copy
+import json
+import time
+import numpy as np
+import pandas as pd
+from Logger import setup_logger
+
+
+class Watcher:
+    """Refits the model as new cycles are added to an assay file during a plate read
+
+    The assay file is polled every interval seconds. When new cycles have been written, the
+    assay is updated and the model is refitted, warm-started from the parameters of the
+    previous fit. Each fit appends a row of parameter estimates to the output CSV file.
+
+    The 95% confidence interval of each parameter (value +- 1.96 stderr) is compared with the
+    previous fit. Once no interval bound has moved by more than tolerance times the interval
+    width for patience consecutive fits, the estimates are considered stable: a stop signal,
+    the output path with .stop appended, is written with the final estimates and watching ends.
+    Watching also ends when all cycles of the protocol have been read, or when the file has
+    not changed for timeout seconds.
+    """
+
+    def __init__(self, p_config, p_out_path, p_interval=30.0, p_tolerance=0.05, p_patience=3, p_min_cycles=10,
+                 p_timeout=3600.0):
+        self.logger = setup_logger("watcher_logger")
+        self.config = p_config
+        self.out_path = p_out_path
+        self.stop_path = p_out_path + ".stop"
+        self.interval = p_interval
+        self.tolerance = p_tolerance
+        self.patience = p_patience
+        self.min_cycles = p_min_cycles
+        self.timeout = p_timeout
+        self.initial_params = copy.deepcopy(p_config.model.params) # configured initial guesses, for cold starts
+        self.result = None
+        self.intervals = None # confidence intervals of the previous fit
+        self.stable_fits = 0
+        self.rows = 0
+
+    @property
+    def assay(self):
+        return self.config.assay
+
+    def stat(self):
+        """Returns the size and modification time of the assay file, to detect changes without reading it"""
+        stat = os.stat(self.assay.path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def poll(self):
+        """Waits for the assay file to change and reads the new cycles, returning False on timeout"""
+        last_stat, changed = self.stat(), time.monotonic()
+        while True:
+            time.sleep(self.interval)
+            stat = self.stat()
+            if stat != last_stat:
+                last_stat, changed = stat, time.monotonic()
+                try:
+                    if self.assay.update() > 0:
+                        return True
+                except Exception as exc: # the file may be read while it is being written
+                    self.logger.info("Could not read assay file, retrying ({}).".format(exc))
+            elif self.timeout is not None and time.monotonic() - changed > self.timeout:
+                self.logger.info("Assay file unchanged for {} s, stopping.".format(self.timeout))
+                return False
+
+    def refit(self):
+        """Fits the model to all cycles read so far, warm-started from the previous fit
+
+        A warm-started fit that fails to estimate errors, e.g. after wandering off from an
+        estimate of the first few cycles, is repeated from the configured initial guesses.
+        """
+        model = self.config.model
+        model.time = self.assay.time
+        self.config.fitter = self.config.make_fitter()
+        if self.result is not None:
+            model.params = copy.deepcopy(self.result.params)
+            result = self.config.fitter.fit()
+            if result.errorbars:
+                self.result = result
+                return result
+            self.logger.info("Warm-started fit failed to estimate errors, refitting from the initial guesses.")
+        model.params = copy.deepcopy(self.initial_params)
+        multistart = self.config.make_multistart()
+        self.result = multistart.fit() if multistart is not None else self.config.fitter.fit()
+        return self.result
+
+    def confidence_intervals(self, result):
+        """Returns the 95% confidence intervals of the varying parameters, or None without error estimates"""
+        params = [result.params[name] for name in result.var_names]
+        if any(param.stderr is None for param in params):
+            return None
+        value = np.array([param.value for param in params])
+        half_width = 1.96*np.array([param.stderr for param in params])
+        return np.column_stack([value - half_width, value + half_width])
+
+    def update_stability(self, result):
+        """Compares the confidence intervals with the previous fit, returning True once they have stabilised"""
+        intervals = self.confidence_intervals(result)
+        if intervals is None or self.intervals is None:
+            self.stable_fits = 0
+        else:
+            width = intervals[:, 1] - intervals[:, 0]
+            moved = np.abs(intervals - self.intervals).max(axis=1)
+            self.stable_fits = self.stable_fits + 1 if np.all(moved <= self.tolerance*width) else 0
+        self.intervals = intervals
+        return self.stable_fits >= self.patience
+
+    def write_row(self, result, stable):
+        """Appends the estimates of a fit to the output file"""
+        row = {"cycles": self.assay.cycles, "time": self.assay.time[-1]}
+        for name, param in result.params.items():
+            row[name] = param.value
+            row[name + "_stderr"] = param.stderr
+        row.update({"chisqr": getattr(result, "chisqr", np.nan), "redchi": getattr(result, "redchi", np.nan),
+                    "nfev": result.nfev, "integration_failures": getattr(result, "integration_failures", 0),
+                    "stable": stable})
+        pd.DataFrame([row]).to_csv(self.out_path, mode='w' if self.rows == 0 else 'a', header=self.rows == 0,
+                                   index=False)
+        self.rows += 1
+        return row
+
+    def write_stop(self, row):
+        """Writes the stop signal, holding the final estimates"""
+        tmp_path = "{}.{}.tmp".format(self.stop_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({key: value.item() if isinstance(value, np.generic) else value for key, value in row.items()},
+                      f, indent=2)
+        os.replace(tmp_path, self.stop_path) # atomic, so a reader never sees a partial signal
+
+    def run(self):
+        """Watches the assay file, refitting on new cycles until the estimates are stable, returning the last result"""
+        if os.path.exists(self.stop_path):
+            os.remove(self.stop_path)
+        self.logger.info("Watching {}.".format(self.assay.path))
+        while True:
+            if self.assay.cycles >= self.min_cycles:
+                begin = time.perf_counter()
+                result = self.refit()
+                stable = self.update_stability(result)
+                row = self.write_row(result, stable)
+                self.logger.info("Fitted {} cycles in {:.2f} s, {} function evaluations.".format(
+                    self.assay.cycles, time.perf_counter() - begin, result.nfev))
+                if stable:
+                    self.logger.info("Confidence intervals stable for {} fits, stopping.".format(self.patience))
+                    self.write_stop(row)
+                    break
+            if self.assay.protocol_cycles is not None and self.assay.cycles >= self.assay.protocol_cycles:
+                self.logger.info("All {} cycles read, stopping.".format(self.assay.protocol_cycles))
+                break
+            if not self.poll():
+                break
+        return self.result
@@ -0,0 +1,86 @@
+import re
+import numpy as np
+
+# a single well (C3, AF48) or a rectangular range of wells (C3:G4, A10:H12)
+selector_regex = r'^([A-Z]{1,2})(\d{1,2})(?::([A-Z]{1,2})(\d{1,2}))?$'
+
+
+def row_index(letters):
+    """Converts a row label into its index, A-Z are rows 0-25 and AA-AF rows 26-31 of a 1536 well plate"""
+    index = 0
+    for letter in letters:
+        index = index*26 + ord(letter) - ord('A') + 1
+    return index - 1
+
+
+def row_label(index):
+    """Converts a row index into its label, the inverse of row_index"""
+    label = ""
+    index += 1
+    while index > 0:
+        index, rest = divmod(index - 1, 26)
+        label = chr(ord('A') + rest) + label
+    return label
+
+
+class Wells:
+    """Compiles well selection strings into index arrays for a plate of the given size
+
+    A selector is a single well (C3) or a rectangular range from its top left to its bottom
+    right well (C3:G4), rows are labelled A-Z then AA-AF, columns are numbered from 1. Each
+    selector is compiled once into an array of flat well indices, row*cols + col, in
+    row-major order, which index assay.well or the flattened assay.matrix. A list of
+    selectors is gathered with a single fancy index.
+    """
+
+    def __init__(self, p_rows, p_cols):
+        self.rows = p_rows
+        self.cols = p_cols
+        self.compiled = {} # selector -> flat well indices
+
+    def compile(self, selector):
+        """Returns the flat indices of the wells of a selector"""
+        selector = selector.upper()
+        if selector in self.compiled:
+            return self.compiled[selector]
+        match = re.match(selector_regex, selector)
+        if not match:
+            raise ValueError("Invalid well selection: {}".format(selector))
+        start_row, start_col = row_index(match.group(1)), int(match.group(2)) - 1
+        end_row, end_col = start_row, start_col
+        if match.group(3): # selection is a range
+            end_row, end_col = row_index(match.group(3)), int(match.group(4)) - 1
+        if end_row < start_row or end_col < start_col:
+            raise ValueError("Well selection {} must go from the top left to the bottom right well".format(selector))
+        if start_col < 0 or end_row >= self.rows or end_col >= self.cols:
+            raise ValueError("Well selection {} is outside of the plate".format(selector))
+        rows = np.arange(start_row, end_row + 1)
+        cols = np.arange(start_col, end_col + 1)
+        indices = (rows[:, np.newaxis]*self.cols + cols).ravel()
+        indices.flags.writeable = False # shared between callers
+        self.compiled[selector] = indices
+        return indices
+
+    def index(self, selectors):
+        """Returns the flat indices of the wells of a list of selectors"""
+        return np.concatenate([self.compile(selector) for selector in selectors])
+
+    def label(self, index):
+        """Returns the label of the well with the given flat index, e.g. C3"""
+        row, col = divmod(int(index), self.cols)
+        return "{}{}".format(row_label(row), col + 1)
+
+    def expand(self, selector):
+        """Returns a list of (label, flat index) pairs for the wells of a selector"""
+        return [(self.label(index), index) for index in self.compile(selector)]
+
+    def gather(self, matrix, selectors):
+        """Returns the timelines of the selected wells, with shape (n_wells, cycles), from a (rows, cols, cycles) matrix"""
+        return matrix.reshape(self.rows*self.cols, -1)[self.index(selectors)]
+
+    def average(self, matrix, selectors):
+        """Returns the average timeline of the selected wells"""
+        wells = self.gather(matrix, selectors)
+        if np.isnan(wells).any():
+            raise ValueError("One or more selected wells contains a nan value")
+        return wells.mean(axis=0)
@@ -0,0 +1,47 @@
+"""Compares the load time of an assay workbook with the bulk and the legacy reader, and from the assay cache
+
+Checks that every load gives the same time, well and matrix arrays. Run from the repository root:
+    python -m benchmarks.assay_benchmark [-c examples/4_param_config.yaml] [-r 5]
+"""
+import time
+import argparse
+import yaml
+import numpy as np
+from Assay import Assay
+from config_schema import config_schema
+
+
+def load(assay_config, reader, repeats, cache=False):
+    """Loads the assay repeatedly, returning the last assay and the best load time"""
+    best = np.inf
+    for _ in range(repeats):
+        begin = time.perf_counter()
+        assay = Assay(assay_config["file_path"], assay_config["cols"], assay_config["rows"], reader, cache)
+        best = min(best, time.perf_counter() - begin)
+    return assay, best
+
+
+def main(args):
+    with open(args.config_f, 'r') as f:
+        assay_config = config_schema.validate(yaml.safe_load(f))["assay"]
+    bulk, bulk_time = load(assay_config, "bulk", args.repeats)
+    legacy, legacy_time = load(assay_config, "legacy", args.repeats)
+    load(assay_config, "bulk", 1, cache=True) # make sure the cache entry exists
+    cached, cached_time = load(assay_config, "bulk", args.repeats, cache=True)
+    same = all(np.array_equal(getattr(bulk, name), getattr(other, name), equal_nan=True)
+               for other in (legacy, cached) for name in ("time", "well", "matrix"))
+    print("{} wells x {} cycles".format(bulk.well.shape[0], bulk.cycles))
+    print("{:>8}{:>12}".format("reader", "load (s)"))
+    print("{:>8}{:>12.4f}".format("legacy", legacy_time))
+    print("{:>8}{:>12.4f}".format("bulk", bulk_time))
+    print("{:>8}{:>12.4f}".format("cached", cached_time))
+    print("bulk speedup {:.1f}x, cached speedup {:.1f}x, identical arrays: {}".format(
+        legacy_time/bulk_time, legacy_time/cached_time, same))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the bulk against the legacy assay reader.")
+    parser.add_argument('-c', '--config', dest='config_f', default='examples/4_param_config.yaml', help='Path to yaml configuration file.')
+    parser.add_argument('-r', '--repeats', dest='repeats', type=int, default=5, help='Number of loads per reader, the best time is reported.')
+    args = parser.parse_args()
+    main(args)
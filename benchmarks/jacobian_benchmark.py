@@ -0,0 +1,126 @@
+"""Compares finite-difference and analytic jacobians for the stiff integrators
+
+Also compares the finite-difference jacobian of the residuals with the perturbed models solved
+one after another and solved together as one stacked system (jacobian_executor: batch), by
+time and by error against a reference solved at much tighter tolerances. Run from the repository root:
+    python -m benchmarks.jacobian_benchmark [-c examples/4_param_config.yaml] [-r 5]
+"""
+import argparse
+import time
+import numpy as np
+from Configurator import Configurator
+from Jacobian import Jacobian
+
+
+class CountingRHS:
+    """Wraps the ODE function to count every evaluation, including those solve_ivp makes
+    while building a finite-difference jacobian (which are not included in sol.nfev)"""
+
+    def __init__(self, p_ode_f):
+        self.ode_f = p_ode_f
+        self.calls = 0
+
+    def __call__(self, t, y, params):
+        self.calls += 1
+        return self.ode_f(t, y, params)
+
+
+def time_integrate(model, repeats):
+    """Returns the best wall time over the repeats, and the solver statistics of the last run"""
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        sol = model.solve() # bypasses the solution cache
+        best = min(best, time.perf_counter() - start)
+    return best, sol
+
+
+def time_fit(config, repeats):
+    """Returns the best wall time of a full fit over the repeats, and the last fit result"""
+    best = float("inf")
+    for _ in range(repeats):
+        config.model.params = config.make_model().params # reset to the initial guess
+        config.model.clear_cache() # each repeat solves from scratch
+        start = time.perf_counter()
+        result = config.fitter.fit()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def residual_jacobians(config, params, repeats):
+    """Returns the best wall time and the finite-difference jacobian of the residuals, per way of solving the perturbed models"""
+    fitter, model = config.fitter, config.model
+    var_names = [name for name, param in params.items() if param.vary and not param.expr]
+
+    def serial(rel_step=fitter.fd_step):
+        model.clear_cache()
+        base = fitter.residuals(params)
+        columns = []
+        for name in var_names:
+            values = params.valuesdict()
+            step = rel_step*abs(values[name]) if values[name] != 0 else rel_step
+            values[name] += step
+            columns.append((fitter.copy_residuals(values) - base)/step)
+        return np.column_stack(columns)
+
+    def batch():
+        model.clear_cache()
+        fitter.jacobian_executor = "batch"
+        return fitter.fd_jacobian(params)
+
+    jacobians = {}
+    for name, func in (("one by one", serial), ("stacked", batch)):
+        best = float("inf")
+        for _ in range(repeats):
+            start = time.perf_counter()
+            jac = func()
+            best = min(best, time.perf_counter() - start)
+        jacobians[name] = (best, jac)
+    atol, rtol = model.atol, model.rtol
+    model.atol, model.rtol = atol*1e-4, 1e-11 # the reference, with a larger step against the smaller solver error
+    reference = serial(1e-4)
+    model.atol, model.rtol = atol, rtol
+    scale = np.abs(reference).max(axis=0)
+    return {name: (best, np.abs(jac - reference).max(axis=0)/scale) for name, (best, jac) in jacobians.items()}
+
+
+def main(args):
+    config = Configurator(args.config_f)
+    model = config.model
+    jac = Jacobian(model.ode_f, list(model.params), len(model.y0))
+    counter = CountingRHS(model.ode_f)
+    model.ode_f = counter
+
+    rows = []
+    for name, mode_jac in (("finite difference", None), ("analytic", jac)):
+        model.jac = mode_jac
+        counter.calls = 0
+        fit_time, _ = time_fit(config, args.repeats)
+        fit_calls = counter.calls // args.repeats
+        # integrate at the fitted parameters
+        int_time, sol = time_integrate(model, args.repeats)
+        counter.calls = 0
+        model.solve()
+        rows.append((name, counter.calls, sol.nfev, sol.njev, sol.nlu, int_time, fit_calls, fit_time))
+
+    print("{:<20}{:>10}{:>10}{:>10}{:>10}{:>14}{:>12}{:>10}".format(
+        "jacobian", "rhs calls", "nfev", "njev", "nlu", "integrate (s)", "fit calls", "fit (s)"))
+    for row in rows:
+        print("{:<20}{:>10}{:>10}{:>10}{:>10}{:>14.4f}{:>12}{:>10.4f}".format(*row))
+
+    # finite-difference jacobian of the residuals at the fitted parameters
+    model.ode_f = counter.ode_f
+    model.jac = None
+    errors = residual_jacobians(config, model.params, args.repeats)
+    print()
+    print("{:<20}{:>14}  {}".format("perturbed solves", "jacobian (s)", "relative error per parameter"))
+    for name, (best, error) in errors.items():
+        print("{:<20}{:>14.4f}  {}".format(name, best, " ".join("{:.1e}".format(e) for e in error)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark analytic against finite-difference jacobians.")
+    parser.add_argument('-c', '--config', dest='config_f', default='examples/4_param_config.yaml', help='Path to yaml configuration file.')
+    parser.add_argument('-r', '--repeats', dest='repeats', type=int, default=3, help='Number of timed repeats.')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,56 @@
+"""Compares fits with the parameters optimised on a linear scale and in log10 space
+
+Every fit starts from the same Latin hypercube starting points, so both scales see the same
+problems. Run from the repository root:
+    python -m benchmarks.log_scale_benchmark [-c examples/4_param_config.yaml] [-n 8]
+"""
+import copy
+import time
+import logging
+import argparse
+import numpy as np
+from Configurator import Configurator
+from MultiStart import MultiStart
+
+
+def fit_from(fitter, params, start, scale):
+    """Fits from the starting values with every varying parameter on the given scale"""
+    params = copy.deepcopy(params)
+    for name, value in start.items():
+        params[name].value = value
+        params[name].user_data = {"scale": scale}
+    fitter.model.params = params
+    fitter.model.clear_cache() # the other scale's fit from this start would otherwise be reused
+    begin = time.perf_counter()
+    result = fitter.fit()
+    return result.nfev, result.chisqr, time.perf_counter() - begin
+
+
+def main(args):
+    config = Configurator(args.config_f)
+    logging.disable(logging.INFO) # silence the per-fit logging
+    fitter = config.fitter
+    params = copy.deepcopy(fitter.model.params)
+    starts = MultiStart(fitter, args.starts, p_seed=args.seed).sample()
+    if args.init_guess:
+        starts.insert(0, {name: params[name].value for name in starts[0]})
+
+    print("{:>6}{:>12}{:>14}{:>12}{:>12}{:>14}{:>12}".format(
+        "start", "linear nfev", "linear chisqr", "linear (s)", "log nfev", "log chisqr", "log (s)"))
+    totals = np.zeros(6)
+    for i, start in enumerate(starts):
+        row = fit_from(fitter, params, start, "linear") + fit_from(fitter, params, start, "log")
+        totals += row
+        print("{:>6}{:>12}{:>14.5g}{:>12.3f}{:>12}{:>14.5g}{:>12.3f}".format(i, *row))
+    means = totals/len(starts)
+    print("{:>6}{:>12.1f}{:>14.5g}{:>12.3f}{:>12.1f}{:>14.5g}{:>12.3f}".format("mean", *means))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark log10-space against linear parameter optimisation.")
+    parser.add_argument('-c', '--config', dest='config_f', default='examples/4_param_config.yaml', help='Path to yaml configuration file.')
+    parser.add_argument('-n', '--starts', dest='starts', type=int, default=8, help='Number of Latin hypercube starting points.')
+    parser.add_argument('-s', '--seed', dest='seed', type=int, default=0, help='Random seed for the starting points.')
+    parser.add_argument('--no-init-guess', dest='init_guess', action='store_false', help='Do not include the configured initial guess as a start.')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,184 @@
+"""Times assay loading, integration, fitting and reporting on synthetic plates, and checks the fits recover the true parameters
+
+Each case is an example model on a plate of the given size and number of cycles, generated by
+benchmarks.synthetic. The results are written to cache/benchmarks/results.json and compared with
+a baseline of an earlier run on the same machine: a stage more than --tolerance slower than in the
+baseline is flagged, as is a fit that does not recover the true parameters, and the command then
+exits with status 1. Run from the repository root:
+    python -m benchmarks.suite [-m 4_param] [-w 96 384] [-n 200] [--no-report] [--save-baseline]
+"""
+import os
+import sys
+import copy
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import itertools
+from datetime import datetime
+import numpy as np
+from Assay import Assay
+from Configurator import Configurator
+from benchmarks.synthetic import generate, models, plates, script_path
+
+results_dir = os.path.join(script_path, 'cache', 'benchmarks')
+
+
+def best_time(func, repeats):
+    """Returns the best wall time of func over the repeats, and its last return value"""
+    best = np.inf
+    for _ in range(repeats):
+        begin = time.perf_counter()
+        value = func()
+        best = min(best, time.perf_counter() - begin)
+    return best, value
+
+
+def recovery(config, fit, truth, rtol, sigmas):
+    """Compares the fitted parameters with the true ones
+
+    A parameter is recovered if it is within rtol of the true value, or within sigmas standard
+    errors for parameters the data barely constrain. The fit must also reach a chi-square no
+    higher than that of the true parameters, i.e. the optimum the data define.
+    """
+    params = {}
+    for name, value in truth.items():
+        fitted, stderr = fit.params[name].value, fit.params[name].stderr
+        error = abs(fitted - value)
+        tolerance = max(rtol*abs(value), sigmas*stderr if stderr is not None else 0.0)
+        params[name] = {"true": value, "fitted": fitted, "stderr": stderr, "rel_error": error/abs(value),
+                        "recovered": bool(error <= tolerance)}
+    true_params = copy.deepcopy(fit.params)
+    for name, value in truth.items():
+        true_params[name].value = value
+    true_chisqr = float(np.sum(config.fitter.residuals(true_params)**2))
+    config.model.params = fit.params # residuals set the model to the true parameters
+    return {"params": params, "chisqr": fit.chisqr, "true_chisqr": true_chisqr,
+            "recovered": bool(fit.success and all(param["recovered"] for param in params.values())
+                              and fit.chisqr <= true_chisqr*(1 + 1e-6))}
+
+
+def run_case(model, wells, cycles, args):
+    """Generates a plate and times each stage on it, returning the timings and the parameter recovery"""
+    assay_path, config_path, truth = generate(model, wells, cycles, noise=args.noise, seed=args.seed,
+                                              guess_factor=args.guess_factor)
+    config = Configurator(config_path)
+    assay_config = config.config["assay"]
+    timings = {}
+    timings["assay_load"], _ = best_time(lambda: Assay(assay_path, assay_config["cols"], assay_config["rows"],
+                                                       assay_config["reader"]), args.repeats)
+
+    ode_model = config.model
+    initial = copy.deepcopy(ode_model.params)
+    true_params = copy.deepcopy(initial)
+    for name, value in truth.items():
+        true_params[name].value = value
+    ode_model.params = true_params
+    timings["integrate"], _ = best_time(ode_model.solve, args.repeats) # without the solution cache
+
+    def fit():
+        ode_model.params = copy.deepcopy(initial)
+        ode_model.clear_cache() # each repeat solves from scratch
+        return config.fitter.fit()
+    timings["fit"], result = best_time(fit, args.repeats)
+    checks = recovery(config, result, truth, args.rtol, args.sigmas)
+
+    if args.report:
+        from Report import Report
+        report_config = config.config["report"]
+        model_sol = ode_model.normalised()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            out = os.path.join(tmp_dir, "report.pdf")
+            report = Report(config.config["title"], config.fitter.normalised_data, config.assay.time, model_sol,
+                            result, config.fitter.mini, out, p_image_format=report_config["format"],
+                            p_dpi=report_config["dpi"], p_workers=report_config["workers"])
+            timings["report"], _ = best_time(report.generate_pdf, args.repeats)
+    return {"model": model, "wells": wells, "cycles": cycles, "format": os.path.splitext(assay_path)[1][1:],
+            "timings": timings, "nfev": result.nfev, **checks}
+
+
+def compare(results, baseline, tolerance, min_delta):
+    """Prints each stage's time against the baseline, returning the (case, stage) pairs that slowed down
+
+    A stage has slowed down if it takes more than tolerance (relative) and min_delta seconds longer than in the baseline.
+    """
+    slower = []
+    print("{:<26}{:>12}{:>12}{:>12}{:>8}".format("case", "stage", "baseline", "current", "ratio"))
+    for case, result in results["cases"].items():
+        base_case = baseline["cases"].get(case)
+        for stage, current in result["timings"].items():
+            base = base_case["timings"].get(stage) if base_case is not None else None
+            if base is None:
+                print("{:<26}{:>12}{:>12}{:>12.4f}{:>8}".format(case, stage, "-", current, "-"))
+                continue
+            flag = current > base*(1 + tolerance) and current - base > min_delta
+            if flag:
+                slower.append((case, stage))
+            print("{:<26}{:>12}{:>12.4f}{:>12.4f}{:>8.2f}{}".format(case, stage, base, current, current/base,
+                                                                   "  SLOWER" if flag else ""))
+    return slower
+
+
+def main(args):
+    logging.disable(logging.INFO) # the loggers of the fitting classes would drown the tables
+    results = {"created": datetime.now().isoformat(timespec="seconds"), "python": platform.python_version(),
+               "machine": platform.platform(), "repeats": args.repeats, "cases": {}}
+    for model, wells, cycles in itertools.product(args.models, args.wells, args.cycles):
+        case = "{}_{}w_{}c".format(model, wells, cycles)
+        print("Running {}.".format(case), flush=True)
+        results["cases"][case] = run_case(model, wells, cycles, args)
+
+    print("{:<26}{:>8}{:>14}{:>14}{:>14}{:>14}{:>10}".format("case", "format", "load (s)", "integrate (s)", "fit (s)",
+                                                           "report (s)", "recovered"))
+    for case, result in results["cases"].items():
+        timings = result["timings"]
+        print("{:<26}{:>8}{:>14.4f}{:>14.4f}{:>14.4f}{:>14}{:>10}".format(
+            case, result["format"], timings["assay_load"], timings["integrate"], timings["fit"],
+            "{:.4f}".format(timings["report"]) if "report" in timings else "-", str(result["recovered"])))
+        for name, param in result["params"].items():
+            if not param["recovered"]:
+                print("  {} = {:.4g}, true {:.4g} ({:.0%} off)".format(name, param["fitted"], param["true"], param["rel_error"]))
+        if result["chisqr"] > result["true_chisqr"]*(1 + 1e-6):
+            print("  chi-square {:.1f}, {:.1f} at the true parameters".format(result["chisqr"], result["true_chisqr"]))
+
+    os.makedirs(results_dir, exist_ok=True)
+    with open(os.path.join(results_dir, "results.json"), 'w') as f:
+        json.dump(results, f, indent=2)
+    failed = [case for case, result in results["cases"].items() if not result["recovered"]]
+    slower = []
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Baseline saved at: {}".format(args.baseline))
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        print("Compared with the baseline of {}:".format(baseline["created"]))
+        slower = compare(results, baseline, args.tolerance, args.min_delta)
+    else:
+        print("No baseline at {}, save one with --save-baseline.".format(args.baseline))
+    if failed or slower:
+        print("{} cases did not recover the true parameters, {} stages slowed down.".format(len(failed), len(slower)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark loading, integration, fitting and reporting on synthetic plates.")
+    parser.add_argument('-m', '--models', dest='models', nargs='+', default=list(models), choices=list(models), help='Example models to generate plates from.')
+    parser.add_argument('-w', '--wells', dest='wells', nargs='+', type=int, default=list(plates), choices=list(plates), help='Plate sizes.')
+    parser.add_argument('-n', '--cycles', dest='cycles', nargs='+', type=int, default=[200, 1000], help='Numbers of cycles.')
+    parser.add_argument('-r', '--repeats', dest='repeats', type=int, default=3, help='Number of runs of each stage, the best time is kept.')
+    parser.add_argument('--noise', dest='noise', type=float, default=0.01, help='Standard deviation of the readings, relative to the full signal.')
+    parser.add_argument('--seed', dest='seed', type=int, default=0, help='Seed of the noise.')
+    parser.add_argument('-g', '--guess-factor', dest='guess_factor', type=float, default=0.5, help='Initial guesses, relative to the true parameters.')
+    parser.add_argument('--no-report', dest='report', action='store_false', help='Skip timing the PDF report.')
+    parser.add_argument('--rtol', dest='rtol', type=float, default=0.5, help='Relative error within which a parameter counts as recovered.')
+    parser.add_argument('--sigmas', dest='sigmas', type=float, default=3.0, help='Standard errors within which a parameter counts as recovered.')
+    parser.add_argument('--baseline', dest='baseline', default=os.path.join(results_dir, 'baseline.json'), help='Results of an earlier run to compare with.')
+    parser.add_argument('--save-baseline', dest='save_baseline', action='store_true', help='Save the results as the baseline instead of comparing with it.')
+    parser.add_argument('-t', '--tolerance', dest='tolerance', type=float, default=0.25, help='Relative slowdown of a stage that is flagged.')
+    parser.add_argument('--min-delta', dest='min_delta', type=float, default=0.05, help='Slowdowns of fewer seconds are not flagged.')
+    args = parser.parse_args()
+    main(args)
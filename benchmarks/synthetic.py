@@ -0,0 +1,189 @@
+"""Generates synthetic CLARIOstar plates from the example models with known parameters
+
+Row A holds control wells at the full signal, every other well follows the normalised product
+curve of the model at the true parameters, each with its own gaussian noise. The plate is written
+as a CLARIOstar .xls export (needs xlwt) or, for plates too large for an .xls sheet, as a .csv
+file, together with a configuration fitting wells B1:B5 against A1:A5 from perturbed initial
+guesses. Run from the repository root:
+    python -m benchmarks.synthetic [-m 4_param] [-w 384] [-n 500] [-o cache/benchmarks/data]
+"""
+import os
+import argparse
+import yaml
+import numpy as np
+from scipy.integrate import solve_ivp
+from Model import load_ode_f
+from Wells import row_label
+
+script_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+default_dir = os.path.join(script_path, 'cache', 'benchmarks', 'data')
+
+# plate sizes by number of wells, as (rows, cols)
+plates = {96: (8, 12), 384: (16, 24), 1536: (32, 48)}
+
+# the example models, with true parameters whose curves approach completion over the default duration
+models = {
+    "1_param": {"func_path": os.path.join(script_path, 'examples', '1_param_ode.py'),
+                "params": {"k": 2.5e4},
+                "y0": [5.0e-9, 20.0e-9, 0.0]},
+    "3_param": {"func_path": os.path.join(script_path, 'examples', '3_param_ode.py'),
+                "params": {"k_plus": 5.0e4, "k_minus": 1.0e-3, "k": 2.0e-3},
+                "y0": [5.0e-9, 20.0e-9, 0.0, 0.0]},
+    "4_param": {"func_path": os.path.join(script_path, 'examples', '4_param_ode.py'),
+                "params": {"kb1": 1.0e-3, "kb2": 2.0e-3, "kh_plus": 200.0, "kh_minus": 2.0e5},
+                "y0": [20.0e-9, 5000.0e-9, 5.0e-9, 0.0, 0.0, 0.0]}
+}
+max_value = 5.0e-9
+signal = 60000.0 # reading of a well at the full product concentration
+xls_rows = 65536 # rows of an .xls sheet
+xls_cols = 256
+
+
+def cycle_string(index, seconds):
+    """Returns the CLARIOstar time string of a cycle, e.g. Cycle 2 (1 min 15 s) or Cycle 40 (1 h 2 min)"""
+    hours, rest = divmod(int(seconds), 3600)
+    minutes, seconds = divmod(rest, 60)
+    parts = (["{} h".format(hours)] if hours else []) + ["{} min".format(minutes)] + (["{} s".format(seconds)] if seconds else [])
+    return "Cycle {} ({})".format(index + 1, " ".join(parts))
+
+
+def fits_xls(wells, cycles):
+    """Returns whether a plate fits an .xls DATA sheet"""
+    rows, cols = plates[wells]
+    return 12 + (rows + 4)*cycles <= xls_rows and cols + 1 <= xls_cols
+
+
+def simulate(model, time):
+    """Returns the normalised product curve of an example model at its true parameters"""
+    spec = models[model]
+    ode_f = load_ode_f(spec["func_path"])
+    sol = solve_ivp(ode_f, (time[0], time[-1]), spec["y0"], t_eval=time, args=(spec["params"],),
+                    method="Radau", rtol=1e-10, atol=1e-16)
+    return sol.y[-1]/max_value
+
+
+def readings(model, wells, cycles, cycle_time, noise, seed):
+    """Returns the time of each cycle and the noisy readings of the plate, with shape (rows, cols, cycles)"""
+    rows, cols = plates[wells]
+    time = np.arange(cycles)*float(cycle_time)
+    curve = simulate(model, time)
+    rng = np.random.default_rng(seed)
+    matrix = np.empty((rows, cols, cycles))
+    matrix[0] = signal # controls, fully reacted
+    matrix[1:] = signal*curve
+    matrix += signal*noise*rng.standard_normal(matrix.shape)
+    return time, matrix
+
+
+def write_xls(path, time, matrix, cycle_time, name):
+    """Writes the readings as a CLARIOstar .xls export, with the protocol and DATA sheets Assay reads"""
+    import xlwt # only needed to write workbooks
+    rows, cols, cycles = matrix.shape
+    book = xlwt.Workbook()
+    data = book.add_sheet('DATA')
+    ptcl = book.add_sheet('Protocol Information')
+    ptcl.write(3, 0, "Test Name: {}".format(name))
+    ptcl.write(11, 0, "Measurement type:")
+    ptcl.write(11, 1, "Fluorescence (FI)")
+    ptcl.write(17, 0, "No. of cycles:")
+    ptcl.write(17, 1, cycles)
+    ptcl.write(18, 0, "Cycle time [s]:")
+    ptcl.write(18, 1, float(cycle_time))
+    data.write(5, 0, "Test Name: {}".format(name))
+    for idx in range(cycles):
+        first = 12 + (rows + 4)*idx
+        data.write(first, 0, cycle_string(idx, time[idx]))
+        data.write(first + 1, 1, "Synthetic readings")
+        for col in range(cols):
+            data.write(first + 2, col + 1, col + 1)
+        for row in range(rows):
+            data.write(first + 3 + row, 0, row_label(row))
+            for col in range(cols):
+                data.write(first + 3 + row, col + 1, float(matrix[row, col, idx]))
+    book.save(path)
+
+
+def write_csv(path, time, matrix):
+    """Writes the readings as a .csv file, one row per cycle of the time in seconds and the wells in row-major order"""
+    rows, cols, cycles = matrix.shape
+    header = ["time"] + ["{}{}".format(row_label(row), col + 1) for row in range(rows) for col in range(cols)]
+    table = np.column_stack([time, matrix.reshape(rows*cols, cycles).T])
+    np.savetxt(path, table, delimiter=",", header=",".join(header), comments="", fmt="%.10g")
+
+
+def write_config(path, model, assay_path, wells, guess_factor):
+    """Writes a configuration fitting wells B1:B5 of the plate from the true parameters scaled by guess_factor"""
+    spec = models[model]
+    rows, cols = plates[wells]
+    parameters = {name: {"init_guess": value*guess_factor, "min": 1.0e-10, "max": 1.0e8}
+                  for name, value in spec["params"].items()}
+    config = {
+        "title": "Synthetic {} {} wells".format(model, wells),
+        "model": {"func_path": spec["func_path"], "parameters": parameters, "y0": spec["y0"], "max_value": max_value},
+        "fitter": {"data_wells": ["B1:B5"], "control_wells": ["A1:A5"], "noise": {"model": "replicate"}},
+        "integration": {"atol": 1.0e-12, "rtol": 1.0e-6, "method": "Radau"},
+        "assay": {"file_path": assay_path, "cols": cols, "rows": rows}
+    }
+    with open(path, 'w') as f:
+        yaml.safe_dump(config, f, sort_keys=False)
+
+
+def generate(model, wells=96, cycles=200, duration=7200, noise=0.01, seed=0, out_dir=default_dir, file_format=None,
+             guess_factor=0.5):
+    """Writes a synthetic plate and its configuration, returning their paths and the true parameters
+
+    The cycle time is duration/cycles, rounded to whole seconds as in CLARIOstar exports. The
+    format is xls if the plate fits an .xls sheet and xlwt is installed, otherwise csv. Files that
+    already exist are reused, since they only depend on the arguments.
+    """
+    if model not in models:
+        raise ValueError("model must be one of {}".format(", ".join(models)))
+    if wells not in plates:
+        raise ValueError("wells must be one of {}".format(", ".join(str(n) for n in plates)))
+    if file_format is None:
+        try:
+            import xlwt # noqa: F401
+            file_format = "xls" if fits_xls(wells, cycles) else "csv"
+        except ImportError:
+            file_format = "csv"
+    if file_format == "xls" and not fits_xls(wells, cycles):
+        raise ValueError("{} wells x {} cycles do not fit an .xls sheet".format(wells, cycles))
+    cycle_time = max(1, round(duration/cycles))
+    name = "{}_{}w_{}c_{}s_{:g}n_{}".format(model, wells, cycles, cycle_time, noise, seed)
+    os.makedirs(out_dir, exist_ok=True)
+    assay_path = os.path.join(out_dir, "{}.{}".format(name, file_format))
+    config_path = os.path.join(out_dir, "{}_{}_g{:g}.yaml".format(name, file_format, guess_factor))
+    if not os.path.exists(assay_path):
+        time, matrix = readings(model, wells, cycles, cycle_time, noise, seed)
+        tmp_path = "{}.{}.tmp.{}".format(os.path.splitext(assay_path)[0], os.getpid(), file_format)
+        if file_format == "xls":
+            write_xls(tmp_path, time, matrix, cycle_time, name)
+        else:
+            write_csv(tmp_path, time, matrix)
+        os.replace(tmp_path, assay_path)
+    if not os.path.exists(config_path):
+        write_config(config_path, model, assay_path, wells, guess_factor)
+    return assay_path, config_path, dict(models[model]["params"])
+
+
+def main(args):
+    assay_path, config_path, params = generate(args.model, args.wells, args.cycles, args.duration, args.noise, args.seed,
+                                               args.out_dir, args.format, args.guess_factor)
+    print("Plate: {}".format(assay_path))
+    print("Configuration: {}".format(config_path))
+    print("True parameters: {}".format(", ".join("{} = {:g}".format(name, value) for name, value in params.items())))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate a synthetic CLARIOstar plate from an example model.")
+    parser.add_argument('-m', '--model', dest='model', default='4_param', choices=list(models), help='Example model generating the curves.')
+    parser.add_argument('-w', '--wells', dest='wells', type=int, default=96, choices=list(plates), help='Number of wells of the plate.')
+    parser.add_argument('-n', '--cycles', dest='cycles', type=int, default=200, help='Number of cycles.')
+    parser.add_argument('-d', '--duration', dest='duration', type=float, default=7200, help='Length of the run in seconds.')
+    parser.add_argument('--noise', dest='noise', type=float, default=0.01, help='Standard deviation of the readings, relative to the full signal.')
+    parser.add_argument('-s', '--seed', dest='seed', type=int, default=0, help='Seed of the noise.')
+    parser.add_argument('-f', '--format', dest='format', choices=['xls', 'csv'], help='File format, by default xls if the plate fits an .xls sheet and xlwt is installed.')
+    parser.add_argument('-g', '--guess-factor', dest='guess_factor', type=float, default=0.5, help='Initial guesses of the configuration, relative to the true parameters.')
+    parser.add_argument('-o', '--output', dest='out_dir', default=default_dir, help='Directory of the plate and configuration.')
+    args = parser.parse_args()
+    main(args)
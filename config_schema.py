@@ -1,16 +1,20 @@
 import re
-from schema import Schema, Use, And, Regex
+from schema import Schema, Use, And, Or, Regex, Optional
+from Wells import selector_regex
 
 assay_schema = Schema({
-    "file_path": And(str, lambda n: n.endswith(".xls"), error="File must be of type .xls"),
+    "file_path": And(str, lambda n: n.endswith((".xls", ".csv")), error="File must be of type .xls or .csv"),
     "cols": int,
-    "rows": int
+    "rows": int,
+    Optional("reader", default="bulk"): Or("bulk", "legacy"),
+    Optional("cache", default=False): bool
 })
 
 param_schema = Schema({
     'init_guess': Use(float), # Use call coerces ints to floats on validation
     'max': Use(float),
     'min': Use(float),
+    Optional('scale', default='linear'): Or('linear', 'log') # log optimises the parameter in log10 space
 })
 
 parameters_schema = Schema({
@@ -21,19 +25,121 @@ model_schema = Schema({
     "func_path": And(str, lambda n: n.endswith(".py"), error="File must be of type .py"),
     "parameters": And(parameters_schema, lambda n: len(n)>=1),
     "y0": And(list, lambda n: all((isinstance(v, float) or isinstance(v, int))  for v in n)),
-    "max_value": Use(float)
+    "max_value": Use(float),
+    Optional("compile", default=False): bool
 })
 
 integration_schema = Schema({
     "atol": Use(float),
     "rtol": Use(float),
-    "method": str
+    "method": str,
+    Optional("jacobian", default="finite_difference"): Or("finite_difference", "analytic"),
+    Optional("cache_size", default=128): And(int, lambda n: n >= 0),
+    Optional("cache_memory", default=64.0): And(Use(float), lambda n: n >= 0), # megabytes
+    Optional("max_time", default=None): Or(None, Use(float)), # seconds per integration
+    Optional("max_nfev", default=None): Or(None, And(int, lambda n: n >= 1)) # ODE function evaluations per integration
 })
 
 
+multistart_schema = Schema({
+    "starts": And(int, lambda n: n >= 1),
+    Optional("workers", default=0): And(int, lambda n: n >= 0), # 0 uses all cores
+    Optional("seed", default=None): Or(None, int),
+    Optional("cancel_factor", default=10.0): Use(float),
+    Optional("min_nfev", default=20): And(int, lambda n: n >= 0)
+})
+
+well_regex = Regex(selector_regex)
+
+uncertainty_schema = Schema({
+    Optional("bootstrap", default=100): And(int, lambda n: n >= 0), # residual bootstrap refits
+    Optional("profile_points", default=10): And(int, lambda n: n >= 0), # profile points either side of the best value
+    Optional("level", default=0.95): And(Use(float), lambda n: 0 < n < 1),
+    Optional("span", default=1.0): Use(float),
+    Optional("workers", default=0): And(int, lambda n: n >= 0), # 0 uses all cores
+    Optional("seed", default=None): Or(None, int)
+})
+
+sampling_schema = Schema({
+    Optional("walkers", default=32): And(int, lambda n: n >= 2),
+    Optional("steps", default=5000): And(int, lambda n: n >= 1), # most steps of each walker, including resumed ones
+    Optional("burn", default=0): And(int, lambda n: n >= 0),
+    Optional("thin", default=1): And(int, lambda n: n >= 1),
+    Optional("check_interval", default=100): And(int, lambda n: n >= 1), # steps between convergence checks
+    Optional("tau_factor", default=50.0): Use(float),
+    Optional("tau_rtol", default=0.01): Use(float),
+    Optional("level", default=0.95): And(Use(float), lambda n: 0 < n < 1),
+    Optional("workers", default=0): And(int, lambda n: n >= 0), # 0 uses all cores
+    Optional("seed", default=None): Or(None, int),
+    Optional("chain", default=None): Or(None, str) # csv file of the chain, resumed if it exists
+})
+
+noise_schema = Schema({
+    Optional("model", default="rolling"): Or("rolling", "replicate", "constant"),
+    Optional("window", default=20): And(int, lambda n: n >= 2),
+    Optional("value", default=1.0): Use(float)
+})
+
 fitter_schema = Schema({
-    "data_wells": [Regex(r'^[A-Z]\d{1,2}(:[A-Z]\d{1,2})?$')],
-    "control_wells": [Regex(r'^[A-Z]\d{1,2}(:[A-Z]\d{1,2})?$')]
+    "data_wells": [well_regex],
+    "control_wells": [well_regex],
+    Optional("sensitivity", default=False): bool,
+    Optional("jacobian_workers", default=0): And(int, lambda n: n >= 0),
+    Optional("jacobian_executor", default="process"): Or("process", "thread", "batch"),
+    Optional("noise", default=noise_schema.validate({})): noise_schema,
+    Optional("multistart"): multistart_schema,
+    Optional("uncertainty"): uncertainty_schema,
+    Optional("sampling"): sampling_schema
+})
+
+plate_schema = Schema({
+    Optional("workers", default=0): And(int, lambda n: n >= 0), # 0 uses all cores
+    Optional("replicates", default=False): bool
+})
+
+store_schema = Schema({
+    Optional("path", default=None): Or(None, str), # sqlite file, defaults to cache/results.sqlite
+    Optional("reuse", default=True): bool # False refits and records without returning stored fits
+})
+
+report_schema = Schema({
+    Optional("format", default="png"): Or("png", "svg"), # svg embeds the figures as vectors
+    Optional("dpi", default=300): And(int, lambda n: n >= 1),
+    Optional("workers", default=0): And(int, lambda n: n >= 0) # 0 uses all cores
+})
+
+watch_schema = Schema({
+    Optional("interval", default=30.0): Use(float), # seconds between checks of the assay file
+    Optional("tolerance", default=0.05): Use(float),
+    Optional("patience", default=3): And(int, lambda n: n >= 1),
+    Optional("min_cycles", default=10): And(int, lambda n: n >= 2),
+    Optional("timeout", default=3600.0): Or(None, Use(float))
+})
+
+dataset_schema = Schema({
+    Optional("label"): str,
+    "data_wells": [well_regex],
+    "control_wells": [well_regex],
+    Optional("y0"): And(list, lambda n: all((isinstance(v, float) or isinstance(v, int))  for v in n)), # defaults to the model y0
+    Optional("max_value"): Use(float) # defaults to the model max_value
+})
+
+candidate_schema = Schema({
+    Optional("label"): str, # defaults to the name of the func_path file
+    **model_schema.schema
+})
+
+selection_schema = Schema({
+    "candidates": And([candidate_schema], lambda n: len(n)>=1), # fitted alongside the model section
+    Optional("criterion", default="aic"): Or("aic", "bic"),
+    Optional("workers", default=0): And(int, lambda n: n >= 0), # 0 uses all cores
+    Optional("cancel_delta", default=10.0): Use(float),
+    Optional("min_nfev", default=50): And(int, lambda n: n >= 0)
+})
+
+global_schema = Schema({
+    "shared": [str], # parameters shared across datasets, all others are fitted separately for each dataset
+    "datasets": And([dataset_schema], lambda n: len(n)>=1)
 })
 
 config_schema = Schema({
@@ -42,6 +148,12 @@ config_schema = Schema({
     "model": model_schema,
     "integration": integration_schema,
     "fitter": fitter_schema,
+    Optional("plate", default=plate_schema.validate({})): plate_schema,
+    Optional("watch", default=watch_schema.validate({})): watch_schema,
+    Optional("report", default=report_schema.validate({})): report_schema,
+    Optional("store"): store_schema,
+    Optional("global"): global_schema,
+    Optional("selection"): selection_schema
 })
 
 
@@ -1,30 +1,172 @@
+import sys
+import time
 import argparse
-from os.path import exists, dirname
-from Configurator import Configurator
-from Report import Report
+from os.path import exists, dirname, abspath, isdir
 import numpy as np
+from Profiler import profiler
+# the fitting, report and batch modules are imported where they are used, so --help, --no-report
+# and the table modes start without importing the libraries they do not need
+
+def run(config, args, out_f):
+    """Fits a loaded configuration in the mode selected by the arguments, writing the output to out_f
+
+    Raises a RuntimeError if the integration fails at the fitted parameters. With --profile, the
+    profile of the run is written next to out_f, also if the run fails.
+    """
+    try:
+        run_mode(config, args, out_f)
+    finally:
+        if profiler.enabled:
+            profiler.export(out_f)
+
+def run_mode(config, args, out_f):
+    """Runs a loaded configuration in the mode selected by the arguments"""
+    if args.plate: # fit each well separately, writing a table of parameters instead of a report
+        table = config.make_plate().fit()
+        table.to_csv(out_f)
+        print("Done, parameter table saved at: {}".format(abspath(out_f)))
+        return
+    if args.watch: # refit as cycles are added to the assay file, writing the estimates after each fit
+        config.make_watcher(out_f).run()
+        print("Done, parameter estimates saved at: {}".format(abspath(out_f)))
+        return
+    if args.global_fit: # fit all datasets of the global section at once
+        global_fitter = config.make_global_fitter()
+        table = global_fitter.param_table(global_fitter.fit())
+        table.to_csv(out_f)
+        print("Done, parameter table saved at: {}".format(abspath(out_f)))
+        return
+    if args.select: # fit the candidate models of the selection section to the same data, ranking them
+        selection = config.make_selection()
+        selection.fit()
+        if args.no_report:
+            from Results import selection_results, save_json
+            save_json(selection_results(selection), out_f)
+            print("Done, results saved at: {}".format(abspath(out_f)))
+            return
+        from Report import ComparisonReport
+        report_config = config.config["report"]
+        report = ComparisonReport(config.config["title"], config.fitter.normalised_data, config.assay.time, selection.curves,
+                                  selection.results, selection.summary, selection.criterion, out_f,
+                                  report_config["format"], report_config["dpi"], config.workers(report_config["workers"]))
+        with profiler.phase("report"):
+            report.generate_pdf()
+        return
+    assay = config.assay
+    model = config.model
+    fitter = config.fitter
+    title = config.config["title"]
+    store = config.make_store()
+    key = store.key(config) if store is not None else None
+    stored = store.load(key) if store is not None else None # the fit of a run with the same inputs
+    if stored is not None:
+        from Results import minimizer_result, result_tables
+        fit = minimizer_result(stored)
+        intervals, posterior = result_tables(stored)
+        model.params = fit.params
+        model_sol = model.normalised()
+    else:
+        start = time.perf_counter()
+        multistart = config.make_multistart()
+        if multistart is not None: # fit from several starting points, keeping the best
+            fit = multistart.fit()
+        else:
+            fit = fitter.fit() # begin the fitting process
+        fit_time = time.perf_counter() - start
+        model_sol = model.normalised()
+        if np.isnan(model_sol).all(): # nothing to report
+            raise RuntimeError("Integration failed at the fitted parameters: {}".format(model.integrate().message))
+        intervals, posterior = None, None
+        uncertainty = config.make_uncertainty(fit)
+        if uncertainty is not None:
+            with profiler.phase("uncertainty"):
+                intervals = uncertainty.run() # bootstrap and profile intervals
+        sampler = config.make_sampler(fit)
+        if sampler is not None:
+            with profiler.phase("sampling"):
+                posterior = sampler.run() # emcee posterior summary
+        if store is not None:
+            from Results import fit_results
+            store.save(key, config, fit_results(fit, intervals, posterior), fit_time, time.perf_counter() - start)
+    if args.no_report: # machine-readable results instead of the pdf
+        from Results import fit_results, save_json
+        save_json(stored if stored is not None else fit_results(fit, intervals, posterior), out_f)
+        print("Done, results saved at: {}".format(abspath(out_f)))
+        return
+    from Report import Report
+    report_config = config.config["report"]
+    report = Report(title, fitter.normalised_data, assay.time, model_sol, fit, fitter.mini, out_f, intervals,
+                    posterior, report_config["format"], report_config["dpi"], config.workers(report_config["workers"]))
+    with profiler.phase("report"):
+        report.generate_pdf() # create and save the report
+
+def history(args):
+    """Writes the fits of the results store to a CSV table, the store of the configuration file if one is given
+
+    Without --output the table is written to stdout.
+    """
+    from Store import Store
+    path = None
+    if args.config_f is not None:
+        import yaml
+        from config_schema import store_schema
+        with open(args.config_f, 'r') as f:
+            store_config = yaml.safe_load(f).get("store")
+        path = store_schema.validate(store_config)["path"] if store_config is not None else None
+    table = Store(path).table()
+    if args.out_f is None:
+        table.to_csv(sys.stdout)
+        return
+    table.to_csv(args.out_f)
+    print("Done, {} stored fits saved at: {}".format(len(table), abspath(args.out_f)))
 
 def main(args):
+    profiler.enabled = args.profile
     # check that the input and output locations exist
-    if not exists(args.config_f):
+    if args.history:
+        history(args)
+    elif not exists(args.config_f):
         print("Configuration file not found.")
-    elif not exists(dirname(args.out_f)):
+    elif args.batch and not isdir(args.out_f):
         print("Output directory not found.")
+    elif not args.batch and not exists(dirname(args.out_f)):
+        print("Output directory not found.")
+    elif args.batch: # run each configuration of a directory or manifest on a worker pool
+        from Batch import Batch
+        extension = "csv" if args.plate or args.global_fit else "json" if args.no_report else "pdf"
+        batch = Batch(Batch.find_configs(args.config_f), args.out_f, run, args, args.workers, extension)
+        summary = batch.run()
+        print("Done, {} of {} runs succeeded, summary saved at: {}".format(
+            (summary["status"] == "ok").sum(), len(summary), abspath(batch.summary_path)))
+        if (summary["status"] != "ok").any():
+            sys.exit(1)
     else:
-        config = Configurator(args.config_f) # load configuration, instantiate classes
-        assay = config.assay
-        model = config.model
-        fitter = config.fitter
-        title = config.config["title"]
-        fit = fitter.fit() # begin the fitting process
-        model_sol = model.normalised()
-        report = Report(title, fitter.normalised_data, assay.time, model_sol, fit, fitter.mini, args.out_f)
-        report.generate_pdf() # create and save the report 
+        profiler.reset()
+        with profiler.phase("configure"):
+            from Configurator import Configurator
+            # in watch mode the fitter is made once the assay has min_cycles, the file may not have any yet
+            config = Configurator(args.config_f, p_fitter=not args.watch) # load configuration, instantiate classes
+        try:
+            run(config, args, args.out_f)
+        except RuntimeError as exc: # nothing to report, exit with an error for batch scripts
+            print(exc)
+            sys.exit(1)
 
 if __name__ == '__main__':
     # set up arguments for command-line interface
     parser = argparse.ArgumentParser(description="Placeholder description")
-    parser.add_argument('-c', '--config', dest='config_f', help='Path to yaml configuration file.')
-    parser.add_argument('-o', '--output', dest='out_f', help='Path to output PDF report file.')
+    parser.add_argument('-c', '--config', dest='config_f', help='Path to yaml configuration file, or with --batch a directory of them or a manifest listing them.')
+    parser.add_argument('-o', '--output', dest='out_f', help='Path to output PDF report file, JSON results file with --no-report, or CSV parameter table with --plate, --global or --watch. With --batch, the output directory.')
+    parser.add_argument('-p', '--plate', dest='plate', action='store_true', help='Fit each selected well separately and output a CSV table of parameters.')
+    parser.add_argument('-g', '--global', dest='global_fit', action='store_true', help='Fit the datasets of the global section at once and output a CSV table of parameters.')
+    parser.add_argument('-w', '--watch', dest='watch', action='store_true', help='Refit as new cycles are written to the assay file and output a CSV table of estimates.')
+    parser.add_argument('-s', '--select', dest='select', action='store_true', help='Fit the model and the candidate models of the selection section to the same data and output a PDF report ranking them.')
+    parser.add_argument('-n', '--no-report', dest='no_report', action='store_true', help='Skip the PDF report and output the fit results, or with --select the ranking and the fits, as a JSON file.')
+    parser.add_argument('--history', dest='history', action='store_true', help='Output a CSV table of the fits in the results store, that of --config if given, to --output or stdout.')
+    parser.add_argument('--profile', dest='profile', action='store_true', help='Time the phases of the run and count the solver calls, writing <output>_profile.json and a Chrome trace <output>_trace.json next to the output.')
+    parser.add_argument('-b', '--batch', dest='batch', action='store_true', help='Run many configurations on a worker pool, writing one output per configuration and a summary CSV.')
+    parser.add_argument('-j', '--workers', dest='workers', type=int, default=0, help='Number of worker processes for --batch, 0 uses all cores.')
     args = parser.parse_args()
+    if args.batch and args.watch:
+        parser.error("--watch cannot be used with --batch")
     main(args)
\ No newline at end of file
@@ -0,0 +1,78 @@
+import os
+import numpy as np
+import pytest
+from lmfit import Parameters
+from Model import Model, load_ode_f
+from Fitter import Fitter
+
+examples = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples')
+
+
+def make_model(**kwargs):
+    params = Parameters()
+    params.add("k_plus", value=5.0e4, min=1.0e-10, max=1.0e8)
+    params.add("k_minus", value=1.0e-3, min=1.0e-10, max=1.0e8)
+    params.add("k", value=2.0e-3, min=1.0e-10, max=1.0e8)
+    return Model(load_ode_f(os.path.join(examples, '3_param_ode.py')), np.linspace(0, 7200, 101), params,
+                 (5.0e-9, 20.0e-9, 0.0, 0.0), 5.0e-9, 1.0e-14, 1.0e-8, "Radau", **kwargs)
+
+
+def test_integrate_batch_matches_separate_solves():
+    model = make_model()
+    base = np.array([param.value for param in model.params.values()])
+    param_matrix = base*np.array([[1.0, 1.0, 1.0], [2.0, 0.5, 1.0], [0.5, 1.0, 3.0]])
+    batch = model.integrate_batch(param_matrix)
+    each = model.integrate_each(param_matrix)
+    assert batch.shape == (3, len(model.time))
+    np.testing.assert_allclose(batch, each, atol=1e-5)
+    assert model.params["k_plus"].value == base[0] # integrate_each restores the parameters
+
+
+def test_integrate_batch_checks_the_parameter_columns():
+    with pytest.raises(ValueError):
+        make_model().integrate_batch(np.ones((2, 2)))
+
+
+def test_batch_jacobian_matches_separate_solves():
+    model = make_model()
+    model.integrate()
+    data = model.normalised() + 0.01*np.random.default_rng(0).standard_normal(len(model.time))
+    fitter = Fitter(model, model.time, data*60000.0, np.full(len(model.time), 60000.0),
+                    p_noise=np.full(len(model.time), 0.01))
+    params = model.params
+    fitter.jacobian_executor = "thread"
+    expected = []
+    base = fitter.residuals(params)
+    for name in params:
+        values = params.valuesdict()
+        step = fitter.fd_step*abs(values[name])
+        values[name] += step
+        expected.append((fitter.copy_residuals(values) - base)/step)
+    expected = np.column_stack(expected)
+    fitter.jacobian_executor = "batch"
+    jac = fitter.fd_jacobian(params)
+    assert jac.shape == expected.shape
+    assert np.all(np.abs(jac - expected).max(axis=0) < 1e-2*np.abs(expected).max(axis=0))
+
+
+def test_cache_reuses_successful_solutions_only():
+    model = make_model(p_max_nfev=5)
+    assert not model.integrate().success
+    assert len(model.cache) == 0
+    model.max_nfev = None
+    assert model.integrate().success
+    assert model.integrate() is model.integrate()
+    assert model.cache_hits == 2 and len(model.cache) == 1
+
+
+def test_cache_is_bounded_by_memory():
+    model = make_model()
+    nbytes = model.integrate().y.nbytes
+    model.cache_memory = 2.5*nbytes/1e6 # room for two solutions
+    for k in (1.0e-3, 2.0e-3, 3.0e-3):
+        model.params["k"].value = k
+        model.integrate()
+    assert len(model.cache) == 2
+    assert 0 < model.cache_bytes <= model.cache_memory*1e6
+    model.clear_cache()
+    assert len(model.cache) == 0 and model.cache_bytes == 0
@@ -0,0 +1,42 @@
+import numpy as np
+import pandas as pd
+import pytest
+import Noise
+from Noise import rolling_moments
+
+
+@pytest.mark.parametrize("window", [1, 2, 5, 40])
+def test_rolling_moments_match_pandas(window):
+    rng = np.random.default_rng(0)
+    data = 1.0e3 + rng.normal(size=(3, 30)).cumsum(axis=1)
+    mean, std = rolling_moments(data, window)
+    for trace, trace_mean, trace_std in zip(data, mean, std):
+        rolling = pd.Series(trace).rolling(window, min_periods=1)
+        np.testing.assert_allclose(trace_mean, rolling.mean().values, rtol=1e-12)
+        np.testing.assert_allclose(trace_std, rolling.std().values, rtol=1e-6, atol=1e-8, equal_nan=True)
+
+
+def test_rolling_std_of_a_single_point_is_nan():
+    mean, std = rolling_moments([[2.0, 4.0, 6.0]], 3)
+    assert np.isnan(std[0, 0])
+    np.testing.assert_allclose(mean[0], [2.0, 3.0, 4.0])
+
+
+def test_rolling_std_of_a_constant_trace_is_zero():
+    mean, std = rolling_moments(np.full((1, 10), 1.0e9), 4)
+    np.testing.assert_array_equal(mean, 1.0e9)
+    np.testing.assert_array_equal(std[0, 1:], 0.0)
+
+
+def test_cached_estimate_loads_only_on_a_miss():
+    Noise.cache.clear()
+    data_wells, control = np.ones((2, 5)) + np.arange(5), np.ones(5)
+    calls = []
+    def load():
+        calls.append(1)
+        return data_wells, control
+    noise = Noise.Noise("constant", p_value=2.0)
+    first = noise.cached("key", load)
+    assert noise.cached("key", load) is first and len(calls) == 1
+    noise.value = 3.0 # other settings are another estimate
+    assert noise.cached("key", load)[0] == 3.0 and len(calls) == 2
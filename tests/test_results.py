@@ -0,0 +1,38 @@
+import json
+import numpy as np
+from lmfit import Parameters, minimize
+from Results import fit_results, minimizer_result, plain
+
+
+def fitted(errorbars=True):
+    x = np.linspace(0, 5, 50)
+    data = 2.0*np.exp(-0.7*x) + np.random.default_rng(2).normal(scale=0.01, size=len(x))
+    params = Parameters()
+    params.add("a", value=1.0, min=0.0)
+    params.add("b", value=1.0, min=0.0, max=10.0)
+    params.add("c", value=0.0, vary=False)
+    residual = lambda params: params["a"]*np.exp(-params["b"]*x) + params["c"] - data
+    result = minimize(residual, params)
+    result.errorbars = errorbars # as when lmfit cannot estimate the errors
+    return result
+
+
+def test_minimizer_result_round_trips_through_json():
+    results = fit_results(fitted())
+    stored = json.loads(json.dumps(results)) # as the Store keeps it
+    rebuilt = minimizer_result(stored)
+    assert fit_results(rebuilt) == results
+    assert rebuilt.params["c"].vary is False and rebuilt.params["a"].max == np.inf
+    np.testing.assert_array_equal(rebuilt.covar, np.array(results["covar"]))
+
+
+def test_minimizer_result_without_covariance():
+    results = fit_results(fitted(errorbars=False))
+    assert results["covar"] is None
+    rebuilt = minimizer_result(results)
+    assert rebuilt.covar is None and not rebuilt.errorbars
+    assert fit_results(rebuilt) == results
+
+
+def test_plain_replaces_non_finite_values():
+    assert plain({"a": np.float64(np.nan), 1: [np.int64(2), np.inf], "b": np.bool_(True)}) == {"a": None, "1": [2, None], "b": True}
@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+from lmfit import Parameters, minimize
+from Selection import information_criterion
+
+
+def residual(params, x, data):
+    return params["a"]*np.exp(-params["b"]*x) - data
+
+
+@pytest.mark.parametrize("criterion", ["aic", "bic"])
+def test_information_criterion_matches_lmfit(criterion):
+    x = np.linspace(0, 5, 50)
+    data = 2.0*np.exp(-0.7*x) + np.random.default_rng(1).normal(scale=0.01, size=len(x))
+    params = Parameters()
+    params.add("a", value=1.0)
+    params.add("b", value=1.0)
+    result = minimize(residual, params, args=(x, data))
+    value = information_criterion(result.chisqr, result.ndata, result.nvarys, criterion)
+    assert value == pytest.approx(getattr(result, criterion), rel=1e-12)
+
+
+def test_information_criterion_of_a_perfect_fit_is_finite():
+    assert np.isfinite(information_criterion(0.0, 10, 2, "aic"))
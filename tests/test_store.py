@@ -0,0 +1,62 @@
+import os
+import shutil
+import yaml
+import pytest
+from Configurator import Configurator
+from Store import Store, input_key
+
+examples = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'examples')
+
+
+def write_config(directory, **fitter):
+    """Copies the 4 parameter example into directory and returns the path of its configuration file"""
+    os.makedirs(directory, exist_ok=True)
+    for name in ("4_param_ode.py", "data_2.xls"):
+        shutil.copy(os.path.join(examples, name), directory)
+    with open(os.path.join(examples, "4_param_config.yaml")) as f:
+        config = yaml.safe_load(f)
+    config["model"]["func_path"] = os.path.join(directory, "4_param_ode.py")
+    config["assay"]["file_path"] = os.path.join(directory, "data_2.xls")
+    config["fitter"].update(fitter)
+    config.pop("store", None)
+    path = os.path.join(directory, "config.yaml")
+    with open(path, 'w') as f:
+        yaml.safe_dump(config, f)
+    return path
+
+
+def key(path):
+    return Store(os.path.join(os.path.dirname(path), "results.sqlite")).key(Configurator(path, p_fitter=False))
+
+
+def test_key_is_stable_across_moved_files(tmp_path):
+    first = key(write_config(str(tmp_path/"a")))
+    assert key(write_config(str(tmp_path/"a"))) == first
+    assert key(write_config(str(tmp_path/"b"))) == first
+
+
+def test_key_changes_with_the_inputs(tmp_path):
+    first = key(write_config(str(tmp_path/"a")))
+    assert key(write_config(str(tmp_path/"b"), data_wells=["C5:G5"])) != first
+    path = write_config(str(tmp_path/"c"))
+    with open(os.path.join(str(tmp_path/"c"), "4_param_ode.py"), 'a') as f:
+        f.write("\n# edited\n")
+    assert key(path) != first
+
+
+def test_report_settings_do_not_change_the_key(tmp_path):
+    path = write_config(str(tmp_path/"a"))
+    first = key(path)
+    with open(path) as f:
+        config = yaml.safe_load(f)
+    config["report"] = {"dpi": 100}
+    with open(path, 'w') as f:
+        yaml.safe_dump(config, f)
+    assert key(path) == first
+
+
+def test_input_key_hashes_the_given_settings(tmp_path):
+    config = Configurator(write_config(str(tmp_path/"a")), p_fitter=False)
+    settings = {"model": dict(config.config["model"]), "assay": dict(config.config["assay"])}
+    assert input_key(config, settings) != input_key(config)
+    assert input_key(config, settings) == input_key(config, settings)
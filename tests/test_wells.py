@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from Wells import Wells, row_index, row_label
+
+
+def test_row_labels_round_trip():
+    assert [row_index(label) for label in ("A", "H", "Z", "AA", "AF")] == [0, 7, 25, 26, 31]
+    assert all(row_label(row_index(row_label(index))) == row_label(index) for index in range(32))
+
+
+def test_single_well():
+    wells = Wells(8, 12)
+    assert list(wells.compile("C3")) == [2*12 + 2]
+    assert list(wells.compile("c3")) == [2*12 + 2]
+
+
+def test_range_with_two_digit_columns():
+    wells = Wells(8, 12)
+    indices = wells.compile("A10:H12")
+    expected = [row*12 + col for row in range(8) for col in range(9, 12)]
+    assert list(indices) == expected
+    assert [label for label, _ in wells.expand("A10:B11")] == ["A10", "A11", "B10", "B11"]
+
+
+def test_two_letter_rows_on_1536_wells():
+    wells = Wells(32, 48)
+    assert list(wells.compile("AA1:AB2")) == [26*48, 26*48 + 1, 27*48, 27*48 + 1]
+    assert list(wells.compile("AF48")) == [32*48 - 1]
+
+
+@pytest.mark.parametrize("selector", ["I1", "A13", "A0", "H1:I1", "AG1", "A1:A49"])
+def test_selection_outside_the_plate(selector):
+    with pytest.raises(ValueError, match="outside of the plate"):
+        Wells(8, 12).compile(selector)
+
+
+@pytest.mark.parametrize("selector", ["B3:A1", "A3:B1", "B1:A3"])
+def test_reversed_range(selector):
+    with pytest.raises(ValueError, match="top left"):
+        Wells(8, 12).compile(selector)
+
+
+@pytest.mark.parametrize("selector", ["", "3C", "C", "C3:", "C3-D4", "AAA1", "C100"])
+def test_invalid_selection(selector):
+    with pytest.raises(ValueError, match="Invalid"):
+        Wells(8, 12).compile(selector)
+
+
+def test_compiled_selections_are_reused():
+    wells = Wells(8, 12)
+    assert wells.compile("C3:D4") is wells.compile("c3:d4")
+    with pytest.raises(ValueError):
+        wells.compile("C3:D4")[0] = 0 # shared between callers, so read-only
+
+
+def test_gather_and_average():
+    matrix = np.arange(8*12*3, dtype=float).reshape(8, 12, 3)
+    wells = Wells(8, 12)
+    gathered = wells.gather(matrix, ["A1", "B2:B3"])
+    np.testing.assert_array_equal(gathered, [matrix[0, 0], matrix[1, 1], matrix[1, 2]])
+    np.testing.assert_array_equal(wells.average(matrix, ["A1", "B2:B3"]), gathered.mean(axis=0))
+
+
+def test_average_rejects_nan():
+    matrix = np.zeros((8, 12, 3))
+    matrix[0, 1, 2] = np.nan
+    with pytest.raises(ValueError, match="nan"):
+        Wells(8, 12).average(matrix, ["A1:A2"])